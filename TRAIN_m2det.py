@@ -21,7 +21,7 @@ from utils.config import Config
 from model.m2det_detector import M2detDetector
 #from model.one_stage_detector import OneStageDetector
 from dataset.coco_dataset import CocoDataset
-from dataset.utils import get_dataset
+from dataset.utils import get_dataset, set_anchor_target_generator
 
 def get_dist_info():
     if dist._initialized:
@@ -106,6 +106,9 @@ def train(cfg_path, dataset_class):
     # prepare data & dataloader
     # Runner要求dataloader放在list里: 使workflow里每个flow对应一个dataloader
     dataset = get_dataset(cfg.data.train, dataset_class)
+    # precompute_targets=True的数据集在dataloader worker中计算anchor target
+    bbox_head = model.module.bbox_head if parallel else model.bbox_head
+    set_anchor_target_generator(dataset, bbox_head.anchor_target_generator(cfg.train_cfg))
     batch_size = cfg.gpus * cfg.data.imgs_per_gpu
     num_workers = cfg.gpus * cfg.data.workers_per_gpu
     dataloader = [DataLoader(dataset, 
@@ -0,0 +1,156 @@
+# model settings
+input_size = 320
+model = dict(
+    type='M2detDetector',
+#    pretrained='weights/m2det/vgg16_reducedfc.pth', # 这里不能采用原有M2det的预训练模型，原因是1.原有预训练模型是pytorch模型，跟mean/std不一样；2.原有预训练参数跟当前使用的VGG模型层的命名不一致，不带'feature'，导致初始化实际上没有用
+    pretrained='weights/m2det/vgg16_caffe-292e1171.pth',
+    backbone=dict(
+        type='M2detVGG',
+        input_size=input_size,
+        depth=16,
+        with_last_pool=False,
+        ceil_mode=True,
+        out_indices=(3, 4),
+        out_feature_indices=(22, 34),
+        l2_norm_scale=20,
+        checkpoint_backbone_stages=()),  # 训练时做activation checkpoint的vgg stage, 比如(0,1,2,3)
+    neck=dict(
+        type='MLFPN',
+        backbone_type='M2detVGG',
+        input_size=input_size,
+        planes=256,       # 代表每个tum的输出layers
+        smooth=True,      # 代表tum是否包含smooth conv(1x1)
+        num_levels=8,     # 代表多少个tums
+        num_scales=6,     # 代表每个tum输出多少scales
+        side_channel=512,
+        sfam=False,     # 是否含sfam模块
+        compress_ratio=16,
+        leach_mode='shared',  # 'shared'代表所有tum共用leach(只计算一次), 'per_level'代表每个tum独立leach
+        checkpoint_tums=False,  # 训练时tum做activation checkpoint(反向重算)，可大幅节省显存从而增大imgs_per_gpu
+        level_dropout=0.),  # 训练时以该概率随机只跑前k个tum, 用于支持测试时num_active_tums<num_levels
+    bbox_head=dict(
+        type='M2detHead',
+        input_size=input_size,
+        planes = 256,
+        num_levels=8,
+        num_classes=81,
+        anchor_strides=None,  # None代表按特征图尺寸推导
+        size_featmaps=None,  # None代表由detector根据backbone/neck推导: (40,40)...(1,1)
+        size_pattern = [0.06, 0.15, 0.33, 0.51, 0.69, 0.87, 1.05],  # 代表anchors尺寸跟img的比例, 前6个数是min_size比例，后6个数是max_size比例，可以此计算anchor最小最大尺寸
+        anchor_ratio_range = ([2, 3], [2, 3], [2, 3], [2, 3], [2, 3], [2, 3]),
+        target_means=(.0, .0, .0, .0),
+        target_stds=(1.0, 1.0, 1.0, 1.0),
+        fuse_head_convs=False))  # True: 每个level的reg/cls conv合并为一个conv(输入特征只读一次, 推理更快),
+                                 # 但参数结构和保存的checkpoint的key(head_convs)随之改变; 两种结构的checkpoint加载时会自动转换
+cudnn_benchmark = True
+train_cfg = dict(
+    assigner=dict(
+        type='MaxIoUAssigner',  # BatchedMaxIoUAssigner: batch内所有图片一次分配, 结果相同;
+                                # GridMaxIoUAssigner: 按anchor网格只计算gt附近anchor的iou, 结果相同
+        pos_iou_thr=0.5,
+        neg_iou_thr=0.5,
+        min_pos_iou=0.,
+        ignore_iof_thr=-1,
+        gt_max_assign_all=False,
+        chunk_size=-1),  # >0时按anchor分块计算iou(比如4096), 密集gt时峰值内存不随gt数增长, 结果相同
+    smoothl1_beta=1.,
+    allowed_border=-1,
+    pos_weight=-1,
+    neg_pos_ratio=3,
+    debug=False)
+test_cfg = dict(
+    nms=dict(type='nms', iou_thr=0.45),  # type可选nms/grid_nms(候选框很多时更快)/soft_nms/torch_nms(纯tensor实现, 不需要编译)/matrix_nms
+    min_bbox_size=0,
+    score_thr=0.02,
+    max_per_img=200,
+    num_active_tums=None)  # 测试时只运行前k个tum(缺失的用0填充), None代表全部8个
+# model training and testing settings
+# dataset settings
+dataset_type = 'CocoDataset'
+data_root = './data/coco/'
+# 预训练模型是否跟该mean/std不匹配？？？当前预训练模型是ssd的pytorch版本，是否应该换成caffe版本？这样mean/std不用换
+img_norm_cfg = dict(mean=[123.675, 116.28, 103.53], std=[1, 1, 1], to_rgb=True)
+data = dict(
+    imgs_per_gpu=2,  # 从4改成2
+    workers_per_gpu=2,
+    train=dict(
+        type='RepeatDataset',
+        times=5,
+        dataset=dict(
+            type=dataset_type,
+            ann_file=data_root + 'annotations/instances_train2017.json',
+            img_prefix=data_root + 'train2017/',
+            img_scale=(320, 320),
+            img_norm_cfg=img_norm_cfg,
+            size_divisor=None,
+            flip_ratio=0.5,
+            with_mask=False,
+            with_crowd=False,
+            with_label=True,
+            test_mode=False,
+            extra_aug=dict(
+                photo_metric_distortion=dict(
+                    brightness_delta=32,
+                    contrast_range=(0.5, 1.5),
+                    saturation_range=(0.5, 1.5),
+                    hue_delta=18),
+                expand=dict(
+                    mean=img_norm_cfg['mean'],
+                    to_rgb=img_norm_cfg['to_rgb'],
+                    ratio_range=(1, 4)),
+                random_crop=dict(
+                    min_ious=(0.1, 0.3, 0.5, 0.7, 0.9), min_crop_size=0.3)),
+            resize_keep_ratio=False,
+            precompute_targets=False)),  # True时anchor target在dataloader worker中计算, 跟训练并行
+    val=dict(
+        type=dataset_type,
+        ann_file=data_root + 'annotations/instances_val2017.json',
+        img_prefix=data_root + 'val2017/',
+        img_scale=(320, 320),
+        img_norm_cfg=img_norm_cfg,
+        size_divisor=None,
+        flip_ratio=0,
+        with_mask=False,
+        with_label=False,
+        test_mode=True,
+        resize_keep_ratio=False),
+    test=dict(
+        type=dataset_type,
+        ann_file=data_root + 'annotations/instances_val2017.json',
+        img_prefix=data_root + 'val2017/',
+        img_scale=(320, 320),
+        img_norm_cfg=img_norm_cfg,
+        size_divisor=None,
+        flip_ratio=0,
+        with_mask=False,
+        with_label=False,
+        test_mode=True,
+        resize_keep_ratio=False))
+# optimizer
+optimizer = dict(type='SGD', lr=4e-4, momentum=0.9, weight_decay=5e-4)  # 学习率是8块GPU的，所以在1块GPU下从2e-3改为了2e-4
+optimizer_config = dict()
+# learning policy
+lr_config = dict(
+    policy='step',
+    warmup='linear',
+    warmup_iters=500,
+    warmup_ratio=1.0 / 3,
+    step=[16, 22])
+checkpoint_config = dict(interval=1)
+# yapf:disable
+log_config = dict(
+    interval=50,
+    hooks=[
+        dict(type='TextLoggerHook'),
+        # dict(type='TensorboardLoggerHook')
+    ])
+# yapf:enable
+# runtime settings
+gpus=2
+total_epochs = 10
+dist_params = dict(backend='nccl')
+log_level = 'INFO'
+work_dir = './work_dirs/m2det320_coco'
+load_from = None
+resume_from = None
+workflow = [('train', 1)]
@@ -12,7 +12,8 @@ model = dict(
         ceil_mode=True,
         out_indices=(3, 4),
         out_feature_indices=(22, 34),
-        l2_norm_scale=20),
+        l2_norm_scale=20,
+        checkpoint_backbone_stages=()),  # 训练时做activation checkpoint的vgg stage, 比如(0,1,2,3)
     neck=dict(
         type='MLFPN',
         backbone_type='M2detVGG',
@@ -23,7 +24,10 @@ model = dict(
         num_scales=6,     # 代表每个tum输出多少scales
         side_channel=512,
         sfam=False,     # 是否含sfam模块
-        compress_ratio=16),
+        compress_ratio=16,
+        leach_mode='shared',  # 'shared'代表所有tum共用leach(只计算一次), 'per_level'代表每个tum独立leach
+        checkpoint_tums=False,  # 训练时tum做activation checkpoint(反向重算)，可大幅节省显存从而增大imgs_per_gpu
+        level_dropout=0.),  # 训练时以该概率随机只跑前k个tum, 用于支持测试时num_active_tums<num_levels
     bbox_head=dict(
         type='M2detHead',
         input_size=input_size,
@@ -35,26 +39,31 @@ model = dict(
         size_featmaps = [(64,64), (32,32), (16,16), (8,8), (4,4), (2,2)],
         anchor_ratio_range = ([2, 3], [2, 3], [2, 3], [2, 3], [2, 3], [2, 3]),
         target_means=(.0, .0, .0, .0),
-        target_stds=(1.0, 1.0, 1.0, 1.0)))
+        target_stds=(1.0, 1.0, 1.0, 1.0),
+        fuse_head_convs=False))  # True: 每个level的reg/cls conv合并为一个conv(输入特征只读一次, 推理更快),
+                                 # 但参数结构和保存的checkpoint的key(head_convs)随之改变; 两种结构的checkpoint加载时会自动转换
 cudnn_benchmark = True
 train_cfg = dict(
     assigner=dict(
-        type='MaxIoUAssigner',
+        type='MaxIoUAssigner',  # BatchedMaxIoUAssigner: batch内所有图片一次分配, 结果相同;
+                                # GridMaxIoUAssigner: 按anchor网格只计算gt附近anchor的iou, 结果相同
         pos_iou_thr=0.5,
         neg_iou_thr=0.5,
         min_pos_iou=0.,
         ignore_iof_thr=-1,
-        gt_max_assign_all=False),
+        gt_max_assign_all=False,
+        chunk_size=-1),  # >0时按anchor分块计算iou(比如4096), 密集gt时峰值内存不随gt数增长, 结果相同
     smoothl1_beta=1.,
     allowed_border=-1,
     pos_weight=-1,
     neg_pos_ratio=3,
     debug=False)
 test_cfg = dict(
-    nms=dict(type='nms', iou_thr=0.45),
+    nms=dict(type='nms', iou_thr=0.45),  # type可选nms/grid_nms(候选框很多时更快)/soft_nms/torch_nms(纯tensor实现, 不需要编译)/matrix_nms
     min_bbox_size=0,
     score_thr=0.02,
-    max_per_img=200)
+    max_per_img=200,
+    num_active_tums=None)  # 测试时只运行前k个tum(缺失的用0填充), None代表全部8个
 # model training and testing settings
 # dataset settings
 dataset_type = 'CocoDataset'
@@ -91,7 +100,8 @@ data = dict(
                     ratio_range=(1, 4)),
                 random_crop=dict(
                     min_ious=(0.1, 0.3, 0.5, 0.7, 0.9), min_crop_size=0.3)),
-            resize_keep_ratio=False)),
+            resize_keep_ratio=False,
+            precompute_targets=False)),  # True时anchor target在dataloader worker中计算, 跟训练并行
     val=dict(
         type=dataset_type,
         ann_file=data_root + 'annotations/instances_val2017.json',
@@ -118,7 +118,8 @@ class CocoDataset(Dataset):
                  with_label=True,
                  extra_aug=None,
                  resize_keep_ratio=True,
-                 test_mode=False):
+                 test_mode=False,
+                 precompute_targets=False):
         # prefix of images path
         self.img_prefix = img_prefix
 
@@ -180,6 +181,14 @@ class CocoDataset(Dataset):
         # image rescale if keep ratio
         self.resize_keep_ratio = resize_keep_ratio
 
+        # 在worker中计算anchor target(anchor_labels等), 需要通过set_anchor_target_generator()设置
+        self.precompute_targets = precompute_targets
+        self.anchor_target_generator = None
+
+    def set_anchor_target_generator(self, generator):
+        """precompute_targets=True时使用的target生成器: head.anchor_target_generator(train_cfg)"""
+        self.anchor_target_generator = generator
+
     def __len__(self):
         return len(self.img_infos)
 
@@ -322,6 +331,17 @@ class CocoDataset(Dataset):
             data['gt_bboxes_ignore'] = DC(to_tensor(gt_bboxes_ignore))
         if self.with_mask:
             data['gt_masks'] = DC(gt_masks, cpu_only=True)
+        if self.precompute_targets:
+            assert self.anchor_target_generator is not None, \
+                'call set_anchor_target_generator() before using precompute_targets'
+            targets = self.anchor_target_generator(
+                to_tensor(gt_bboxes), to_tensor(gt_labels), img_meta)
+            # no valid anchors
+            if targets is None:
+                return None
+            for name, target in zip(('anchor_labels', 'anchor_label_weights',
+                                     'anchor_bbox_targets', 'anchor_bbox_weights'), targets):
+                data[name] = DC(target)
         return data
 
     def prepare_test_img(self, idx):
@@ -236,6 +236,17 @@ class ConcatDataset(_ConcatDataset):
             self.flag = np.concatenate(flags)
 
 
+def set_anchor_target_generator(dataset, generator):
+    """给RepeatDataset/ConcatDataset内所有precompute_targets=True的数据集设置anchor target生成器"""
+    if isinstance(dataset, RepeatDataset):
+        set_anchor_target_generator(dataset.dataset, generator)
+    elif isinstance(dataset, ConcatDataset):
+        for dset in dataset.datasets:
+            set_anchor_target_generator(dset, generator)
+    elif getattr(dataset, 'precompute_targets', False):
+        dataset.set_anchor_target_generator(generator)
+
+
 def get_dataset(data_cfg, dataset_class):
     """"获得数据集
     Args:
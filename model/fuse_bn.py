@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用于部署时把BatchNorm折叠进前面的conv: 推理时bn只是一个逐通道的仿射变换
+y = (x - mean) / sqrt(var + eps) * gamma + beta, 可以直接合并到conv的weight/bias中，
+从而减少一次kernel调用和一次完整的特征图读写。
+"""
+import torch
+import torch.nn as nn
+
+
+def fuse_conv_bn(conv, bn):
+    """return a new conv with bn running stats folded into weight and bias
+    Args:
+        conv(nn.Conv2d): conv layer before bn
+        bn(nn.BatchNorm2d): bn layer (use running_mean/running_var)
+    Returns:
+        fused_conv(nn.Conv2d): conv with bias, equivalent to bn(conv(x)) in eval mode
+    """
+    fused_conv = nn.Conv2d(conv.in_channels,
+                           conv.out_channels,
+                           kernel_size=conv.kernel_size,
+                           stride=conv.stride,
+                           padding=conv.padding,
+                           dilation=conv.dilation,
+                           groups=conv.groups,
+                           bias=True).to(conv.weight.device)
+    scale, shift = bn_scale_shift(bn)
+    with torch.no_grad():
+        fused_conv.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        if conv.bias is not None:
+            fused_conv.bias.copy_(conv.bias * scale + shift)
+        else:
+            fused_conv.bias.copy_(shift)
+    return fused_conv
+
+
+def bn_scale_shift(bn):
+    """return (scale, shift) so that bn(x) == x * scale + shift in eval mode"""
+    std = (bn.running_var + bn.eps).sqrt()
+    if bn.affine:
+        scale = bn.weight / std
+        shift = bn.bias - bn.running_mean * scale
+    else:
+        scale = 1. / std
+        shift = -bn.running_mean * scale
+    return scale.detach(), shift.detach()
+
+
+def fuse_module(module):
+    """recursively fuse conv+bn pairs inside a module (in place)
+    1. 带fuse()方法的子模块(比如BasicConv/MLFPN)调用自身fuse()
+    2. nn.Sequential中相邻的Conv2d+BatchNorm2d(比如VGG with_bn)合并，bn替换成Identity
+    Returns:
+        module(nn.Module): the same module after fusing
+    """
+    for name, child in module.named_children():
+        if hasattr(child, 'fuse'):
+            child.fuse()
+        elif isinstance(child, nn.Sequential):
+            _fuse_sequential(child)
+        else:
+            fuse_module(child)
+    return module
+
+
+def _fuse_sequential(seq):
+    layers = list(seq._modules.items())
+    for (name, layer), (next_name, next_layer) in zip(layers[:-1], layers[1:]):
+        if isinstance(layer, nn.Conv2d) and isinstance(next_layer, nn.BatchNorm2d):
+            seq._modules[name] = fuse_conv_bn(layer, next_layer)
+            seq._modules[next_name] = nn.Identity()
+    for name, layer in seq._modules.items():
+        if hasattr(layer, 'fuse'):
+            layer.fuse()
+        elif not isinstance(layer, (nn.Conv2d, nn.BatchNorm2d)):
+            fuse_module(layer)
+
+
+class ChannelShift(nn.Module):
+    """只剩逐通道偏置的bn: 用于bn的scale已经折叠进前面conv之后的部分"""
+    def __init__(self, shift):
+        super(ChannelShift, self).__init__()
+        self.register_buffer('shift', shift.detach().clone())
+
+    def forward(self, x):
+        return x + self.shift.view(1, -1, 1, 1)
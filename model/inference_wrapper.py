@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用于部署的TorchScript推理模块: img -> backbone -> MLFPN -> head -> decode -> nms -> 固定格式tensor
+1. 特征部分(backbone/neck/head的conv)是纯tensor计算，用torch.jit.trace导出
+2. 后处理部分(decode/nms)用torch.jit.script导出，不依赖img_meta字典和编译的nms扩展
+导出的文件可以直接在C++(libtorch)中torch::jit::load，python中用load_torchscript()加载，
+都不需要解析cfg或者构建python模型
+"""
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+from typing import Tuple
+
+from utils.anchor_generator import grid_anchors_flat
+from utils.bbox_reg import delta2bbox_script
+from utils.nms.torch_nms import nms_sorted
+
+# test_cfg没有设置nms_pre时推理模块nms之前保留的候选个数
+DEFAULT_NMS_PRE = 1000
+
+
+class M2detFeatureNet(nn.Module):
+    """backbone -> neck -> head, 输出按anchor展平
+    输出的anchor顺序跟head.get_anchors()一致: level -> (h, w) -> 6个base anchor
+    """
+    def __init__(self, detector):
+        super(M2detFeatureNet, self).__init__()
+        self.backbone = detector.backbone
+        self.neck = detector.neck if detector.cfg.model.neck is not None else None
+        self.bbox_head = detector.bbox_head
+        # restrict_classes()之后cls conv只输出背景和选中的类别
+        self.num_classes = detector.bbox_head.cls_out_channels
+
+    def forward(self, img):
+        """
+        Args:
+            img(tensor): (b,3,h,w)
+        Returns:
+            cls_scores(tensor): (b, num_anchors, num_classes) logits
+            bbox_preds(tensor): (b, num_anchors, 4) deltas
+        """
+        x = self.backbone(img)
+        if self.neck is not None:
+            x = self.neck(x)
+        cls_scores, bbox_preds = self.bbox_head(x)
+        b = img.size(0)
+        cls_scores = torch.cat([s.permute(0, 2, 3, 1).reshape(
+            b, -1, self.num_classes) for s in cls_scores], 1)
+        bbox_preds = torch.cat([p.permute(0, 2, 3, 1).reshape(
+            b, -1, 4) for p in bbox_preds], 1)
+        return cls_scores, bbox_preds
+
+
+def nms_keep(bboxes, scores, iou_thr: float):
+    """greedy nms(跟cpu_nms一致: iou >= iou_thr的框被抑制, 面积按+1计算)，
+    使用torch_nms的分块计算(nms_sorted)
+    Args:
+        bboxes(tensor): (n,4)
+        scores(tensor): (n,)
+    Returns:
+        keep(tensor): (k,) indices sorted by score descending
+    """
+    _, order = scores.sort(descending=True, stable=True)
+    kept = nms_sorted(bboxes[order], iou_thr)
+    # script模式下order[kept]会使整个函数慢大约3倍，index_select没有这个问题
+    return order.index_select(0, kept)
+
+
+class M2detInferenceWrapper(nn.Module):
+    """可script的完整推理模块
+    Args:
+        feature_net(nn.Module): M2detFeatureNet或其trace后的ScriptModule
+        anchors(tensor): (num_anchors, 4) 跟feature_net输出的anchor顺序一致
+        test_cfg(dict): score_thr, nms(type='nms', iou_thr), max_per_img, nms_pre(可选, 默认DEFAULT_NMS_PRE)
+        class_inds(list): head.restrict_classes()选中的类别序号, 输出的labels映射回原来的类别序号
+    """
+    def __init__(self, feature_net, anchors, target_means, target_stds, test_cfg,
+                 class_inds=None):
+        super(M2detInferenceWrapper, self).__init__()
+        assert test_cfg['nms'].get('type', 'nms') == 'nms', \
+            'only hard nms can be exported'
+        self.feature_net = feature_net
+        self.register_buffer('anchors', anchors.float())
+        self.register_buffer('target_means', torch.tensor(target_means, dtype=torch.float32))
+        self.register_buffer('target_stds', torch.tensor(target_stds, dtype=torch.float32))
+        self.score_thr = float(test_cfg['score_thr'])
+        self.iou_thr = float(test_cfg['nms']['iou_thr'])
+        self.max_per_img = int(test_cfg['max_per_img'])
+        # test_cfg没有设置nms_pre时(默认配置score_thr=0.02时有几万个候选)只取score最高的
+        # DEFAULT_NMS_PRE个做nms，避免导出的模型nms太慢; 显式设置为-1则不限制
+        nms_pre = test_cfg.get('nms_pre')
+        self.nms_pre = int(nms_pre if nms_pre is not None else DEFAULT_NMS_PRE)
+        self.max_ratio = float(np.abs(np.log(16 / 1000)))
+        self.map_labels = class_inds is not None
+        self.register_buffer('label_map', torch.tensor(
+            class_inds if class_inds is not None else [], dtype=torch.long) - 1)
+
+    def decode(self, deltas):
+        """同utils.bbox_reg.delta2bbox, 支持batch: (b,n,4) -> (b,n,4)"""
+        return delta2bbox_script(self.anchors, deltas, self.target_means, self.target_stds,
+                                 self.max_ratio)
+
+    def multiclass_nms(self, bboxes, scores):
+        """单张图的多类nms: 所有类别一起做一次nms(不同类别的框加偏移保证不重叠)
+        Args:
+            bboxes(tensor): (n,4)
+            scores(tensor): (n, num_classes) 包含背景
+        Returns:
+            dets(tensor): (k,5) sorted by score, k <= max_per_img
+            labels(tensor): (k,) 0-based
+        """
+        cls_scores = scores[:, 1:]
+        inds = (cls_scores > self.score_thr).nonzero()
+        anchor_inds, labels = inds[:, 0], inds[:, 1]
+        det_scores = cls_scores[anchor_inds, labels]
+        if self.nms_pre > 0 and det_scores.numel() > self.nms_pre:
+            det_scores, topk = det_scores.topk(self.nms_pre)
+            anchor_inds, labels = anchor_inds[topk], labels[topk]
+        det_bboxes = bboxes[anchor_inds]
+        if det_bboxes.numel() == 0:
+            return bboxes.new_zeros((0, 5)), labels
+        offsets = labels.to(det_bboxes.dtype) * (det_bboxes.max() + 2)
+        keep = nms_keep(det_bboxes + offsets[:, None], det_scores, self.iou_thr)
+        keep = keep[:self.max_per_img]
+        dets = torch.cat([det_bboxes[keep], det_scores[keep][:, None]], 1)
+        return dets, labels[keep]
+
+    def forward(self, img, img_shapes, scale_factors) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            img(tensor): (b,3,h,w)
+            img_shapes(tensor): (b,2) 缩放后的图片(h, w)，用于裁剪bbox
+            scale_factors(tensor): (b,1)或(b,4)[ws,hs,ws,hs], bbox除以该值还原到原图
+        Returns:
+            dets(tensor): (b, max_per_img, 5) [x1,y1,x2,y2,score], 不足的部分填0
+            labels(tensor): (b, max_per_img) 0-based, 不足的部分填-1
+            num_dets(tensor): (b,) 每张图有效的检测个数
+        """
+        cls_scores, bbox_preds = self.feature_net(img)
+        scores = cls_scores.softmax(-1)
+        bboxes = self.decode(bbox_preds)
+        b = img.size(0)
+        out_dets = img.new_zeros((b, self.max_per_img, 5))
+        out_labels = torch.full((b, self.max_per_img), -1, dtype=torch.long,
+                                device=img.device)
+        num_dets = torch.zeros(b, dtype=torch.long, device=img.device)
+        for i in range(b):
+            h = img_shapes[i, 0]
+            w = img_shapes[i, 1]
+            zero = torch.zeros_like(h)
+            x1 = torch.min(torch.max(bboxes[i, :, 0], zero), w - 1)
+            y1 = torch.min(torch.max(bboxes[i, :, 1], zero), h - 1)
+            x2 = torch.min(torch.max(bboxes[i, :, 2], zero), w - 1)
+            y2 = torch.min(torch.max(bboxes[i, :, 3], zero), h - 1)
+            # 跟get_bboxes一样先还原到原图再做nms(iou的+1使nms结果跟尺度有关)
+            dets, labels = self.multiclass_nms(
+                torch.stack([x1, y1, x2, y2], -1) / scale_factors[i], scores[i])
+            if self.map_labels:
+                labels = self.label_map[labels]
+            n = dets.size(0)
+            out_dets[i, :n] = dets
+            out_labels[i, :n] = labels
+            num_dets[i] = n
+        return out_dets, out_labels, num_dets
+
+
+def get_flat_anchors(bbox_head, device='cpu'):
+    """按M2detFeatureNet输出顺序拼接所有level的anchors: (num_anchors, 4)"""
+    return grid_anchors_flat(bbox_head.anchor_generators, bbox_head.featmap_sizes,
+                             bbox_head.anchor_strides, device=device)
+
+
+def build_inference_wrapper(detector, script=True, feature_net=None):
+    """从M2detDetector构建推理模块
+    Args:
+        detector(nn.Module): eval模式的detector(可以先deploy()折叠bn)
+        script(bool): True则返回trace+script后的ScriptModule, False返回eager模块
+        feature_net(nn.Module): 替换默认的M2detFeatureNet(比如cpu上的int8量化模型)，输出格式需一致
+    Returns:
+        wrapper(nn.Module)
+    """
+    detector.eval()
+    head = detector.bbox_head
+    input_size = detector.cfg.input_size
+    if feature_net is None:
+        feature_net = M2detFeatureNet(detector).eval()
+        device = next(detector.parameters()).device
+    else:
+        device = torch.device('cpu')
+    if script:
+        example = torch.zeros(1, 3, input_size, input_size, device=device)
+        with torch.no_grad():
+            feature_net = torch.jit.trace(feature_net, example)
+    wrapper = M2detInferenceWrapper(feature_net,
+                                    get_flat_anchors(head, device),
+                                    head.target_means,
+                                    head.target_stds,
+                                    detector.test_cfg,
+                                    head.class_inds).eval()
+    if script:
+        wrapper = torch.jit.script(wrapper)
+    return wrapper
+
+
+def export_torchscript(detector, out_file, class_names=None, feature_net=None,
+                       extra_meta=None):
+    """导出TorchScript文件，同时在文件中保存input_size/class_names等元信息"""
+    wrapper = build_inference_wrapper(detector, script=True, feature_net=feature_net)
+    meta = dict(input_size=detector.cfg.input_size,
+                num_classes=detector.bbox_head.num_classes,
+                class_names=list(class_names) if class_names is not None else None,
+                max_per_img=int(detector.test_cfg['max_per_img']))
+    if extra_meta is not None:
+        meta.update(extra_meta)
+    torch.jit.save(wrapper, out_file, _extra_files={'meta.json': json.dumps(meta)})
+    return wrapper
+
+
+def load_torchscript(path, map_location='cpu'):
+    """冷启动加载导出的模型: 不需要cfg, 也不需要构建python模型
+    Returns:
+        model(ScriptModule): model(img, img_shapes, scale_factors) -> (dets, labels, num_dets)
+        meta(dict): input_size/num_classes/class_names/max_per_img(量化模型还有quant_backend)
+    """
+    extra_files = {'meta.json': ''}
+    model = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'] or '{}')
+    if meta.get('quant_backend') is not None:
+        # int8模型需要跟量化时相同的quantized engine
+        torch.backends.quantized.engine = meta['quant_backend']
+    return model.eval(), meta
@@ -15,3 +15,17 @@ class M2detDetector(OneStageDetector):
 
     def __init__(self, cfg):  # 输入参数修改成cfg，同时预训练模型参数网址可用了
         super(M2detDetector, self).__init__(cfg)
+        # anytime inference: 测试时只运行前num_active_tums个tum
+        if self.test_cfg.get('num_active_tums', None) is not None:
+            self.set_active_levels(self.test_cfg.num_active_tums)
+
+    def deploy(self):
+        """切换到部署模式: 折叠所有BasicConv/MLFPN.Norm的bn"""
+        return self.fuse_for_inference()
+
+    def set_active_levels(self, num_active_levels=None):
+        """运行时切换测试时使用的tum个数(1~num_levels, None代表全部)，用于负载高峰时降低延时，
+        不需要更换模型. 只影响eval模式，训练时由neck的level_dropout控制
+        """
+        self.neck.set_active_levels(num_active_levels)
+        return self
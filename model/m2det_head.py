@@ -11,17 +11,52 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from mmdet.core import multiclass_nms
-
-from utils.anchor_generator import AnchorGenerator
-from utils.anchor_target import anchor_target
+from utils.anchor_generator import AnchorGenerator, AnchorCache, m2det_anchor_generators
+from utils.anchor_target import (anchor_target, anchor_target_batched, pad_gt_list,
+                                 GridMaxIoUAssigner, AnchorTargetGenerator)
 from utils.multi_apply import multi_apply  
-from utils.bbox_reg import delta2bbox
+from utils.bbox_reg import delta2bbox, delta2bbox_fast, bbox2ctr_wh
+from utils.bbox_nms import multiclass_nms, candidate_nms
 from model.weight_init import kaiming_normal_init
-from model.losses import weighted_smoothl1
+from model.losses import weighted_smoothl1, smooth_l1_loss
 from utils.registry_build import registered
 
 
+def get_bboxes_from_scores(scores, bbox_preds, anchors_cwh, img_shape, scale_factor, cfg,
+                           target_means, target_stds, rescale=False):
+    """单张图的后处理: 先筛选score > score_thr的(anchor, class)对，再在所有level中联合取score最高的
+    nms_pre个，只对剩下的anchor解码，然后nms. 不需要解码所有的anchor
+    Args:
+        scores(tensor): (N, num_classes) 所有level拼接后的softmax score
+        bbox_preds(tensor): (N, 4)
+        anchors_cwh(tensor): (N, 4) anchor的中心和宽高(bbox2ctr_wh())
+        cfg(dict): test_cfg, dict(score_thr, nms, max_per_img, nms_pre(可选))
+    Returns:
+        det_bboxes(k,5), det_labels(k,)
+    """
+    num_classes = scores.shape[1]
+    # 在连续的scores上比较，去掉背景列后按展开的序号取score(比scores[:, 1:]上的mask快)
+    valid_mask = scores > cfg['score_thr']
+    valid_mask[:, 0] = False
+    flat_inds = valid_mask.view(-1).nonzero()[:, 0]
+    anchor_inds = flat_inds // num_classes
+    labels = flat_inds % num_classes - 1
+    pair_scores = scores.reshape(-1)[flat_inds]
+    nms_pre = cfg.get('nms_pre', -1)
+    if 0 < nms_pre < pair_scores.numel():
+        _, topk_inds = pair_scores.topk(nms_pre)
+        # 保持anchor的顺序
+        topk_inds, _ = topk_inds.sort()
+        anchor_inds = anchor_inds[topk_inds]
+        labels = labels[topk_inds]
+        pair_scores = pair_scores[topk_inds]
+    bboxes = delta2bbox_fast(anchors_cwh[anchor_inds], bbox_preds[anchor_inds], target_means,
+                             target_stds, img_shape)
+    if rescale:
+        bboxes /= bboxes.new_tensor(scale_factor)
+    return candidate_nms(bboxes, pair_scores, labels, cfg['nms'], cfg['max_per_img'])
+
+
 @registered.register_module
 class M2detHead(nn.Module):
     """M2detHead主要完成3件事：生成anchors, 处理feat maps，计算loss
@@ -41,19 +76,42 @@ class M2detHead(nn.Module):
                  anchor_ratio_range = ([2, 3], [2, 3], [2, 3], [2, 3], [2, 3], [2, 3]),
                  target_means=(.0, .0, .0, .0),
                  target_stds=(1.0, 1.0, 1.0, 1.0),
+                 fuse_head_convs=False,  # 每个level的reg/cls两个conv合并成一个conv, 输入特征只读一次
                  **kwargs):  # 这里的2代表了2和1/2, 而3代表了3和1/3，可以此计算每个cell的anchor个数：2个方框+4个ratio=6个
         super().__init__()
-        self.featmap_sizes = size_featmaps
+        # size_featmaps=None时由detector根据backbone/neck推导后填入cfg
+        assert size_featmaps is not None, 'size_featmaps should be given or inferred by detector'
+        self.featmap_sizes = [tuple(s) for s in size_featmaps]
+        # anchor_strides=None时按特征图尺寸推导: 比如512输入为8,16,32,64,128,256
+        if anchor_strides is None:
+            anchor_strides = [int(round(input_size / max(s))) for s in self.featmap_sizes]
         self.anchor_strides = anchor_strides
         self.anchor_ratios = anchor_ratio_range
+        self.size_pattern = size_pattern
         self.num_classes = num_classes
+        # restrict_classes()之后cls conv只输出背景和选中的类别
+        self.cls_out_channels = num_classes
+        self.class_inds = None
         self.target_means = target_means
         self.target_stds = target_stds
+        self.fuse_head_convs = fuse_head_convs
+        self.num_reg_channels = 4 * 6
         
         # create m2det head layers
         reg_convs = []
         cls_convs = []
+        head_convs = []
         for i in range(len(size_featmaps)):
+            if fuse_head_convs:
+                # 输出通道前24个为reg, 后num_classes*6个为cls
+                head_convs.append(
+                    nn.Conv2d(
+                        planes * num_levels,
+                        self.num_reg_channels + num_classes * 6,
+                        kernel_size=3,
+                        stride=1,
+                        padding=1))
+                continue
             reg_convs.append(
                 nn.Conv2d(
                     planes * num_levels,
@@ -68,40 +126,16 @@ class M2detHead(nn.Module):
                     kernel_size=3,
                     stride=1,
                     padding=1))
-        self.reg_convs = nn.ModuleList(reg_convs)
-        self.cls_convs = nn.ModuleList(cls_convs)
+        if fuse_head_convs:
+            self.head_convs = nn.ModuleList(head_convs)
+        else:
+            self.reg_convs = nn.ModuleList(reg_convs)
+            self.cls_convs = nn.ModuleList(cls_convs)
         
         # generate anchors
-        if input_size == 512:
-            min_ratios = size_pattern[:-1]
-            max_ratios = size_pattern[1:]
-            
-            min_sizes = [min_ratios[i] * input_size for i in range(len(min_ratios))]
-            max_sizes = [max_ratios[i] * input_size for i in range(len(max_ratios))]
-            
-            
-            
-        
-        self.anchor_generators = []
-        for k in range(len(self.anchor_strides)):
-            base_size = min_sizes[k]
-            stride = self.anchor_strides[k]
-            ctr = ((stride - 1) / 2., (stride - 1) / 2.)
-            scales = [1., np.sqrt(max_sizes[k] / min_sizes[k])]  # 以base_size为第一个anchor，即scale=1，再以
-            ratios = [1.]
-            for r in self.anchor_ratios[k]:
-                ratios += [1 / r, r]
-            # scales (2,) and ratios (5,), if scale_major=False, (1,5)*(2,1)->(2,5)*(2,5)->(2,5)
-            anchor_generator = AnchorGenerator(
-                base_size, scales, ratios, scale_major=False, ctr=ctr)
-            
-            # for m2det, there are 6 anchors for each cells, no matter in any featmap cell
-            anchor_generator.base_anchors = anchor_generator.base_anchors[:6]  # 取前6个anchors(对应scale=1的5种ratios + scale=sqrt(max_size/min_size)的1种ratio)
-#            indices = list(range(len(ratios)))
-#            indices.insert(1, len(indices))
-#            anchor_generator.base_anchors = torch.index_select(
-#                anchor_generator.base_anchors, 0, torch.LongTensor(indices))
-            self.anchor_generators.append(anchor_generator)
+        self.anchor_generators = m2det_anchor_generators(
+            input_size, self.anchor_strides, size_pattern, self.anchor_ratios)
+        self.anchor_cache = AnchorCache(self.anchor_generators, self.anchor_strides)
     
     def init_weights(self):
         
@@ -115,8 +149,31 @@ class M2detHead(nn.Module):
                 elif key.split('.')[-1] == 'bias':
                     m.state_dict()[key][...] = 0   
         
-        self.cls_convs.apply(weights_init)
-        self.reg_convs.apply(weights_init)
+        if self.fuse_head_convs:
+            self.head_convs.apply(weights_init)
+        else:
+            self.cls_convs.apply(weights_init)
+            self.reg_convs.apply(weights_init)
+    
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """reg_convs/cls_convs两个conv的权重与合并后head_convs的权重互相转换，
+        使得两种结构的checkpoint都可以直接加载
+        """
+        for i in range(len(self.featmap_sizes)):
+            for name in ('weight', 'bias'):
+                reg_key = prefix + 'reg_convs.{}.{}'.format(i, name)
+                cls_key = prefix + 'cls_convs.{}.{}'.format(i, name)
+                head_key = prefix + 'head_convs.{}.{}'.format(i, name)
+                if self.fuse_head_convs and reg_key in state_dict and cls_key in state_dict:
+                    state_dict[head_key] = torch.cat(
+                        [state_dict.pop(reg_key), state_dict.pop(cls_key)], 0)
+                elif not self.fuse_head_convs and head_key in state_dict:
+                    head_param = state_dict.pop(head_key)
+                    state_dict[reg_key] = head_param[:self.num_reg_channels]
+                    state_dict[cls_key] = head_param[self.num_reg_channels:]
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
     
     def forward(self, feats):
         """return the output features of MLFPN
@@ -128,52 +185,74 @@ class M2detHead(nn.Module):
         """
         bbox_preds = []
         cls_scores = []
+        if self.fuse_head_convs:
+            # 一次conv输出后按通道切分(view, 不拷贝)
+            for feat, head_conv in zip(feats, self.head_convs):
+                out = head_conv(feat)
+                bbox_preds.append(out[:, :self.num_reg_channels])
+                cls_scores.append(out[:, self.num_reg_channels:])
+            return cls_scores, bbox_preds
         for (feat, reg_conv, cls_conv) in zip(feats, self.reg_convs, self.cls_convs):
             bbox_preds.append(reg_conv(feat))
             cls_scores.append(cls_conv(feat))
         return cls_scores, bbox_preds
     
-    def get_anchors(self, featmap_sizes, img_metas):
-        """Get anchors according to feature map sizes.
+    def restrict_classes(self, class_inds):
+        """只检测部分类别: cls conv只保留每个anchor的背景和选中类别的输出通道，
+        softmax在这些类别上重新归一化，后处理也只遍历这些类别. 输出的det_labels仍然是原来的类别序号.
+        需要在加载权重之后调用，之后不能再训练
+        Args:
+            class_inds(list[int]): 选中的类别序号, 1~num_classes-1 (0为背景)
+        """
+        class_inds = sorted(set(int(i) for i in class_inds))
+        assert len(class_inds) > 0 and all(0 < i < self.num_classes for i in class_inds), \
+            'class_inds should be in [1, {}]'.format(self.num_classes - 1)
+        # 当前cls conv输出的类别(可以在已经restrict的head上继续缩小)
+        cur_labels = [0] + (self.class_inds or list(range(1, self.num_classes)))
+        assert all(i in cur_labels for i in class_inds), 'classes already removed'
+        rows = torch.tensor([cur_labels.index(i) for i in [0] + class_inds])
+        num_anchors = self.anchor_generators[0].num_base_anchors
+        channel_inds = (torch.arange(num_anchors)[:, None] * self.cls_out_channels + rows).view(-1)
+        if self.fuse_head_convs:
+            convs = self.head_convs
+            channel_inds = torch.cat([torch.arange(self.num_reg_channels),
+                                      channel_inds + self.num_reg_channels])
+        else:
+            convs = self.cls_convs
+        for i, conv in enumerate(convs):
+            new_conv = nn.Conv2d(conv.in_channels, channel_inds.numel(), conv.kernel_size,
+                                 conv.stride, conv.padding, device=conv.weight.device,
+                                 dtype=conv.weight.dtype)
+            with torch.no_grad():
+                new_conv.weight.copy_(conv.weight[channel_inds])
+                new_conv.bias.copy_(conv.bias[channel_inds])
+            convs[i] = new_conv
+        self.cls_out_channels = len(rows)
+        self.class_inds = class_inds
+        return self
+
+    def get_anchors(self, featmap_sizes, img_metas, device='cpu', allowed_border=-1):
+        """从anchor cache获取anchors和valid flags(只在featmap_sizes/pad_shape第一次出现时生成)
         Args:
             featmap_sizes (list[tuple]): Multi-level feature map sizes.
             img_metas (list[dict]): Image meta info.
+            allowed_border (int): >=0时valid flags同时去掉超出img_shape的anchor
 
         Returns:
-            tuple: anchors of each image, valid flags of each image
+            tuple: anchors of each image(所有图片共享同一个(N,4) tensor),
+                valid flags of each image (N,), 每个level的anchor数
         """
-        num_imgs = len(img_metas)
-        num_levels = len(featmap_sizes)
-
-        # since feature map sizes of all images are the same, we only compute
-        # anchors for one time
-        multi_level_anchors = []
-        for i in range(num_levels):
-            anchors = self.anchor_generators[i].grid_anchors(
-                featmap_sizes[i], self.anchor_strides[i])
-            multi_level_anchors.append(anchors)
-        anchor_list = [multi_level_anchors for _ in range(num_imgs)]
-
-        # for each image, we compute valid flags of multi level anchors
-        valid_flag_list = []
-        for img_id, img_meta in enumerate(img_metas):
-            multi_level_flags = []
-            for i in range(num_levels):
-                anchor_stride = self.anchor_strides[i]
-                feat_h, feat_w = featmap_sizes[i]
-                h, w, _ = img_meta['pad_shape']
-                valid_feat_h = min(int(np.ceil(h / anchor_stride)), feat_h)
-                valid_feat_w = min(int(np.ceil(w / anchor_stride)), feat_w)
-                flags = self.anchor_generators[i].valid_flags(
-                    (feat_h, feat_w), (valid_feat_h, valid_feat_w))
-                multi_level_flags.append(flags)
-            valid_flag_list.append(multi_level_flags)
-
-        return anchor_list, valid_flag_list
+        cached = self.anchor_cache.get(featmap_sizes, device)
+        anchor_list = [cached['anchors']] * len(img_metas)
+        valid_flag_list = [
+            self.anchor_cache.valid_flags(featmap_sizes, img_meta['pad_shape'],
+                                          img_meta['img_shape'], allowed_border, device)
+            for img_meta in img_metas]
+        return anchor_list, valid_flag_list, cached['num_level_anchors']
                 
     def loss_single(self, cls_score, bbox_pred, labels, label_weights,
                     bbox_targets, bbox_weights, num_total_samples, cfg):
-        """return one img loss
+        """return one img loss(逐张图的参考实现, loss()使用batch版本的loss_batch())
         Args:
             cls_score(tensor): (m, num_class) for all bbox in one img
             bbox_pred(tensor): (m, 4) for all bbox coodinate in one img
@@ -206,7 +285,17 @@ class M2detHead(nn.Module):
                                      avg_factor=num_total_samples)
         return loss_cls, loss_reg
     
-    def loss(self, cls_scores, bbox_preds, gt_bboxes, gt_labels, img_metas, cfg):
+    def anchor_target_generator(self, cfg):
+        """用于dataset的precompute_targets: 在DataLoader worker中计算每张图的anchor target
+        Args:
+            cfg: train cfg
+        """
+        return AnchorTargetGenerator(self.anchor_generators, self.featmap_sizes,
+                                     self.anchor_strides, self.target_means, self.target_stds,
+                                     cfg)
+
+    def loss(self, cls_scores, bbox_preds, gt_bboxes, gt_labels, img_metas, cfg,
+             anchor_targets=None):
         """ return losses dict('loss_cls', 'loss_reg')
         Args:
             cls_scores(list): (6,) with (b,n_class*6,h,w)
@@ -215,78 +304,164 @@ class M2detHead(nn.Module):
             gt_labels(list): (n_img,) with (m,)
             img_metas(list): (n_img,) with dict()
             cfg
+            anchor_targets(tuple, optional): dataset中算好的(labels, label_weights, bbox_targets,
+                bbox_weights), 每个为(n_img,)的list, 见anchor_target_generator()
         """
-        # get all anchors (n_img,): 
-        anchor_list, valid_flag_list = self.get_anchors(self.featmap_sizes, img_metas) # anchor_list(b,) with (24576,4),(6114,4),(1536,4),(384,4),(96,4),(24,4)
-        # get target (n_scale,): (2,k,4)
-        cls_reg_targets = anchor_target(
-            anchor_list,
-            valid_flag_list,
-            gt_bboxes,
-            img_metas,
-            self.target_means,
-            self.target_stds,
-            cfg,
-            gt_labels_list=gt_labels,
-            label_channels=1,
-            sampling=False,
-            unmap_outputs=False)
-        
-        if cls_reg_targets is None:
-            return None
-        (labels_list, label_weights_list, bbox_targets_list, 
-         bbox_weights_list, num_total_pos, num_total_neg) = cls_reg_targets
-        
-         # 由于anchor_target()函数多做了一步分解到level的操作，这里需要重新把
-        # 所有anchor合并到(b, sum(wi*hi*6), 4)
+        assert self.class_inds is None, 'restricted head can not be trained'
         num_images = len(img_metas)
+        if anchor_targets is not None:
+            all_labels, all_label_weights, all_bbox_targets, all_bbox_weights = [
+                torch.stack(targets) for targets in anchor_targets]
+            # 跟anchor_target()一样每张图至少算1个正样本(保持为tensor, 不需要同步)
+            num_total_pos = (all_labels > 0).sum(1).clamp(min=1).sum()
+            return self.loss_from_targets(cls_scores, bbox_preds, all_labels, all_label_weights,
+                                          all_bbox_targets, all_bbox_weights, num_total_pos, cfg)
+        # get all anchors (n_img,): 
+        # anchor_list(b,) with (32760,4), 每个level的anchor数: 24576,6144,1536,384,96,24
+        anchor_list, valid_flag_list, num_level_anchors = self.get_anchors(
+            self.featmap_sizes, img_metas, cls_scores[0].device, cfg.allowed_border)
+        if cfg.assigner.get('type') == 'BatchedMaxIoUAssigner':
+            # 所有图片一次分配，直接得到(b, sum(wi*hi*6))的target
+            gt_bboxes_pad, gt_labels_pad, gt_valid = pad_gt_list(gt_bboxes, gt_labels)
+            cls_reg_targets = anchor_target_batched(
+                anchor_list[0], valid_flag_list, gt_bboxes_pad, gt_valid, img_metas,
+                self.target_means, self.target_stds, cfg, gt_labels=gt_labels_pad)
+            if cls_reg_targets is None:
+                return None
+            (all_labels, all_label_weights, all_bbox_targets, all_bbox_weights,
+             num_total_pos, num_total_neg) = cls_reg_targets
+        else:
+            assigner = None
+            if cfg.assigner.get('type') == 'GridMaxIoUAssigner':
+                # 按anchor网格只计算每个gt附近的anchor
+                assign_args = cfg.assigner.copy()
+                assign_args.pop('type')
+                assigner = GridMaxIoUAssigner(self.anchor_generators, self.featmap_sizes,
+                                              self.anchor_strides, **assign_args)
+            # get target (n_scale,): (2,k,4)
+            cls_reg_targets = anchor_target(
+                anchor_list,
+                valid_flag_list,
+                gt_bboxes,
+                img_metas,
+                self.target_means,
+                self.target_stds,
+                cfg,
+                gt_labels_list=gt_labels,
+                label_channels=1,
+                sampling=False,
+                unmap_outputs=False,
+                num_level_anchors=num_level_anchors,
+                assigner=assigner)
+
+            if cls_reg_targets is None:
+                return None
+            (labels_list, label_weights_list, bbox_targets_list,
+             bbox_weights_list, num_total_pos, num_total_neg) = cls_reg_targets
+
+            # 由于anchor_target()函数多做了一步分解到level的操作，这里需要重新把
+            # 所有anchor合并到(b, sum(wi*hi*6), 4)
+            all_labels = torch.cat(labels_list, -1).view(num_images, -1)
+            all_label_weights = torch.cat(label_weights_list, -1).view(num_images, -1)
+            all_bbox_targets = torch.cat(bbox_targets_list, -2).view(num_images, -1, 4)
+            all_bbox_weights = torch.cat(bbox_weights_list, -2).view(num_images, -1, 4)
+        return self.loss_from_targets(cls_scores, bbox_preds, all_labels, all_label_weights,
+                                      all_bbox_targets, all_bbox_weights, num_total_pos, cfg)
+
+    def loss_from_targets(self, cls_scores, bbox_preds, all_labels, all_label_weights,
+                          all_bbox_targets, all_bbox_weights, num_total_pos, cfg):
+        """根据(b, sum(wi*hi*6))的target计算loss"""
+        num_images = all_labels.size(0)
         all_cls_scores = torch.cat([s.permute(0, 2, 3, 1).reshape(
-                num_images, -1, self.num_classes) for s in cls_scores], 1)
-        all_labels = torch.cat(labels_list, -1).view(num_images, -1)
-        all_label_weights = torch.cat(label_weights_list, -1).view(num_images, -1)
+                num_images, -1, self.cls_out_channels) for s in cls_scores], 1)
         all_bbox_preds = torch.cat([b.permute(0, 2, 3, 1).reshape(
                 num_images, -1, 4) for b in bbox_preds], -2)
-        all_bbox_targets = torch.cat(bbox_targets_list, -2).view(num_images, -1, 4)
-        all_bbox_weights = torch.cat(bbox_weights_list, -2).view(num_images, -1, 4)
         
-        # calculate losses
-        # TODO: num_total_samples数据？？
-        losses_cls, losses_reg = multi_apply(self.loss_single,
-                                             all_cls_scores,
-                                             all_bbox_preds,
-                                             all_labels,
-                                             all_label_weights,
-                                             all_bbox_targets,
-                                             all_bbox_weights,
-                                             num_total_samples=num_total_pos,
-                                             cfg=cfg)
+        # calculate losses: 整个batch一起做hard negative mining
+        losses_cls, losses_reg = self.loss_batch(all_cls_scores,
+                                                 all_bbox_preds,
+                                                 all_labels,
+                                                 all_label_weights,
+                                                 all_bbox_targets,
+                                                 all_bbox_weights,
+                                                 num_total_samples=num_total_pos,
+                                                 cfg=cfg)
         return dict(loss_cls=losses_cls, loss_reg=losses_reg)
 
+    def loss_batch(self, all_cls_scores, all_bbox_preds, all_labels, all_label_weights,
+                   all_bbox_targets, all_bbox_weights, num_total_samples, cfg):
+        """batch版本的loss_single(): cross entropy整个batch一次计算，每张图的hard negative
+        通过沿anchor维度的一次排序选出前neg_pos_ratio * num_pos个，没有nonzero/topk和逐张图的循环.
+        选出的样本跟loss_single()相同，loss只有求和顺序带来的浮点误差
+        Args:
+            all_cls_scores(tensor): (b, m, num_class)
+            all_bbox_preds(tensor): (b, m, 4)
+            all_labels(tensor): (b, m)
+            all_label_weights(tensor): (b, m)
+            all_bbox_targets(tensor): (b, m, 4)
+            all_bbox_weights(tensor): (b, m, 4)
+        Returns:
+            losses_cls(list): (b,) with 0-d tensor
+            losses_reg(list): (b,) with (1,) tensor
+        """
+        num_images, num_anchors, num_classes = all_cls_scores.shape
+        loss_cls_all = F.cross_entropy(
+            all_cls_scores.reshape(-1, num_classes), all_labels.reshape(-1),
+            reduction='none').view(num_images, num_anchors) * all_label_weights
+
+        # hard negtive mining: 负样本的loss从大到小排序(loss >= 0, 其他anchor填-1排在最后)
+        pos = all_labels > 0
+        neg = all_labels == 0
+        num_neg_samples = torch.min(cfg.neg_pos_ratio * pos.sum(1), neg.sum(1))
+        sorted_loss_neg, _ = loss_cls_all.masked_fill(~neg, -1).sort(1, descending=True)
+        topk = torch.arange(num_anchors, device=all_labels.device)[None, :] < \
+            num_neg_samples[:, None]
+        loss_cls_pos = (loss_cls_all * pos).sum(1)
+        loss_cls_neg = (sorted_loss_neg * topk).sum(1)
+        loss_cls = (loss_cls_pos + loss_cls_neg) / num_total_samples
+
+        # loss of reg
+        loss_reg = smooth_l1_loss(all_bbox_preds, all_bbox_targets, cfg.smoothl1_beta,
+                                  reduction='none')
+        loss_reg = (loss_reg * all_bbox_weights).sum((1, 2)) / num_total_samples
+        return list(loss_cls.unbind(0)), list(loss_reg[:, None].unbind(0))
+
     def get_bboxes(self, cls_scores, bbox_preds, img_metas, cfg, rescale=False):
-        """用于在test时计算bbox"""
+        """用于在test时计算bbox: anchor生成和softmax对整个batch一起计算，
+        筛选/解码/nms逐张图进行(get_bboxes_from_scores())，结果跟逐张图调用get_bboxes_single()一致
+        Args:
+            cls_scores(list): (num_levels,) with (b, num_anchors*num_classes, h, w)
+            bbox_preds(list): (num_levels,) with (b, num_anchors*4, h, w)
+            img_metas(list): (b,) with dict(img_shape, scale_factor, ...)
+        Returns:
+            result_list(list): (b,) with (det_bboxes(k,5), det_labels(k,))
+        """
         assert len(cls_scores) == len(bbox_preds)
-        num_levels = len(cls_scores)
+        num_imgs = len(img_metas)
+        featmap_sizes = [cls_score.size()[-2:] for cls_score in cls_scores]
+        # 所有图片共享缓存的anchors(中心和宽高)
+        anchors_cwh = self.anchor_cache.get(featmap_sizes, cls_scores[0].device)['anchors_cwh']
+        # 所有level拼接后一次softmax: (b, N, num_classes) and (b, N, 4)
+        scores = torch.cat([
+            cls_score.detach().permute(0, 2, 3, 1).reshape(num_imgs, -1, self.cls_out_channels)
+            for cls_score in cls_scores], 1).softmax(-1)
+        bbox_preds = torch.cat([
+            bbox_pred.detach().permute(0, 2, 3, 1).reshape(num_imgs, -1, 4)
+            for bbox_pred in bbox_preds], 1)
 
-        mlvl_anchors = [
-            self.anchor_generators[i].grid_anchors(cls_scores[i].size()[-2:],
-                                                   self.anchor_strides[i])
-            for i in range(num_levels)
-        ]
         result_list = []
-        for img_id in range(len(img_metas)):
-            cls_score_list = [
-                cls_scores[i][img_id].detach() for i in range(num_levels)
-            ]
-            bbox_pred_list = [
-                bbox_preds[i][img_id].detach() for i in range(num_levels)
-            ]
-            img_shape = img_metas[img_id]['img_shape']
-            scale_factor = img_metas[img_id]['scale_factor']
-            proposals = self.get_bboxes_single(cls_score_list, bbox_pred_list,
-                                               mlvl_anchors, img_shape,
-                                               scale_factor, cfg, rescale)
-            result_list.append(proposals)
-        return result_list
+        for img_id, img_meta in enumerate(img_metas):
+            result_list.append(get_bboxes_from_scores(
+                scores[img_id], bbox_preds[img_id], anchors_cwh, img_meta['img_shape'],
+                img_meta['scale_factor'], cfg, self.target_means, self.target_stds, rescale))
+        return [self.map_labels(result) for result in result_list]
+
+    def map_labels(self, result):
+        """restrict_classes()之后把子集中的类别序号映射回原来的类别序号(0-based)"""
+        if self.class_inds is None:
+            return result
+        det_bboxes, det_labels = result
+        return det_bboxes, det_labels.new_tensor(self.class_inds)[det_labels] - 1
 
     def get_bboxes_single(self,
                           cls_scores,
@@ -296,43 +471,20 @@ class M2detHead(nn.Module):
                           scale_factor,
                           cfg,
                           rescale=False):
+        """单张图计算bbox
+        Args:
+            cls_scores(list): (num_levels,) with (num_anchors*num_classes, h, w)
+            bbox_preds(list): (num_levels,) with (num_anchors*4, h, w)
+            mlvl_anchors(list): (num_levels,) with (h*w*num_anchors, 4)
+        """
         assert len(cls_scores) == len(bbox_preds) == len(mlvl_anchors)
-        mlvl_bboxes = []
-        mlvl_scores = []
-        for cls_score, bbox_pred, anchors in zip(cls_scores, bbox_preds,
-                                                 mlvl_anchors):
-            assert cls_score.size()[-2:] == bbox_pred.size()[-2:]
-            cls_score = cls_score.permute(1, 2, 0).reshape(
-                -1, self.cls_out_channels)
-            if self.use_sigmoid_cls:
-                scores = cls_score.sigmoid()
-            else:
-                scores = cls_score.softmax(-1)
-            bbox_pred = bbox_pred.permute(1, 2, 0).reshape(-1, 4)
-            nms_pre = cfg.get('nms_pre', -1)
-            if nms_pre > 0 and scores.shape[0] > nms_pre:
-                if self.use_sigmoid_cls:
-                    max_scores, _ = scores.max(dim=1)
-                else:
-                    max_scores, _ = scores[:, 1:].max(dim=1)
-                _, topk_inds = max_scores.topk(nms_pre)
-                anchors = anchors[topk_inds, :]
-                bbox_pred = bbox_pred[topk_inds, :]
-                scores = scores[topk_inds, :]
-            bboxes = delta2bbox(anchors, bbox_pred, self.target_means,
-                                self.target_stds, img_shape)
-            mlvl_bboxes.append(bboxes)
-            mlvl_scores.append(scores)
-        mlvl_bboxes = torch.cat(mlvl_bboxes)
-        if rescale:
-            mlvl_bboxes /= mlvl_bboxes.new_tensor(scale_factor)
-        mlvl_scores = torch.cat(mlvl_scores)
-        if self.use_sigmoid_cls:
-            padding = mlvl_scores.new_zeros(mlvl_scores.shape[0], 1)
-            mlvl_scores = torch.cat([padding, mlvl_scores], dim=1)
-        det_bboxes, det_labels = multiclass_nms(
-            mlvl_bboxes, mlvl_scores, cfg.score_thr, cfg.nms, cfg.max_per_img)
-        return det_bboxes, det_labels
+        scores = torch.cat([cls_score.permute(1, 2, 0).reshape(-1, self.cls_out_channels)
+                            for cls_score in cls_scores]).softmax(-1)
+        bbox_preds = torch.cat([bbox_pred.permute(1, 2, 0).reshape(-1, 4)
+                                for bbox_pred in bbox_preds])
+        return self.map_labels(get_bboxes_from_scores(
+            scores, bbox_preds, bbox2ctr_wh(torch.cat(mlvl_anchors)), img_shape, scale_factor,
+            cfg, self.target_means, self.target_stds, rescale))
 
 
 # %%
@@ -9,6 +9,7 @@ import logging
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint as cp
 from .vgg import VGG
 from .weight_init import constant_init, normal_init, kaiming_init
 from .checkpoint import load_checkpoint
@@ -30,13 +31,15 @@ class M2detVGG(VGG):
                  out_indices=(3, 4),
                  out_feature_indices=(22, 34),
                  l2_norm_scale=20.,
+                 checkpoint_backbone_stages=(),
                  **kwargs):   # 添加一个**kwargs: 有一个type没地方放，又不想改cfg
         super(M2detVGG, self).__init__(
             depth,
             with_last_pool=with_last_pool,
             ceil_mode=ceil_mode,
             out_indices=out_indices)
-        assert input_size in (300, 512)
+        # 输出特征为input_size/8和input_size/16, mlfpn还需要再下采样到1/128
+        assert input_size == 300 or input_size % 64 == 0
         self.input_size = input_size
 
         self.features.add_module(
@@ -59,6 +62,30 @@ class M2detVGG(VGG):
         self.l2_norm = L2Norm(
             self.features[out_feature_indices[0] - 1].out_channels,
             l2_norm_scale)
+        # 哪些vgg stage(对应range_sub_modules)在训练时做activation checkpoint
+        self.checkpoint_backbone_stages = checkpoint_backbone_stages
+        self.segments = self._make_segments()
+
+    def _make_segments(self):
+        """把features切分成若干段(start, end, with_cp)：需要checkpoint的stage单独成段，
+        输出层(out_feature_indices)总是作为段的结尾，从而输出特征能被保留
+        """
+        cp_layers = set()
+        for i in self.checkpoint_backbone_stages:
+            cp_layers.update(range(*self.range_sub_modules[i]))
+        segments = []
+        start = 0
+        for i in range(len(self.features)):
+            if (i in self.out_feature_indices or i == len(self.features) - 1
+                    or (i in cp_layers) != (i + 1 in cp_layers)):
+                segments.append((start, i + 1, i in cp_layers))
+                start = i + 1
+        return segments
+
+    def _forward_layers(self, x, start, end):
+        for i in range(start, end):
+            x = self.features[i](x)
+        return x
 
     def init_weights(self, pretrained=None):
         if isinstance(pretrained, str):
@@ -83,9 +110,13 @@ class M2detVGG(VGG):
 
     def forward(self, x):
         outs = []
-        for i, layer in enumerate(self.features):
-            x = layer(x)
-            if i in self.out_feature_indices:
+        for start, end, with_cp in self.segments:
+            if with_cp and self.training and torch.is_grad_enabled():
+                x = cp.checkpoint(self._forward_layers, x, start, end, 
+                                  use_reentrant=False)
+            else:
+                x = self._forward_layers(x, start, end)
+            if end - 1 in self.out_feature_indices:
                 outs.append(x)
 #        for i, layer in enumerate(self.extra):
 #            x = F.relu(layer(x), inplace=True)
@@ -7,10 +7,15 @@ Created on Thu Mar 14 15:00:07 2019
 
 @author: ubuntu
 """
+import logging
+import random
+from contextlib import contextmanager, nullcontext
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 from .weight_init import kaiming_normal_init
+from .fuse_bn import fuse_conv_bn, fuse_module, bn_scale_shift, ChannelShift
 from utils.registry_build import registered
 
 
@@ -33,9 +38,33 @@ class BasicConv(nn.Module):
         if self.relu is not None:
             x = self.relu(x)
         return x
+    
+    def fuse(self):
+        """把bn折叠进conv(部署用)，之后forward只有conv+relu"""
+        if self.bn is not None:
+            self.conv = fuse_conv_bn(self.conv, self.bn)
+            self.bn = None
+        return self
+
+@contextmanager
+def frozen_bn_stats(module):
+    """临时把module内所有bn的momentum置0，使前向计算不更新running stats
+    (用于activation checkpoint的重算阶段，避免同一个batch被统计两次)
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d)]
+    momentums = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(bns, momentums):
+            bn.momentum = momentum
+
 
 class TUM(nn.Module):
-    def __init__(self, first_level=True, input_planes=128, is_smooth=True, side_channel=512, scales=6):
+    def __init__(self, first_level=True, input_planes=128, is_smooth=True, side_channel=512, scales=6,
+                 base_size=64):
         super(TUM, self).__init__()
         self.is_smooth = is_smooth
         self.side_channel = side_channel
@@ -44,6 +73,12 @@ class TUM(nn.Module):
         self.first_level = first_level
         self.scales = scales
         self.in1 = input_planes + side_channel if not first_level else input_planes
+        # 最后一层3x3 conv默认不加padding(尺寸减2, 比如512输入时4->2)，
+        # 输入尺寸较小时(比如256输入时该层输入为2)改为padding=1保持尺寸，避免特征图为0
+        last_size = base_size
+        for _ in range(self.scales - 2):
+            last_size = (last_size + 1) // 2
+        last_padding = 0 if last_size >= 3 else 1
 
         self.layers = nn.Sequential()
         self.layers.add_module('{}'.format(len(self.layers)), BasicConv(self.in1, self.planes, 3, 2, 1))
@@ -56,7 +91,7 @@ class TUM(nn.Module):
             else:
                 self.layers.add_module(
                         '{}'.format(len(self.layers)),
-                        BasicConv(self.planes, self.planes, 3, 1, 0)
+                        BasicConv(self.planes, self.planes, 3, 1, last_padding)
                         )
         self.toplayer = nn.Sequential(BasicConv(self.planes, self.planes, 1, 1, 0))
         
@@ -77,9 +112,9 @@ class TUM(nn.Module):
             self.smooth = nn.Sequential(*smooth)
 
     def _upsample_add(self, x, y, fuse_type='interp'):
-        _,_,H,W = y.size()
+        # 用y.shape而不是解包y.size()，使forward可以被torch.fx符号追踪(量化用)
         if fuse_type=='interp':
-            return F.interpolate(x, size=(H,W), mode='nearest') + y
+            return F.interpolate(x, size=y.shape[-2:], mode='nearest') + y
         else:
             raise NotImplementedError
             #return nn.ConvTranspose2d(16, 16, 3, stride=2, padding=1)
@@ -153,9 +188,12 @@ class MLFPN(nn.Module):
                  num_scales=6, 
                  side_channel=512,
                  sfam = False,
-                 compress_ratio=16):
+                 compress_ratio=16,
+                 leach_mode='shared',
+                 checkpoint_tums=False,
+                 level_dropout=0.):
         super().__init__()
-        # TODO: input_size似乎也没用，是否可去掉
+        # input_size用于确定tum最后一层的padding(base feature尺寸为input_size/8)
         # TODO: 去掉了phase参数，并在cfg中也去除，是否会影响？
 #        self.phase = phase  # train or test
         self.input_size = input_size    # input img size (512)
@@ -166,6 +204,11 @@ class MLFPN(nn.Module):
         self.side_channel = side_channel  # use to add to tum input layers
         self.sfam = sfam
         self.compress_ratio = compress_ratio
+        assert leach_mode in ('shared', 'per_level')
+        self.leach_mode = leach_mode  # shared: 所有tum共用一个leach(原版M2det做法), per_level: 每个tum独立leach
+        self.checkpoint_tums = checkpoint_tums  # 训练时tum不保存中间特征，反向时重算，用计算换显存
+        self.level_dropout = level_dropout  # 训练时以该概率随机只跑前k个tum，让head适应缺失的tum输出
+        self.num_active_levels = num_levels  # 测试时只跑前k个tum(anytime inference)
         
         # build FFM: 
         if backbone_type == 'M2detVGG':
@@ -180,10 +223,17 @@ class MLFPN(nn.Module):
         self.up_reduce= BasicConv(
             deep_in, deep_out, kernel_size=1, stride=1)
         
-        # build FFM2
-        self.leach = nn.ModuleList([
-            BasicConv(deep_out + shallow_out, self.planes//2, 
-                      kernel_size=(1,1),stride=(1,1))]*self.num_levels)
+        # build FFM2: shared模式下leach列表里是同一个module，state dict里依然保存成
+        # leach.0~leach.7，从而兼容原有checkpoint
+        if self.leach_mode == 'shared':
+            self.leach = nn.ModuleList([
+                BasicConv(deep_out + shallow_out, self.planes//2, 
+                          kernel_size=(1,1),stride=(1,1))]*self.num_levels)
+        else:
+            self.leach = nn.ModuleList([
+                BasicConv(deep_out + shallow_out, self.planes//2, 
+                          kernel_size=(1,1),stride=(1,1)) 
+                for _ in range(self.num_levels)])
         
         # build TUM
         tums = []
@@ -194,14 +244,16 @@ class MLFPN(nn.Module):
                             input_planes=self.planes//2,
                             is_smooth=self.smooth,
                             scales=self.num_scales,
-                            side_channel=512))
+                            side_channel=512,
+                            base_size=(self.input_size + 7) // 8))
             else:
                 tums.append(
                         TUM(first_level=False,
                             input_planes=self.planes//2,
                             is_smooth=self.smooth,
                             scales=self.num_scales,
-                            side_channel=self.planes))
+                            side_channel=self.planes,
+                            base_size=(self.input_size + 7) // 8))
         self.tums = nn.ModuleList(tums)
         
         # build sfam:
@@ -230,6 +282,124 @@ class MLFPN(nn.Module):
         self.up_reduce.apply(weights_init)
         self.leach.apply(weights_init)
         
+    def leach_forward(self, base_feature):
+        """计算每个tum的leach输入：共享同一个module的level只计算一次，复用结果
+        Args:
+            base_feature(tensor): (b,768,64,64)
+        Returns:
+            leach_feats(list): (num_levels,) with (b,planes//2,64,64)
+        """
+        cached = {}
+        leach_feats = []
+        for leach in self.leach:
+            if id(leach) not in cached:
+                cached[id(leach)] = leach(base_feature)
+            leach_feats.append(cached[id(leach)])
+        return leach_feats
+    
+    def tum_forward(self, i, x, y):
+        """第i个tum的前向计算：checkpoint_tums打开时只保存tum的输入，反向时重算tum内部特征
+        重算时冻结bn的running stats更新，保证bn统计量跟不做checkpoint时一致
+        """
+        tum = self.tums[i]
+        if self.checkpoint_tums and self.training and torch.is_grad_enabled():
+            return cp.checkpoint(tum, x, y, use_reentrant=False, 
+                                 context_fn=lambda: (nullcontext(), 
+                                                     frozen_bn_stats(tum)))
+        return tum(x, y)
+    
+    def set_active_levels(self, num_active_levels=None):
+        """设置测试时只运行前k个tum，缺失tum的输出通道用0填充，head结构不变
+        Args:
+            num_active_levels(int): 1~num_levels, None代表全部tum
+        """
+        if num_active_levels is None:
+            num_active_levels = self.num_levels
+        assert 1 <= num_active_levels <= self.num_levels
+        self.num_active_levels = num_active_levels
+        return self
+    
+    def get_active_levels(self):
+        """训练时按level_dropout随机采样k，测试时返回set_active_levels()设置的k"""
+        if not self.training:
+            return self.num_active_levels
+        if self.level_dropout > 0 and random.random() < self.level_dropout:
+            return random.randint(1, self.num_levels)
+        return self.num_levels
+    
+    def norm_forward(self, x, num_active_levels):
+        """对sources[0]做Norm: x只包含前k个tum的通道
+        缺失的tum输出视为0，对应Norm的输出为常数 bias - running_mean*weight/std；
+        前k个tum的通道只用自己的running stats切片做bn，训练时也只更新这部分统计量，
+        避免0填充的通道污染bn统计量
+        """
+        num_channels = self.planes * self.num_levels
+        if num_active_levels == self.num_levels:
+            return self.Norm(x)
+        if not isinstance(self.Norm, nn.BatchNorm2d):
+            # 部署模式下的ChannelShift是逐通道的，对0填充的输入同样精确
+            return self.Norm(torch.cat([x, x.new_zeros(
+                x.size(0), num_channels - x.size(1), *x.shape[2:])], 1))
+        norm = self.Norm
+        c = x.size(1)
+        active = F.batch_norm(x, norm.running_mean[:c], norm.running_var[:c],
+                              norm.weight[:c], norm.bias[:c], 
+                              self.training, norm.momentum, norm.eps)
+        missing = norm.bias[c:] - norm.running_mean[c:] * norm.weight[c:] / \
+            torch.sqrt(norm.running_var[c:] + norm.eps)
+        missing = missing.view(1, -1, 1, 1).expand(
+            x.size(0), -1, *x.shape[2:]).to(x.dtype)
+        return torch.cat([active, missing], 1)
+    
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """shared模式下加载per_level训练的checkpoint时，只有最后一个leach的参数会
+        生效，这里给出提示而不是静默加载
+        """
+        if self.leach_mode == 'shared':
+            key = prefix + 'leach.{}.conv.weight'
+            weights = [state_dict[key.format(i)] for i in range(self.num_levels)
+                       if key.format(i) in state_dict]
+            if any(not torch.equal(w, weights[0]) for w in weights[1:]):
+                logging.getLogger().warning(
+                    'leach weights in checkpoint differ between levels, '
+                    'use leach_mode=\'per_level\' to load them')
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+        
+    def fuse(self):
+        """部署模式：折叠所有BasicConv的bn，并尽量把最后的Norm也折叠掉
+        Norm作用在sources[0]上，而sources[0]的每256个通道来自对应tum的
+        smooth[-1](conv+relu)输出，由于relu(z)*s = relu(z*s) (s>0)，
+        Norm的scale可以折叠进该conv，只剩下逐通道的shift。
+        但该输出同时作为下一个tum的side输入，所以需要在下一个tum里消费它的
+        两个conv(layers[0]和latlayer[-1])的输入通道上再除以s，零填充下这是精确等价的。
+        sfam打开或者smooth关闭时无法折叠，保留Norm。
+        """
+        fuse_module(self)
+        if not isinstance(self.Norm, nn.BatchNorm2d):
+            return self
+        scale, shift = bn_scale_shift(self.Norm)
+        if self.sfam or not self.smooth or not (scale > 0).all():
+            return self
+        if any(tum.smooth[-1].conv.bias is None for tum in self.tums):
+            return self
+        planes = scale.numel() // self.num_levels
+        for i, tum in enumerate(self.tums):
+            conv = tum.smooth[-1].conv
+            s = scale[i * planes:(i + 1) * planes]
+            with torch.no_grad():
+                conv.weight.mul_(s.view(-1, 1, 1, 1))
+                conv.bias.mul_(s)
+                if i + 1 < self.num_levels:
+                    # 下一个tum的输入是cat([leach, side])，side通道在后面
+                    next_tum = self.tums[i + 1]
+                    for next_conv in (next_tum.layers[0].conv, 
+                                      next_tum.latlayer[-1].conv):
+                        next_conv.weight[:, -planes:].div_(s.view(1, -1, 1, 1))
+        self.Norm = ChannelShift(shift)
+        return self
+    
     def forward(self, x):
         """Returns the Multi layer output with same scales concated together. [2048] 
         Args:
@@ -240,19 +410,32 @@ class MLFPN(nn.Module):
         base_feature = torch.cat([x_shallow, 
             F.interpolate(x_deep, scale_factor=2, mode='nearest')], 1)  # (b,768,64,64)
         
-        tum_outs = [self.tums[0](self.leach[0](base_feature), 'none')]
-        for i in range(1, self.num_levels, 1):
-            tum_outs.append(self.tums[i](self.leach[i](base_feature), tum_outs[i-1][-1]))
+        # 只运行前k个tum, 后面的tum依赖前一个tum的输出, 所以截断在任何位置都成立
+        num_active = self.get_active_levels()
+        leach_feats = self.leach_forward(base_feature)
+        tum_outs = [self.tum_forward(0, leach_feats[0], 'none')]
+        for i in range(1, num_active, 1):
+            tum_outs.append(self.tum_forward(i, leach_feats[i], tum_outs[i-1][-1]))
         
         # concate same scale outputs together: tum_outs (8,) -> sources (6,)
         sources = []
         for i in range(self.num_scales, 0, -1):
             sources.append(torch.cat([tum_out[i-1] for tum_out in tum_outs], 1))
         
+        # 缺失tum的通道用0填充, sources[0]在norm_forward()中单独处理
+        # (sfam需要完整通道，做完attention后再切回前k个tum的通道, 0通道乘attention依然为0)
+        if num_active < self.num_levels:
+            num_channels = self.planes * self.num_levels
+            for i in range(0 if self.sfam else 1, len(sources)):
+                src = sources[i]
+                sources[i] = torch.cat([src, src.new_zeros(
+                    src.size(0), num_channels - src.size(1), *src.shape[2:])], 1)
+        
         if self.sfam:
             sources = self.sfam_module(sources)
+            sources[0] = sources[0][:, :self.planes * num_active]
         
-        sources[0] = self.Norm(sources[0])
+        sources[0] = self.norm_forward(sources[0], num_active)
         
         return sources
     
\ No newline at end of file
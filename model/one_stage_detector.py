@@ -5,15 +5,39 @@ Created on Tue Mar  5 16:05:16 2019
 
 @author: ubuntu
 """
+import copy
 import logging
+import torch
 import torch.nn as nn
 import numpy as np
 import pycocotools.mask as maskUtils
 import mmcv
 
 from dataset.utils import tensor2imgs
+from model.fuse_bn import fuse_module
 from dataset.class_names import get_classes
 from utils.registry_build import registered, build_module
+from utils.detections import Detections, bbox2result, as_result_list
+
+
+def infer_featmap_sizes(modules, input_size):
+    """在meta device上做一次只推导shape的前向(不分配内存也不做计算)，得到head输入特征图尺寸
+    Args:
+        modules(list): [backbone, neck], 依次前向
+        input_size(int): 输入图片尺寸
+    Returns:
+        featmap_sizes(list): [(h,w), ...]
+    """
+    net = nn.Sequential(*modules)
+    # deepcopy时把参数/buffer直接映射成meta tensor，不复制权重；leach共享的module仍然共享
+    memo = {id(t): torch.empty_like(t, device='meta')
+            for t in list(net.parameters()) + list(net.buffers())}
+    meta_net = copy.deepcopy(net, memo).eval()
+    img = torch.empty(1, 3, input_size, input_size, device='meta')
+    with torch.no_grad():
+        outs = meta_net(img)
+    return [tuple(out.shape[-2:]) for out in outs]
+
 
 @registered.register_module
 class OneStageDetector(nn.Module):
@@ -26,9 +50,16 @@ class OneStageDetector(nn.Module):
         self.cfg = cfg
         
         self.backbone = build_module(cfg.model.backbone, registered)
-        self.bbox_head = build_module(cfg.model.bbox_head, registered)
         if cfg.model.neck is not None:
             self.neck = build_module(cfg.model.neck, registered)
+        # 支持任意输入尺寸: head的size_featmaps为None时通过backbone/neck推导
+        if 'size_featmaps' in cfg.model.bbox_head and cfg.model.bbox_head.size_featmaps is None:
+            modules = [self.backbone]
+            if cfg.model.neck is not None:
+                modules.append(self.neck)
+            cfg.model.bbox_head.size_featmaps = infer_featmap_sizes(
+                modules, cfg.model.bbox_head.input_size)
+        self.bbox_head = build_module(cfg.model.bbox_head, registered)
 
         self.train_cfg = cfg.train_cfg
         self.test_cfg = cfg.test_cfg
@@ -42,23 +73,57 @@ class OneStageDetector(nn.Module):
         self.backbone.init_weights(pretrained=pretrained)
         self.bbox_head.init_weights()
 
+    def fuse_for_inference(self):
+        """部署用：把backbone/neck中的bn折叠进前面的conv并去掉bn，返回数值等价的
+        eval模式模型(in place修改)，之后不应再用于训练
+        """
+        self.eval()
+        fuse_module(self.backbone)
+        if self.cfg.model.neck is not None:
+            if hasattr(self.neck, 'fuse'):
+                self.neck.fuse()
+            else:
+                fuse_module(self.neck)
+        return self
+
+    def restrict_classes(self, classes, dataset='coco'):
+        """部署用：只检测部分类别(比如['person', 'car'])，head的cls conv只保留这些类别的输出，
+        输出结果的类别序号不变. 需要在加载权重之后调用，之后不应再用于训练
+        Args:
+            classes(list): 类别名或类别序号(1~num_classes-1)
+            dataset(str or list): 数据集名称或类别名list, 用于把类别名转换成序号
+        """
+        class_names = get_classes(dataset) if isinstance(dataset, str) else list(dataset)
+        class_inds = [c if isinstance(c, int) else class_names.index(c) + 1 for c in classes]
+        self.bbox_head.restrict_classes(class_inds)
+        return self
+
     def extract_feat(self, img):
         x = self.backbone(img)
         if self.cfg.model.neck is not None:
             x = self.neck(x)
         return x
 
-    def forward_train(self, img, img_metas, gt_bboxes, gt_labels):
+    def forward_train(self, img, img_metas, gt_bboxes, gt_labels, anchor_labels=None,
+                      anchor_label_weights=None, anchor_bbox_targets=None,
+                      anchor_bbox_weights=None):
+        """anchor_*为dataset中算好的anchor target(precompute_targets=True), 否则在loss中计算"""
         x = self.extract_feat(img)
         outs = self.bbox_head(x)
         loss_inputs = outs + (gt_bboxes, gt_labels, img_metas, self.train_cfg)
-        losses = self.bbox_head.loss(*loss_inputs)
+        if anchor_labels is not None:
+            losses = self.bbox_head.loss(*loss_inputs, anchor_targets=(
+                anchor_labels, anchor_label_weights, anchor_bbox_targets, anchor_bbox_weights))
+        else:
+            losses = self.bbox_head.loss(*loss_inputs)
         return losses
     
     def forward_test(self, imgs, img_metas, **kwargs):
-        """用于测试时的前向计算：如果是单张图则跳转到simple_test(), 
-        如果是多张图则跳转到aug_test()，但ssd当前不支持多图测试(aug_test未实施)
-        即在验证时每个gpu只能放1张图片
+        """用于测试时的前向计算：如果是单种尺度则跳转到simple_test(), 
+        如果是多种尺度(test time augmentation)则跳转到aug_test()，但ssd当前不支持(aug_test未实施)
+        每个gpu可以放多张图片(imgs_per_gpu>1)，整个batch一起前向和后处理
+        Returns:
+            results(list): (imgs_per_gpu,) 每个元素为一张图的结果[class1, class2, ...]
         """
         for var, name in [(imgs, 'imgs'), (img_metas, 'img_metas')]:
             if not isinstance(var, list):
@@ -70,9 +135,11 @@ class OneStageDetector(nn.Module):
             raise ValueError(
                 'num of augmentations ({}) != num of image meta ({})'.format(
                     len(imgs), len(img_metas)))
-        # TODO: remove the restriction of imgs_per_gpu == 1 when prepared
         imgs_per_gpu = imgs[0].size(0)
-        assert imgs_per_gpu == 1
+        if imgs_per_gpu != len(img_metas[0]):
+            raise ValueError(
+                'num of imgs ({}) != num of image meta ({})'.format(
+                    imgs_per_gpu, len(img_metas[0])))
 
         if num_augs == 1:
             return self.simple_test(imgs[0], img_metas[0], **kwargs)
@@ -85,19 +152,28 @@ class OneStageDetector(nn.Module):
         else:
             return self.forward_test(img, img_meta, **kwargs)  
     
-    def simple_test(self, img, img_meta, rescale=False):
-        """用于测试时单图前向计算：
-        输出
+    def simple_test(self, img, img_meta, rescale=False, compact=False):
+        """用于测试时的batch前向计算:
+        Args:
+            img(tensor): (b,3,h,w)
+            img_meta(list): (b,) with dict
+            compact(bool): True时每张图输出一个Detections, 否则为按类别的list
+        Returns:
+            bbox_results(list): (b,) with [class1, class2, ...], 每个class为(n,5)的array,
+                compact=True时为(b,) with Detections
         """
         x = self.extract_feat(img)
         outs = self.bbox_head(x)
         bbox_inputs = outs + (img_meta, self.test_cfg, rescale)
         bbox_list = self.bbox_head.get_bboxes(*bbox_inputs)
+        if compact:
+            return [Detections.from_tensors(det_bboxes, det_labels, self.bbox_head.num_classes)
+                    for det_bboxes, det_labels in bbox_list]
         bbox_results = [
             self.bbox2result(det_bboxes, det_labels, self.bbox_head.num_classes)
             for det_bboxes, det_labels in bbox_list
         ]
-        return bbox_results[0]
+        return bbox_results
     
     def aug_test(self, imgs, img_metas, rescale=False):
         """用于测试时多图前向计算: 当前ssd不支持多图测试"""
@@ -106,15 +182,16 @@ class OneStageDetector(nn.Module):
     def show_result(self, data, result, img_norm_cfg,
                     dataset='coco',
                     score_thr=0.3):
-        if isinstance(result, tuple):
-            bbox_result, segm_result = result
-        else:
-            bbox_result, segm_result = result, None
-
+        """显示一个batch的检测结果
+        Args:
+            data(dict): dataloader输出的一个batch
+            result(list): simple_test()/forward_test()的输出, (b,) 每张图一个结果: 按类别的list
+                或Detections(compact=True), 有mask时为(bbox_result, segm_result)
+        """
         img_tensor = data['img'][0]
         img_metas = data['img_meta'][0].data[0]
         imgs = tensor2imgs(img_tensor, **img_norm_cfg)
-        assert len(imgs) == len(img_metas)
+        assert len(imgs) == len(img_metas) == len(result)
 
         if isinstance(dataset, str):
             class_names = get_classes(dataset)
@@ -125,7 +202,13 @@ class OneStageDetector(nn.Module):
                 'dataset must be a valid dataset name or a sequence'
                 ' of class names, not {}'.format(type(dataset)))
 
-        for img, img_meta in zip(imgs, img_metas):
+        for img, img_meta, img_result in zip(imgs, img_metas, result):
+            if isinstance(img_result, tuple):
+                bbox_result, segm_result = img_result
+            else:
+                bbox_result, segm_result = img_result, None
+            bbox_result = as_result_list(bbox_result)
+
             h, w, _ = img_meta['img_shape']
             img_show = img[:h, :w, :]
 
@@ -163,11 +246,4 @@ class OneStageDetector(nn.Module):
         Returns:
             list(ndarray): bbox results of each class
         """
-        if bboxes.shape[0] == 0:
-            return [
-                np.zeros((0, 5), dtype=np.float32) for i in range(num_classes - 1)
-            ]
-        else:
-            bboxes = bboxes.cpu().numpy()
-            labels = labels.cpu().numpy()
-            return [bboxes[labels == i, :] for i in range(num_classes - 1)]
\ No newline at end of file
+        return bbox2result(bboxes, labels, num_classes)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ONNX导出与onnxruntime cpu推理:
+1. export_onnx(): 导出backbone->MLFPN->head的conv部分(M2detFeatureNet)，batch维度为动态，
+   head参数/test_cfg/类别名保存在onnx的metadata中
+2. OnnxM2detRunner: 只依赖onnxruntime+torch, 网络部分由onnxruntime运行，
+   后处理沿用model.m2det_head.get_bboxes_from_scores，不需要mmcv/mmdet
+"""
+import json
+import numpy as np
+import torch
+
+from utils.anchor_generator import m2det_anchor_generators, grid_anchors_flat
+from utils.bbox_reg import bbox2ctr_wh
+from model.inference_wrapper import M2detFeatureNet
+
+
+def export_onnx(detector, out_file, class_names=None, opset_version=11):
+    """导出onnx文件
+    Args:
+        detector(nn.Module): M2detDetector(可以先deploy()折叠bn)
+        out_file(str): .onnx file
+        class_names(list): 类别名，保存到metadata
+    """
+    import onnx
+    detector.eval()
+    head = detector.bbox_head
+    input_size = detector.cfg.input_size
+    feature_net = M2detFeatureNet(detector).eval()
+    device = next(detector.parameters()).device
+    dummy = torch.zeros(1, 3, input_size, input_size, device=device)
+    with torch.no_grad():
+        torch.onnx.export(feature_net, dummy, out_file,
+                          input_names=['img'],
+                          output_names=['cls_scores', 'bbox_preds'],
+                          dynamic_axes={'img': {0: 'batch'},
+                                        'cls_scores': {0: 'batch'},
+                                        'bbox_preds': {0: 'batch'}},
+                          opset_version=opset_version,
+                          dynamo=False)
+    # 保存后处理需要的信息
+    meta = dict(input_size=input_size,
+                num_classes=head.num_classes,
+                anchor_strides=list(head.anchor_strides),
+                size_pattern=list(head.size_pattern),
+                featmap_sizes=[list(s) for s in head.featmap_sizes],
+                anchor_ratio_range=[list(r) for r in head.anchor_ratios],
+                target_means=list(head.target_means),
+                target_stds=list(head.target_stds),
+                test_cfg=dict(detector.test_cfg),
+                class_inds=head.class_inds,
+                class_names=list(class_names) if class_names is not None else None)
+    model = onnx.load(out_file)
+    prop = model.metadata_props.add()
+    prop.key = 'm2det'
+    prop.value = json.dumps(meta)
+    onnx.save(model, out_file)
+    return out_file
+
+
+class OnnxM2detRunner(object):
+    """onnxruntime推理: 输入归一化之后的img和img_metas，输出跟M2detHead.get_bboxes()相同格式
+    Args:
+        onnx_file(str): export_onnx()导出的文件
+        num_threads(int): onnxruntime的intra op线程数, None代表默认
+    """
+    def __init__(self, onnx_file, num_threads=None):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_file, opts,
+                                            providers=['CPUExecutionProvider'])
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map['m2det'])
+        self.meta = meta
+        self.input_size = meta['input_size']
+        self.num_classes = meta['num_classes']
+        self.class_names = meta['class_names']
+        self.target_means = meta['target_means']
+        self.target_stds = meta['target_stds']
+        self.test_cfg = meta['test_cfg']
+        # restrict_classes()选中的类别, 输出的labels映射回原来的类别序号
+        self.class_inds = meta.get('class_inds')
+        anchor_generators = m2det_anchor_generators(
+            self.input_size, meta['anchor_strides'], meta['size_pattern'],
+            meta['anchor_ratio_range'])
+        self.anchors = grid_anchors_flat(anchor_generators, meta['featmap_sizes'],
+                                         meta['anchor_strides'], device='cpu')
+        self.anchors_cwh = bbox2ctr_wh(self.anchors)
+
+    def run_network(self, img):
+        """
+        Args:
+            img(tensor or ndarray): (b,3,h,w)
+        Returns:
+            cls_scores(ndarray): (b, num_anchors, num_classes)
+            bbox_preds(ndarray): (b, num_anchors, 4)
+        """
+        if isinstance(img, torch.Tensor):
+            img = img.detach().cpu().numpy()
+        cls_scores, bbox_preds = self.session.run(
+            None, {'img': np.ascontiguousarray(img, dtype=np.float32)})
+        return cls_scores, bbox_preds
+
+    def postprocess(self, cls_scores, bbox_preds, img_metas, rescale=False):
+        """跟M2detHead.get_bboxes_single()一致的后处理
+        Returns:
+            result_list(list): (b,) with (det_bboxes(k,5), det_labels(k,))
+        """
+        from model.m2det_head import get_bboxes_from_scores
+        result_list = []
+        for img_id, img_meta in enumerate(img_metas):
+            result_list.append(get_bboxes_from_scores(
+                torch.as_tensor(cls_scores[img_id]).softmax(-1),
+                torch.as_tensor(bbox_preds[img_id]), self.anchors_cwh, img_meta['img_shape'],
+                img_meta['scale_factor'], self.test_cfg, self.target_means, self.target_stds,
+                rescale))
+        if self.class_inds is not None:
+            label_map = torch.tensor(self.class_inds) - 1
+            result_list = [(dets, label_map[labels]) for dets, labels in result_list]
+        return result_list
+
+    def __call__(self, img, img_metas, rescale=False):
+        cls_scores, bbox_preds = self.run_network(img)
+        return self.postprocess(cls_scores, bbox_preds, img_metas, rescale)
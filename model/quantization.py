@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cpu上的int8训练后量化(post training static quantization):
+1. 用torch.fx追踪M2detFeatureNet(backbone->MLFPN->head conv)，prepare时自动把BasicConv的
+   conv+bn+relu以及vgg的conv+relu融合，并插入observer
+2. 用若干张测试图片做校准，统计每层激活的量化参数
+3. 转换成int8 conv/relu，l2norm等不支持量化的op自动保留fp32
+量化后的模型通过model.inference_wrapper导出成TorchScript，load_torchscript()直接加载
+"""
+import copy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from model.inference_wrapper import M2detFeatureNet, export_torchscript
+
+
+def quantize_feature_net(detector, calib_imgs, backend='x86'):
+    """训练后静态量化
+    Args:
+        detector(nn.Module): fp32的M2detDetector
+        calib_imgs(iterable): 校准用的img, 每个为(b,3,h,w)的tensor
+        backend(str): 'x86'/'fbgemm'用于x86服务器, 'qnnpack'用于arm
+    Returns:
+        qnet(GraphModule): cpu上的int8 feature net, 输出同M2detFeatureNet
+    """
+    torch.backends.quantized.engine = backend
+    detector.eval()
+    feature_net = copy.deepcopy(M2detFeatureNet(detector)).cpu().eval()
+    input_size = detector.cfg.input_size
+    example = torch.zeros(1, 3, input_size, input_size)
+    prepared = prepare_fx(feature_net, get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        for img in calib_imgs:
+            prepared(img.cpu())
+    return convert_fx(prepared)
+
+
+def coco_calib_imgs(dataset, num_imgs, start=0):
+    """从test模式的CocoDataset中取num_imgs张图片用于校准
+    Returns:
+        imgs(generator): (1,3,h,w) tensors
+    """
+    for idx in range(start, min(start + num_imgs, len(dataset))):
+        data = dataset[idx]
+        yield data['img'][0][None]
+
+
+def export_quantized(detector, calib_imgs, out_file, class_names=None, backend='x86'):
+    """量化并导出TorchScript文件(同export_torchscript的格式)，用load_torchscript()加载
+    Returns:
+        wrapper(ScriptModule): int8的完整推理模块
+    """
+    qnet = quantize_feature_net(detector, calib_imgs, backend=backend)
+    return export_torchscript(detector, out_file, class_names=class_names,
+                              feature_net=qnet, extra_meta=dict(quant_backend=backend))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查activation checkpoint打开前后梯度一致，同时保存给反向的激活显著减少
+"""
+import copy
+import torch
+
+from model.mlfpn import MLFPN
+from model.m2detvgg import M2detVGG
+
+
+class SavedTensorCounter(object):
+    """统计前向过程中为反向保存的tensor字节数(cpu上近似代替峰值显存)"""
+    def __init__(self):
+        self.nbytes = 0
+
+    def pack(self, tensor):
+        self.nbytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+
+def run_backward(model, inputs, weights):
+    counter = SavedTensorCounter()
+    with torch.autograd.graph.saved_tensors_hooks(counter.pack, counter.unpack):
+        outs = model(inputs)
+    loss = sum((out * w).sum() for out, w in zip(outs, weights))
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters()
+             if p.grad is not None}
+    return grads, counter.nbytes
+
+
+def check_same_grads(grads, grads_cp):
+    assert grads.keys() == grads_cp.keys()
+    for name in grads:
+        assert torch.allclose(grads[name], grads_cp[name], rtol=1e-4, atol=1e-5), name
+
+
+def test_checkpoint_tums():
+    torch.manual_seed(0)
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256,
+                  num_levels=2)
+    mlfpn.init_weights()
+    mlfpn_cp = copy.deepcopy(mlfpn)
+    mlfpn_cp.checkpoint_tums = True
+    mlfpn.train()
+    mlfpn_cp.train()
+
+    feats = [torch.randn(2,512,64,64), torch.randn(2,1024,32,32)]
+    weights = [torch.randn(2, 512, s, s) for s in (64, 32, 16, 8, 4, 2)]
+    grads, nbytes = run_backward(mlfpn, feats, weights)
+    grads_cp, nbytes_cp = run_backward(mlfpn_cp, feats, weights)
+
+    check_same_grads(grads, grads_cp)
+    # 重算时不应再次更新bn的running stats
+    for (name, buf), buf_cp in zip(mlfpn.named_buffers(), mlfpn_cp.buffers()):
+        if 'running' in name:
+            assert torch.allclose(buf, buf_cp), name
+    assert nbytes_cp < nbytes / 2, 'saved activations: {:.1f}MB -> {:.1f}MB'.format(
+        nbytes / 1024**2, nbytes_cp / 1024**2)
+
+
+def test_checkpoint_backbone_stages():
+    torch.manual_seed(0)
+    cfg = dict(input_size=512, depth=16, with_last_pool=False, ceil_mode=True,
+               out_indices=(3, 4), out_feature_indices=(22, 34),
+               l2_norm_scale=20.)
+    vgg = M2detVGG(**cfg)
+    vgg.init_weights()
+    vgg_cp = M2detVGG(checkpoint_backbone_stages=(0, 1, 2, 3, 4), **cfg)
+    vgg_cp.load_state_dict(vgg.state_dict())
+    vgg.train()
+    vgg_cp.train()
+
+    img = torch.randn(1, 3, 64, 64)
+    weights = [torch.randn(1, 512, 8, 8), torch.randn(1, 1024, 4, 4)]
+    grads, nbytes = run_backward(vgg, img, weights)
+    grads_cp, nbytes_cp = run_backward(vgg_cp, img, weights)
+
+    check_same_grads(grads, grads_cp)
+    assert nbytes_cp < nbytes / 2
+
+
+if __name__ == '__main__':
+    test_checkpoint_tums()
+    test_checkpoint_backbone_stages()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查BatchedMaxIoUAssigner/anchor_target_batched跟逐张图的MaxIoUAssigner/anchor_target_single一致
+"""
+import torch
+from addict import Dict
+
+from utils.anchor_generator import m2det_anchor_generators, grid_anchors_flat
+from utils.anchor_target import (MaxIoUAssigner, BatchedMaxIoUAssigner, GridMaxIoUAssigner,
+                                 anchor_target_single, anchor_target_batched, pad_gt_list)
+
+STRIDES = [8, 16, 32, 64, 107, 320]
+FEATMAP_SIZES = [(40, 40), (20, 20), (10, 10), (5, 5), (3, 3), (1, 1)]
+
+
+def m2det_generators(input_size=320):
+    return m2det_anchor_generators(input_size, STRIDES, [0.06, 0.15, 0.33, 0.51, 0.69, 0.87, 1.05],
+                                   [[2, 3]] * 6)
+
+
+def m2det_anchors(input_size=320):
+    return grid_anchors_flat(m2det_generators(input_size), FEATMAP_SIZES, STRIDES)
+
+
+def random_gts(anchors, num_gts_list, seed=0):
+    """随机gt, 一部分直接取anchor(制造多个anchor iou相同、多个gt选中同一个anchor的情况)"""
+    g = torch.Generator().manual_seed(seed)
+    gt_bboxes_list, gt_labels_list = [], []
+    for num_gts in num_gts_list:
+        xy = torch.rand(num_gts, 2, generator=g) * 250
+        gts = torch.cat([xy, xy + torch.rand(num_gts, 2, generator=g) * 150 + 4], 1)
+        copy = torch.rand(num_gts, generator=g) < 0.3
+        gts[copy] = anchors[torch.randint(0, anchors.size(0), (int(copy.sum()), ),
+                                          generator=g)]
+        if num_gts > 2:
+            gts[-1] = gts[0]  # 重复的gt
+        gt_bboxes_list.append(gts)
+        gt_labels_list.append(torch.randint(1, 81, (num_gts, ), generator=g))
+    return gt_bboxes_list, gt_labels_list
+
+
+def test_batched_assigner():
+    anchors = m2det_anchors()
+    gt_bboxes_list, gt_labels_list = random_gts(anchors, [1, 7, 30, 3])
+    gt_bboxes, gt_labels, gt_valid = pad_gt_list(gt_bboxes_list, gt_labels_list)
+    assert gt_bboxes.shape == (4, 30, 4) and gt_valid.sum(1).tolist() == [1, 7, 30, 3]
+    bbox_valid = torch.rand(4, anchors.size(0), generator=torch.Generator().manual_seed(1)) > 0.1
+    for gt_max_assign_all in (True, False):
+        for min_pos_iou in (0., 0.3):
+            args = dict(pos_iou_thr=0.5, neg_iou_thr=0.4, min_pos_iou=min_pos_iou,
+                        gt_max_assign_all=gt_max_assign_all)
+            result = BatchedMaxIoUAssigner(**args).assign(anchors, gt_bboxes, gt_valid,
+                                                          gt_labels, bbox_valid)
+            assert result.gt_inds.shape == (4, anchors.size(0))
+            for i in range(4):
+                ref = MaxIoUAssigner(**args).assign(anchors[bbox_valid[i]], gt_bboxes_list[i],
+                                                    None, gt_labels_list[i])
+                assert torch.equal(result.gt_inds[i][bbox_valid[i]], ref.gt_inds)
+                assert torch.equal(result.labels[i][bbox_valid[i]], ref.labels)
+                assert torch.equal(result.max_overlaps[i][bbox_valid[i]], ref.max_overlaps)
+                assert (result.gt_inds[i][~bbox_valid[i]] == -1).all()
+
+
+def test_chunked_assigner():
+    """按anchor分块计算iou跟一次计算的结果完全一致"""
+    anchors = m2det_anchors()
+    gt_bboxes_list, gt_labels_list = random_gts(anchors, [40, 3], seed=3)
+    # 跟所有anchor都不重叠的gt: max iou为0，所有anchor都是它的max
+    gt_bboxes_list[1][1] = torch.tensor([1000., 1000., 1010., 1010.])
+    gt_bboxes, gt_labels, gt_valid = pad_gt_list(gt_bboxes_list, gt_labels_list)
+    for gt_max_assign_all in (True, False):
+        args = dict(pos_iou_thr=0.5, neg_iou_thr=(0.1, 0.4), min_pos_iou=0.,
+                    gt_max_assign_all=gt_max_assign_all)
+        refs = [MaxIoUAssigner(**args).assign(anchors, gt_bboxes_list[i], None,
+                                              gt_labels_list[i]) for i in range(2)]
+        for chunk_size in (97, 333, 4096, 100000):
+            batched = BatchedMaxIoUAssigner(chunk_size=chunk_size, **args).assign(
+                anchors, gt_bboxes, gt_valid, gt_labels)
+            for i, ref in enumerate(refs):
+                result = MaxIoUAssigner(chunk_size=chunk_size, **args).assign(
+                    anchors, gt_bboxes_list[i], None, gt_labels_list[i])
+                assert torch.equal(result.gt_inds, ref.gt_inds)
+                assert torch.equal(result.labels, ref.labels)
+                assert torch.equal(result.max_overlaps, ref.max_overlaps)
+                assert torch.equal(batched.gt_inds[i], ref.gt_inds)
+                assert torch.equal(batched.labels[i], ref.labels)
+
+
+def test_grid_assigner():
+    """按网格剪枝的分配结果跟MaxIoUAssigner完全一致"""
+    anchors = m2det_anchors()
+    gt_bboxes_list, gt_labels_list = random_gts(anchors, [60, 5], seed=4)
+    # 很小的gt(候选anchor的iou都很低，需要跟所有anchor计算)、很长的gt、超出图片的gt
+    gt_bboxes_list[1][1] = torch.tensor([100., 100., 103., 102.])
+    gt_bboxes_list[1][2] = torch.tensor([0., 150., 319., 160.])
+    gt_bboxes_list[1][3] = torch.tensor([300., 300., 400., 420.])
+    bbox_valid = torch.rand(anchors.size(0), generator=torch.Generator().manual_seed(5)) > 0.1
+    for neg_iou_thr in (0.4, (0.1, 0.4), (0., 0.5)):
+        for gt_max_assign_all in (True, False):
+            args = dict(pos_iou_thr=0.5, neg_iou_thr=neg_iou_thr, min_pos_iou=0.,
+                        gt_max_assign_all=gt_max_assign_all)
+            assigner = GridMaxIoUAssigner(m2det_generators(), FEATMAP_SIZES, STRIDES, **args)
+            for gt_bboxes, gt_labels in zip(gt_bboxes_list, gt_labels_list):
+                ref = MaxIoUAssigner(**args).assign(anchors[bbox_valid], gt_bboxes, None,
+                                                    gt_labels)
+                result = assigner.assign(anchors, gt_bboxes, None, gt_labels, bbox_valid)
+                assert torch.equal(result.gt_inds[bbox_valid], ref.gt_inds)
+                assert torch.equal(result.labels[bbox_valid], ref.labels)
+                assert (result.gt_inds[~bbox_valid] == -1).all()
+                # 正样本的max_overlaps是准确的
+                pos = ref.gt_inds > 0
+                assert torch.equal(result.max_overlaps[bbox_valid][pos], ref.max_overlaps[pos])
+
+
+def test_anchor_target_batched():
+    anchors = m2det_anchors()
+    gt_bboxes_list, gt_labels_list = random_gts(anchors, [5, 12], seed=2)
+    gt_bboxes, gt_labels, gt_valid = pad_gt_list(gt_bboxes_list, gt_labels_list)
+    img_metas = [dict(img_shape=(320, 320, 3)), dict(img_shape=(240, 320, 3))]
+    valid_flag_list = [torch.ones(anchors.size(0), dtype=torch.bool)] * 2
+    cfg = Dict(assigner=dict(type='BatchedMaxIoUAssigner', pos_iou_thr=0.5, neg_iou_thr=0.5,
+                             min_pos_iou=0., ignore_iof_thr=-1, gt_max_assign_all=False),
+               allowed_border=0, pos_weight=-1)
+    targets = anchor_target_batched(anchors, valid_flag_list, gt_bboxes, gt_valid, img_metas,
+                                    [0.] * 4, [0.1, 0.1, 0.2, 0.2], cfg, gt_labels=gt_labels)
+    num_pos = 0
+    for i in range(2):
+        ref = anchor_target_single(anchors, valid_flag_list[i], gt_bboxes_list[i],
+                                   gt_labels_list[i], img_metas[i], [0.] * 4,
+                                   [0.1, 0.1, 0.2, 0.2], cfg, sampling=False)
+        for t, r in zip(targets[:4], ref[:4]):
+            assert torch.equal(t[i], r)
+        num_pos += ref[4].numel()
+    assert targets[4] == num_pos
+
+
+if __name__ == '__main__':
+    test_batched_assigner()
+    test_chunked_assigner()
+    test_grid_assigner()
+    test_anchor_target_batched()
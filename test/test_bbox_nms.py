@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查batched multiclass_nms跟逐类别nms的输出一致，多线程的nms_multi跟逐类别nms一致
+"""
+import pytest
+import torch
+
+from utils.bbox_nms import multiclass_nms, multiclass_nms_per_class
+from utils.nms import nms_wrapper
+
+
+def random_dets(num_bboxes=3000, num_classes=11, seed=0):
+    """围绕若干个中心生成互相重叠的bbox, scores (n, num_classes)包含背景"""
+    g = torch.Generator().manual_seed(seed)
+    ctr = torch.rand(30, 2, generator=g) * 500
+    ctr = ctr[torch.randint(0, 30, (num_bboxes, ), generator=g)]
+    ctr = ctr + torch.randn(num_bboxes, 2, generator=g) * 8
+    wh = torch.rand(num_bboxes, 2, generator=g) * 80 + 10
+    bboxes = torch.cat([ctr - wh / 2, ctr + wh / 2], 1)
+    scores = (torch.randn(num_bboxes, num_classes, generator=g) * 2).softmax(-1)
+    return bboxes, scores
+
+
+def test_batched_multiclass_nms():
+    bboxes, scores = random_dets()
+    nms_cfgs = [dict(type='nms', iou_thr=0.45),
+                dict(type='nms', iou_thr=0.45, split_thr=100),
+                dict(type='nms', iou_thr=0.45, num_threads=4),
+                dict(type='grid_nms', iou_thr=0.45),
+                dict(type='torch_nms', iou_thr=0.45),
+                dict(type='soft_nms', iou_thr=0.3, min_score=0.05)]
+    for nms_cfg in nms_cfgs:
+        for max_num in (-1, 100):
+            dets, labels = multiclass_nms(bboxes, scores, 0.1, nms_cfg, max_num)
+            ref_cfg = {k: v for k, v in nms_cfg.items() if k not in ('split_thr', 'num_threads')}
+            ref_dets, ref_labels = multiclass_nms_per_class(bboxes, scores, 0.1, ref_cfg, max_num)
+            assert dets.shape[0] > 0
+            assert torch.equal(labels, ref_labels)
+            assert torch.allclose(dets, ref_dets)
+
+    # 每个类别单独回归的bbox: (n, num_classes*4)
+    cls_bboxes = bboxes.repeat(1, 11) + torch.rand(bboxes.shape[0], 44) * 4
+    dets, labels = multiclass_nms(cls_bboxes, scores, 0.1, dict(type='nms', iou_thr=0.45), 100)
+    ref_dets, ref_labels = multiclass_nms_per_class(cls_bboxes, scores, 0.1,
+                                                    dict(type='nms', iou_thr=0.45), 100)
+    assert torch.equal(labels, ref_labels)
+    assert torch.allclose(dets, ref_dets)
+
+    dets, labels = multiclass_nms(bboxes, scores, 1., dict(type='nms', iou_thr=0.45), 100)
+    assert dets.shape == (0, 5) and labels.shape == (0, )
+
+
+def test_batched_nms_grid(monkeypatch):
+    """框数超过split_thr时所有类别仍然只调用一次nms(网格索引的cpu_grid_nms)"""
+    calls = []
+    real_grid_nms = nms_wrapper.cpu_grid_nms
+
+    def grid_nms(dets, thresh, cell_size=0):
+        calls.append(dets.shape[0])
+        if real_grid_nms is None:
+            return nms_wrapper.torch_nms(dets, thresh)[1].tolist()
+        return real_grid_nms(dets, thresh, cell_size=cell_size)
+
+    monkeypatch.setattr(nms_wrapper, 'cpu_grid_nms', grid_nms)
+    bboxes, scores = random_dets()
+    nms_cfg = dict(type='nms', iou_thr=0.45, split_thr=100)
+    dets, labels = multiclass_nms(bboxes, scores, 0.1, nms_cfg, 100)
+    ref_dets, ref_labels = multiclass_nms_per_class(bboxes, scores, 0.1,
+                                                    dict(type='nms', iou_thr=0.45), 100)
+    assert calls == [int((scores[:, 1:] > 0.1).sum())]
+    assert torch.equal(labels, ref_labels)
+    assert torch.allclose(dets, ref_dets)
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+def test_nms_multi(compiled, monkeypatch):
+    if not compiled:
+        # 没有编译的cpu_nms_multi时退回到线程池执行torch_nms
+        monkeypatch.setattr(nms_wrapper, 'cpu_nms_multi', None)
+    elif nms_wrapper.cpu_nms_multi is None:
+        pytest.skip('cpu_nms_multi is not built')
+    bboxes, scores = random_dets(2000, num_classes=9)
+    dets_list = [torch.cat([bboxes, scores[:, i:i + 1]], 1) for i in range(1, 9)]
+    dets_list.append(dets_list[0][:0])
+    for num_threads in (1, 3):
+        keeps = nms_wrapper.nms_multi(dets_list, 0.45, num_threads=num_threads)
+        assert len(keeps) == len(dets_list)
+        for dets, keep in zip(dets_list, keeps):
+            assert torch.equal(keep, nms_wrapper.torch_nms(dets, 0.45)[1])
+    np_keeps = nms_wrapper.nms_multi([d.numpy() for d in dets_list], 0.45, num_threads=2)
+    assert [k.tolist() for k in np_keeps] == [k.tolist() for k in keeps]
+
+
+if __name__ == '__main__':
+    test_batched_multiclass_nms()
+    test_batched_nms_grid(pytest.MonkeyPatch())
+    test_nms_multi(True, pytest.MonkeyPatch())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查delta2bbox_fast、delta2bbox_script跟delta2bbox结果一致(包括batch输入和输出buffer)
+"""
+import numpy as np
+import torch
+
+from utils.bbox_reg import (delta2bbox, delta2bbox_fast, delta2bbox_script, bbox2ctr_wh,
+                            bbox2delta)
+
+
+def test_delta2bbox_fast():
+    g = torch.Generator().manual_seed(0)
+    rois = torch.rand(2000, 2, generator=g) * 500
+    rois = torch.cat([rois, rois + torch.rand(2000, 2, generator=g) * 200 + 10], 1)
+    deltas = torch.randn(3, 2000, 4, generator=g) * 2
+    anchors_cwh = bbox2ctr_wh(rois)
+    for means, stds in (([0, 0, 0, 0], [1, 1, 1, 1]),
+                        ([0.1, 0, -0.1, 0], [0.1, 0.1, 0.2, 0.2])):
+        for max_shape in (None, (300, 400, 3)):
+            out = torch.empty_like(deltas)
+            bboxes = delta2bbox_fast(anchors_cwh, deltas, means, stds, max_shape, out=out)
+            assert bboxes is out
+            for i in range(3):
+                ref = delta2bbox(rois, deltas[i], means, stds, max_shape)
+                assert torch.equal(bboxes[i], ref)
+                assert torch.equal(delta2bbox_fast(anchors_cwh, deltas[i], means, stds,
+                                                   max_shape), ref)
+    # 编码后再解码得到原来的框
+    gts = rois + torch.randn(2000, 4, generator=g)
+    bboxes = delta2bbox_fast(anchors_cwh, bbox2delta(rois, gts, [0.] * 4, [0.1, 0.1, 0.2, 0.2]),
+                             [0.] * 4, [0.1, 0.1, 0.2, 0.2])
+    assert torch.allclose(bboxes, gts, atol=1e-3)
+    assert delta2bbox_fast(anchors_cwh[:0], deltas[0, :0]).shape == (0, 4)
+
+
+def test_delta2bbox_script():
+    """script后的delta2bbox_script对batch输入(b,n,4)的结果跟逐张图delta2bbox一致"""
+    g = torch.Generator().manual_seed(0)
+    rois = torch.rand(500, 2, generator=g) * 500
+    rois = torch.cat([rois, rois + torch.rand(500, 2, generator=g) * 200 + 10], 1)
+    deltas = torch.randn(2, 500, 4, generator=g) * 2
+    means, stds = [0.1, 0, -0.1, 0], [0.1, 0.1, 0.2, 0.2]
+    scripted = torch.jit.script(delta2bbox_script)
+    bboxes = scripted(rois, deltas, torch.tensor(means), torch.tensor(stds),
+                      float(np.abs(np.log(16 / 1000))))
+    for i in range(2):
+        assert torch.equal(bboxes[i], delta2bbox(rois, deltas[i], means, stds))
+
+
+if __name__ == '__main__':
+    test_delta2bbox_fast()
+    test_delta2bbox_script()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查向量化的bbox2result跟逐类别筛选一致，Detections的pickle和results2json跟旧格式一致，
+show_result()接受两种格式的结果
+"""
+import json
+import os.path as osp
+import pickle
+import tempfile
+from types import SimpleNamespace
+
+import mmcv
+import numpy as np
+import pytest
+import torch
+
+from test_inference_wrapper import build_small_detector
+from utils.coco_eval import results2json
+from utils.detections import Detections, bbox2result
+
+
+class FakeDataset(object):
+    img_ids = [3, 7]
+    cat_ids = list(range(1, 91))[:80]
+
+    def __len__(self):
+        return len(self.img_ids)
+
+
+def random_dets(num_dets, num_classes=81, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    bboxes = torch.rand(num_dets, 2, generator=g) * 400
+    bboxes = torch.cat([bboxes, bboxes + torch.rand(num_dets, 2, generator=g) * 100,
+                        torch.rand(num_dets, 1, generator=g)], 1)
+    labels = torch.randint(0, num_classes - 1, (num_dets, ), generator=g)
+    return bboxes, labels
+
+
+def test_bbox2result():
+    for num_dets in (0, 1, 200):
+        bboxes, labels = random_dets(num_dets)
+        result = bbox2result(bboxes, labels, 81)
+        assert len(result) == 80
+        for i in range(80):
+            ref = bboxes.numpy()[labels.numpy() == i]
+            assert result[i].dtype == np.float32 and np.array_equal(result[i], ref)
+
+
+def test_detections():
+    bboxes, labels = random_dets(200)
+    dets = Detections.from_tensors(bboxes, labels, 81)
+    assert len(dets) == 200
+    assert np.array_equal(dets.dets, bboxes.numpy())
+    ref = bbox2result(bboxes, labels, 81)
+    assert all(np.array_equal(a, b) for a, b in zip(dets.to_list(), ref))
+    assert dets.to_list() is dets.to_list()
+    # 缓存的旧格式不参与pickle
+    loaded = pickle.loads(pickle.dumps(dets))
+    assert loaded._list is None
+    assert np.array_equal(loaded.boxes, dets.boxes) and np.array_equal(loaded.labels, dets.labels)
+
+    # results2json: Detections跟旧格式的输出相同
+    dataset = FakeDataset()
+    empty = Detections.from_tensors(torch.zeros(0, 5), torch.zeros(0, dtype=torch.long), 81)
+    with tempfile.TemporaryDirectory() as tmp:
+        out_file = osp.join(tmp, 'results.json')
+        results2json(dataset, [dets, empty], out_file)
+        with open(out_file) as f:
+            json_results = json.load(f)
+        results2json(dataset, [ref, empty.to_list()], out_file)
+        with open(out_file) as f:
+            assert json.load(f) == json_results
+    assert len(json_results) == 200
+
+
+def test_show_result(monkeypatch):
+    """show_result接受simple_test()的输出(按类别的list或compact=True的Detections)，每张图画自己的结果"""
+    detector = build_small_detector()
+    img = torch.randn(2, 3, 512, 512)
+    img_metas = [dict(img_shape=(512, 512, 3), scale_factor=1.),
+                 dict(img_shape=(480, 400, 3), scale_factor=0.8)]
+    data = dict(img=[img], img_meta=[SimpleNamespace(data=[img_metas])])
+    img_norm_cfg = dict(mean=[123.675, 116.28, 103.53], std=[1, 1, 1], to_rgb=True)
+    drawn = []
+    monkeypatch.setattr(mmcv, 'imshow_det_bboxes',
+                        lambda img, bboxes, labels, **kwargs: drawn.append((img, bboxes, labels)),
+                        raising=False)
+    with torch.no_grad():
+        results = detector.simple_test(img, img_metas)
+        compact = detector.simple_test(img, img_metas, compact=True)
+    for result in (results, compact):
+        drawn.clear()
+        detector.show_result(data, result, img_norm_cfg, dataset=['a', 'b', 'c', 'd'])
+        assert len(drawn) == 2
+        for (img_show, bboxes, labels), img_meta, dets in zip(drawn, img_metas, compact):
+            assert img_show.shape == img_meta['img_shape']
+            order = np.argsort(dets.labels, kind='stable')
+            assert np.array_equal(bboxes, dets.dets[order])
+            assert np.array_equal(labels, dets.labels[order])
+
+
+if __name__ == '__main__':
+    test_bbox2result()
+    test_detections()
+    test_show_result(pytest.MonkeyPatch())
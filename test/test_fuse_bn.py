@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查部署模式下bn折叠前后输出一致
+"""
+import copy
+import torch
+import torch.nn as nn
+
+from model.mlfpn import MLFPN
+from model.vgg import VGG
+from model.fuse_bn import fuse_module, ChannelShift
+
+
+def randomize_bn(module, positive_scale=True):
+    """让bn的running stats和affine参数都不是初始值，否则折叠前后一致没有意义"""
+    for m in module.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            if not positive_scale:
+                m.weight.data.uniform_(-1., 1.)
+            m.bias.data.uniform_(-0.5, 0.5)
+
+
+def test_fuse_mlfpn():
+    torch.manual_seed(0)
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256,
+                  num_levels=2)
+    mlfpn.init_weights()
+    randomize_bn(mlfpn)
+    mlfpn.eval()
+    fused = copy.deepcopy(mlfpn).fuse()
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+    assert isinstance(fused.Norm, ChannelShift)
+
+    feats = [torch.randn(1,512,64,64), torch.randn(1,1024,32,32)]
+    with torch.no_grad():
+        outs = mlfpn(feats)
+        fused_outs = fused(feats)
+    for out, fused_out in zip(outs, fused_outs):
+        assert torch.allclose(out, fused_out, rtol=1e-4, atol=1e-3)
+
+
+def test_fuse_mlfpn_keep_norm():
+    """Norm的scale有负数时不能折叠，应保留Norm且结果依然一致"""
+    torch.manual_seed(0)
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256,
+                  num_levels=2)
+    mlfpn.init_weights()
+    randomize_bn(mlfpn, positive_scale=False)
+    mlfpn.eval()
+    fused = copy.deepcopy(mlfpn).fuse()
+    assert isinstance(fused.Norm, nn.BatchNorm2d)
+
+    feats = [torch.randn(1,512,64,64), torch.randn(1,1024,32,32)]
+    with torch.no_grad():
+        outs = mlfpn(feats)
+        fused_outs = fused(feats)
+    for out, fused_out in zip(outs, fused_outs):
+        assert torch.allclose(out, fused_out, rtol=1e-4, atol=1e-3)
+
+
+def test_fuse_vgg_with_bn():
+    torch.manual_seed(0)
+    vgg = VGG(depth=11, with_bn=True, num_stages=2, dilations=(1, 1),
+              out_indices=(0, 1))
+    vgg.init_weights()
+    randomize_bn(vgg, positive_scale=False)
+    vgg.eval()
+    fused = fuse_module(copy.deepcopy(vgg))
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+
+    img = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        outs = vgg(img)
+        fused_outs = fused(img)
+    for out, fused_out in zip(outs, fused_outs):
+        assert torch.allclose(out, fused_out, rtol=1e-4, atol=1e-3)
+
+
+if __name__ == '__main__':
+    test_fuse_mlfpn()
+    test_fuse_mlfpn_keep_norm()
+    test_fuse_vgg_with_bn()
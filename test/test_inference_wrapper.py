@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查TorchScript导出的推理模块跟eager模式、detector.simple_test()的输出一致
+"""
+import os
+import tempfile
+
+import torch
+from addict import Dict
+
+from model.m2det_detector import M2detDetector
+from model.inference_wrapper import (DEFAULT_NMS_PRE, build_inference_wrapper,
+                                     export_torchscript, load_torchscript, get_flat_anchors)
+from utils.bbox_reg import delta2bbox
+
+
+def build_small_detector():
+    """2个tum、5类的小模型，用于cpu上的快速测试"""
+    cfg = Dict(
+        input_size=512,
+        model=dict(
+            type='M2detDetector',
+            pretrained=None,
+            backbone=dict(type='M2detVGG', input_size=512, depth=16,
+                          with_last_pool=False, ceil_mode=True,
+                          out_indices=(3, 4), out_feature_indices=(22, 34),
+                          l2_norm_scale=20),
+            neck=dict(type='MLFPN', backbone_type='M2detVGG', input_size=512,
+                      planes=256, smooth=True, num_levels=2, num_scales=6,
+                      side_channel=512, sfam=False, compress_ratio=16),
+            bbox_head=dict(type='M2detHead', input_size=512, planes=256,
+                           num_levels=2, num_classes=5,
+                           anchor_strides=(8, 16, 32, 64, 100, 300))),
+        train_cfg=dict(),
+        test_cfg=dict(nms=dict(type='nms', iou_thr=0.45), min_bbox_size=0,
+                      score_thr=0.25, max_per_img=50, nms_pre=300))
+    torch.manual_seed(0)
+    detector = M2detDetector(cfg)
+    # 随机初始化的head输出太小，放大一些让各类别的score拉开
+    for conv in detector.bbox_head.cls_convs:
+        conv.weight.data.normal_(0, 1.)
+    for conv in detector.bbox_head.reg_convs:
+        conv.weight.data.normal_(0, 0.5)
+    return detector.eval()
+
+
+def test_script_matches_eager():
+    detector = build_small_detector()
+    eager = build_inference_wrapper(detector, script=False)
+    scripted = build_inference_wrapper(detector, script=True)
+
+    img = torch.randn(2, 3, 512, 512)
+    img_shapes = torch.tensor([[512., 512.], [480., 400.]])
+    scale_factors = torch.tensor([[1.], [0.8]])
+    with torch.no_grad():
+        dets, labels, num_dets = eager(img, img_shapes, scale_factors)
+        s_dets, s_labels, s_num_dets = scripted(img, img_shapes, scale_factors)
+    assert dets.shape == (2, 50, 5) and labels.shape == (2, 50)
+    assert (num_dets > 0).all()
+    assert torch.equal(num_dets, s_num_dets)
+    assert torch.equal(labels, s_labels)
+    assert torch.allclose(dets, s_dets, rtol=1e-4, atol=1e-3)
+    assert (labels[0, num_dets[0]:] == -1).all()
+
+    # decode跟utils.bbox_reg.delta2bbox一致
+    anchors = get_flat_anchors(detector.bbox_head)
+    deltas = torch.randn(1, anchors.size(0), 4) * 0.1
+    assert torch.allclose(eager.decode(deltas)[0], delta2bbox(anchors, deltas[0]),
+                          atol=1e-3)
+
+    # 保存后不需要cfg直接加载
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'm2det.pt')
+        export_torchscript(detector, path, class_names=['a', 'b', 'c', 'd'])
+        loaded, meta = load_torchscript(path)
+        with torch.no_grad():
+            l_dets, l_labels, l_num_dets = loaded(img, img_shapes, scale_factors)
+    assert meta['input_size'] == 512 and meta['class_names'][0] == 'a'
+    assert torch.equal(l_labels, s_labels)
+    assert torch.allclose(l_dets, s_dets)
+
+
+def test_matches_detector():
+    """跟detector.simple_test(rescale=True)的结果一致(包括scale_factor != 1的图片)"""
+    detector = build_small_detector()
+    detector.test_cfg.max_per_img = 1000
+    img = torch.randn(2, 3, 512, 512)
+    img_metas = [dict(img_shape=(512, 512, 3), scale_factor=1.),
+                 dict(img_shape=(480, 400, 3), scale_factor=0.8)]
+    img_shapes = torch.tensor([[512., 512.], [480., 400.]])
+    scale_factors = torch.tensor([[1.], [0.8]])
+    for nms_pre in (300, -1):
+        detector.test_cfg.nms_pre = nms_pre
+        wrapper = build_inference_wrapper(detector, script=False)
+        with torch.no_grad():
+            results = detector.simple_test(img, img_metas, rescale=True, compact=True)
+            dets, labels, num_dets = wrapper(img, img_shapes, scale_factors)
+        for i, result in enumerate(results):
+            n = int(num_dets[i])
+            assert n == len(result) and n > 0
+            # 两边的输出顺序可能不同(score相同时)，按(label, score, bbox)排序后比较
+            out = sorted(zip(labels[i, :n].tolist(), dets[i, :n, [4, 0, 1, 2, 3]].tolist()))
+            ref = sorted(zip(result.labels.tolist(), result.dets[:, [4, 0, 1, 2, 3]].tolist()))
+            assert [o[0] for o in out] == [r[0] for r in ref]
+            assert torch.allclose(torch.tensor([o[1] for o in out]),
+                                  torch.tensor([r[1] for r in ref]), atol=1e-3)
+
+    # test_cfg没有nms_pre时导出的模块也限制nms的候选个数
+    detector.test_cfg.pop('nms_pre')
+    assert build_inference_wrapper(detector, script=False).nms_pre == DEFAULT_NMS_PRE
+
+
+if __name__ == '__main__':
+    test_script_matches_eager()
+    test_matches_detector()
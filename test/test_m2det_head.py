@@ -8,6 +8,11 @@ Created on Tue Mar 19 10:16:38 2019
 
 from model.mlfpn import MLFPN
 from model.m2det_head import M2detHead
+from utils.bbox_reg import delta2bbox
+from utils.bbox_nms import multiclass_nms
+from utils.anchor_target import anchor_target, anchor_inside_flags
+from utils.multi_apply import multi_apply
+import pickle
 import torch
 import matplotlib.pyplot as plt
 from addict import Dict
@@ -30,7 +35,295 @@ def draw_base_anchors(base_anchors_list):
             draw_rect(anchor)
         
 
+def test_fuse_head_convs():
+    """合并reg/cls conv后输出一致，且两种结构的state_dict可以互相加载"""
+    torch.manual_seed(0)
+    cfg = dict(input_size=512, planes=16, num_levels=2, num_classes=5)
+    head = M2detHead(**cfg)
+    fused_head = M2detHead(fuse_head_convs=True, **cfg)
+    fused_head.load_state_dict(head.state_dict())
+    assert len(fused_head.head_convs) == 6
+    assert fused_head.head_convs[0].out_channels == 24 + 5 * 6
+
+    feats = [torch.randn(2, 32, s, s) for s in (64, 32, 16, 8, 4, 2)]
+    with torch.no_grad():
+        cls_scores, bbox_preds = head(feats)
+        fused_cls_scores, fused_bbox_preds = fused_head(feats)
+    for a, b in zip(cls_scores + bbox_preds, fused_cls_scores + fused_bbox_preds):
+        assert a.shape == b.shape
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-5)
+
+    unfused_head = M2detHead(**cfg)
+    unfused_head.load_state_dict(fused_head.state_dict())
+    for name, param in head.state_dict().items():
+        assert torch.equal(param, unfused_head.state_dict()[name]), name
+
+
+def test_input_size():
+    """size_featmaps/anchor_strides为None时由detector推导，跟实际特征图尺寸和anchor个数一致"""
+    from model.m2det_detector import M2detDetector
+    from model.inference_wrapper import M2detFeatureNet, get_flat_anchors
+    for input_size, sizes in [(320, [40, 20, 10, 5, 3, 1]), (384, [48, 24, 12, 6, 3, 1])]:
+        cfg = Dict(
+            input_size=input_size,
+            model=dict(
+                type='M2detDetector',
+                pretrained=None,
+                backbone=dict(type='M2detVGG', input_size=input_size, depth=16,
+                              with_last_pool=False, ceil_mode=True,
+                              out_indices=(3, 4), out_feature_indices=(22, 34),
+                              l2_norm_scale=20),
+                neck=dict(type='MLFPN', backbone_type='M2detVGG', input_size=input_size,
+                          planes=256, smooth=True, num_levels=2, num_scales=6,
+                          side_channel=512),
+                bbox_head=dict(type='M2detHead', input_size=input_size, planes=256,
+                               num_levels=2, num_classes=5,
+                               anchor_strides=None, size_featmaps=None)),
+            train_cfg=dict(),
+            test_cfg=dict())
+        detector = M2detDetector(cfg).eval()
+        head = detector.bbox_head
+        assert head.featmap_sizes == [(s, s) for s in sizes]
+        assert list(head.anchor_strides[:4]) == [8, 16, 32, 64]
+
+        img = torch.randn(1, 3, input_size, input_size)
+        with torch.no_grad():
+            feats = detector.neck(detector.backbone(img))
+            cls_scores, bbox_preds = M2detFeatureNet(detector)(img)
+        assert [tuple(f.shape[-2:]) for f in feats] == head.featmap_sizes
+        assert cls_scores.shape[1] == get_flat_anchors(head).shape[0]
+
+
+def test_batched_get_bboxes():
+    """batch后处理跟逐张图get_bboxes_single()结果一致"""
+    torch.manual_seed(0)
+    head = M2detHead(input_size=512, planes=16, num_levels=2, num_classes=5)
+    for conv in head.cls_convs:
+        conv.weight.data.normal_(0, 1.)
+    cfg = Dict(score_thr=0.2, nms=dict(type='nms', iou_thr=0.45), max_per_img=50, nms_pre=100)
+    img_metas = [dict(img_shape=(512, 512, 3), scale_factor=1.),
+                 dict(img_shape=(400, 480, 3), scale_factor=0.8),
+                 dict(img_shape=(512, 300, 3), scale_factor=[0.5, 0.6, 0.5, 0.6])]
+    feats = [torch.randn(3, 32, s, s) for s in (64, 32, 16, 8, 4, 2)]
+    with torch.no_grad():
+        cls_scores, bbox_preds = head(feats)
+    results = head.get_bboxes(cls_scores, bbox_preds, img_metas, cfg, rescale=True)
+    assert len(results) == 3
+
+    mlvl_anchors = [head.anchor_generators[i].grid_anchors(
+        cls_scores[i].shape[-2:], head.anchor_strides[i], device='cpu') for i in range(6)]
+    for img_id, img_meta in enumerate(img_metas):
+        det_bboxes, det_labels = head.get_bboxes_single(
+            [s[img_id] for s in cls_scores], [p[img_id] for p in bbox_preds], mlvl_anchors,
+            img_meta['img_shape'], img_meta['scale_factor'], cfg, rescale=True)
+        assert det_bboxes.shape[0] > 0
+        assert torch.equal(results[img_id][1], det_labels)
+        assert torch.allclose(results[img_id][0], det_bboxes)
+
+
+def test_get_bboxes_score_thr_first():
+    """先筛选score再解码，结果跟解码所有anchor后multiclass_nms一致; nms_pre联合所有level取top-k"""
+    torch.manual_seed(0)
+    head = M2detHead(input_size=512, planes=16, num_levels=2, num_classes=5)
+    for conv in head.cls_convs:
+        conv.weight.data.normal_(0, 1.)
+    feats = [torch.randn(1, 32, s, s) for s in (64, 32, 16, 8, 4, 2)]
+    with torch.no_grad():
+        cls_scores, bbox_preds = head(feats)
+    img_meta = dict(img_shape=(400, 480, 3), scale_factor=0.8)
+    mlvl_anchors = [head.anchor_generators[i].grid_anchors(
+        cls_scores[i].shape[-2:], head.anchor_strides[i], device='cpu') for i in range(6)]
+    cfg = Dict(score_thr=0.2, nms=dict(type='nms', iou_thr=0.45), max_per_img=50)
+
+    scores = torch.cat([s[0].permute(1, 2, 0).reshape(-1, 5) for s in cls_scores]).softmax(-1)
+    deltas = torch.cat([p[0].permute(1, 2, 0).reshape(-1, 4) for p in bbox_preds])
+    bboxes = delta2bbox(torch.cat(mlvl_anchors), deltas, head.target_means, head.target_stds,
+                        img_meta['img_shape']) / 0.8
+    ref_bboxes, ref_labels = multiclass_nms(bboxes, scores, cfg.score_thr, cfg.nms,
+                                            cfg.max_per_img)
+    det_bboxes, det_labels = head.get_bboxes(cls_scores, bbox_preds, [img_meta], cfg,
+                                             rescale=True)[0]
+    assert det_bboxes.shape[0] > 0
+    assert torch.equal(det_labels, ref_labels)
+    assert torch.allclose(det_bboxes, ref_bboxes)
+
+    # nms_pre: 所有level的(anchor, class)对中score最高的nms_pre个参与nms
+    cfg.nms_pre = 30
+    det_bboxes, _ = head.get_bboxes(cls_scores, bbox_preds, [img_meta], cfg, rescale=True)[0]
+    kth_score = scores[:, 1:][scores[:, 1:] > cfg.score_thr].topk(30)[0][-1]
+    assert 0 < det_bboxes.shape[0] <= 30
+    assert (det_bboxes[:, 4] >= kth_score).all()
+    # 没有框超过score_thr
+    cfg.score_thr = 1.
+    det_bboxes, det_labels = head.get_bboxes(cls_scores, bbox_preds, [img_meta], cfg)[0]
+    assert det_bboxes.shape == (0, 5) and det_labels.shape == (0, )
+
+
+def test_anchor_cache():
+    """缓存的anchors/valid flags跟逐level生成的一致，batch中的图片共享同一个tensor，loss可以在cpu上计算"""
+    torch.manual_seed(0)
+    head = M2detHead(input_size=512, planes=16, num_levels=2, num_classes=5)
+    img_metas = [Dict(img_shape=(500, 400, 3), pad_shape=(512, 448, 3)),
+                 Dict(img_shape=(300, 512, 3), pad_shape=(320, 512, 3))]
+    featmap_sizes = head.featmap_sizes
+    anchor_list, valid_flag_list, num_level_anchors = head.get_anchors(featmap_sizes, img_metas)
+    assert anchor_list[0] is anchor_list[1]
+    assert anchor_list[0] is head.get_anchors(featmap_sizes, img_metas)[0][0]
+    assert num_level_anchors == [h * w * 6 for h, w in featmap_sizes]
+    ref_anchors = torch.cat([head.anchor_generators[i].grid_anchors(
+        featmap_sizes[i], head.anchor_strides[i]) for i in range(6)])
+    assert torch.equal(anchor_list[0], ref_anchors)
+    cached = head.anchor_cache.get(featmap_sizes)
+    assert torch.equal(cached['anchors_cwh'][:, 2:], ref_anchors[:, 2:] - ref_anchors[:, :2] + 1)
+    assert cached['level_offsets'][-1] == ref_anchors.size(0)
+    for img_meta, flags in zip(img_metas, valid_flag_list):
+        h, w = img_meta['pad_shape'][:2]
+        ref_flags = torch.cat([head.anchor_generators[i].valid_flags(
+            featmap_sizes[i], (min(-(-h // stride), featmap_sizes[i][0]),
+                               min(-(-w // stride), featmap_sizes[i][1]))).bool()
+            for i, stride in enumerate(head.anchor_strides)])
+        assert torch.equal(flags, ref_flags)
+        inside = head.anchor_cache.valid_flags(featmap_sizes, img_meta['pad_shape'],
+                                               img_meta['img_shape'], 0)
+        assert torch.equal(inside, anchor_inside_flags(ref_anchors, ref_flags,
+                                                       img_meta['img_shape'][:2], 0))
+
+    # loss: 共享的flat anchors跟逐level的anchor list得到相同的target
+    # (unmap_outputs=False要求所有anchor有效，训练时pad_shape为输入尺寸)
+    img_metas = [Dict(img_shape=(512, 400, 3), pad_shape=(512, 512, 3)),
+                 Dict(img_shape=(300, 512, 3), pad_shape=(512, 512, 3))]
+    anchor_list, valid_flag_list, num_level_anchors = head.get_anchors(featmap_sizes, img_metas)
+    train_cfg = Dict(assigner=Dict(type='MaxIoUAssigner', pos_iou_thr=0.5, neg_iou_thr=0.5,
+                                   min_pos_iou=0., ignore_iof_thr=-1, gt_max_assign_all=False),
+                     smoothl1_beta=1., allowed_border=-1, pos_weight=-1, neg_pos_ratio=3)
+    gt_bboxes = [torch.tensor([[20., 20., 120., 120.]]), torch.tensor([[100., 50., 300., 250.]])]
+    gt_labels = [torch.tensor([1]), torch.tensor([3])]
+    targets = anchor_target(anchor_list, valid_flag_list, gt_bboxes, img_metas, head.target_means,
+                            head.target_stds, train_cfg, gt_labels_list=gt_labels,
+                            sampling=False, unmap_outputs=False,
+                            num_level_anchors=num_level_anchors)
+    mlvl_anchors = [head.anchor_generators[i].grid_anchors(featmap_sizes[i],
+                                                           head.anchor_strides[i])
+                    for i in range(6)]
+    ref_targets = anchor_target([list(mlvl_anchors) for _ in img_metas],
+                                [list(torch.split(f, num_level_anchors)) for f in valid_flag_list],
+                                gt_bboxes, img_metas, head.target_means, head.target_stds,
+                                train_cfg, gt_labels_list=gt_labels, sampling=False,
+                                unmap_outputs=False)
+    for t, ref in zip(targets[:4], ref_targets[:4]):
+        assert all(torch.equal(a, b) for a, b in zip(t, ref))
+    feats = [torch.randn(2, 32, h, w) for h, w in featmap_sizes]
+    outs = head(feats)
+    losses = head.loss(*outs, gt_bboxes, gt_labels, img_metas, train_cfg)
+    assert torch.isfinite(sum(losses['loss_cls']) + sum(losses['loss_reg']))
+    # batch分配跟逐张图分配的loss相同
+    train_cfg.assigner.type = 'BatchedMaxIoUAssigner'
+    batched_losses = head.loss(*outs, gt_bboxes, gt_labels, img_metas, train_cfg)
+    train_cfg.assigner.type = 'GridMaxIoUAssigner'
+    grid_losses = head.loss(*outs, gt_bboxes, gt_labels, img_metas, train_cfg)
+    for name in ('loss_cls', 'loss_reg'):
+        assert all(torch.equal(a, b) for a, b in zip(losses[name], batched_losses[name]))
+        assert all(torch.equal(a, b) for a, b in zip(losses[name], grid_losses[name]))
+
+
+def test_restrict_classes():
+    """只保留部分类别: cls输出等于原输出对应的通道，labels映射回原类别, 合并conv的head一致"""
+    torch.manual_seed(0)
+    cfg = dict(input_size=512, planes=16, num_levels=2, num_classes=5)
+    head = M2detHead(**cfg)
+    for conv in head.cls_convs:
+        conv.weight.data.normal_(0, 1.)
+    fused_head = M2detHead(fuse_head_convs=True, **cfg)
+    fused_head.load_state_dict(head.state_dict())
+    test_cfg = Dict(score_thr=0.1, nms=dict(type='nms', iou_thr=0.45), max_per_img=50)
+    img_metas = [dict(img_shape=(512, 512, 3), scale_factor=1.)] * 2
+    feats = [torch.randn(2, 32, s, s) for s in (64, 32, 16, 8, 4, 2)]
+    with torch.no_grad():
+        cls_scores, _ = head(feats)
+        head.restrict_classes([4, 2])
+        fused_head.restrict_classes([2, 4])
+        sub_cls_scores, bbox_preds = head(feats)
+        fused_cls_scores, _ = fused_head(feats)
+    assert head.cls_out_channels == 3 and head.class_inds == [2, 4]
+    assert head.cls_convs[0].out_channels == 3 * 6
+    for full, sub, fused in zip(cls_scores, sub_cls_scores, fused_cls_scores):
+        b, _, h, w = full.shape
+        ref = full.view(b, 6, 5, h, w)[:, :, [0, 2, 4]].reshape(b, -1, h, w)
+        assert torch.equal(sub, ref)
+        assert torch.allclose(fused, ref, rtol=1e-4, atol=1e-5)
+    results = head.get_bboxes(sub_cls_scores, bbox_preds, img_metas, test_cfg)
+    labels = torch.cat([det_labels for _, det_labels in results])
+    assert labels.numel() > 0 and set(labels.tolist()) <= {1, 3}
+
+    # 再缩小一次跟直接选一个类别一致
+    head.restrict_classes([4])
+    with torch.no_grad():
+        cls_scores_4, _ = head(feats)
+    assert torch.equal(cls_scores_4[0], cls_scores[0].view(2, 6, 5, 64, 64)[:, :, [0, 4]]
+                       .reshape(2, -1, 64, 64))
+
+
+def test_precompute_targets():
+    """dataset中(pickle到worker之后)计算的anchor target跟loss中计算的loss相同"""
+    torch.manual_seed(0)
+    head = M2detHead(input_size=512, planes=16, num_levels=2, num_classes=5)
+    img_metas = [Dict(img_shape=(512, 400, 3), pad_shape=(512, 512, 3)),
+                 Dict(img_shape=(300, 512, 3), pad_shape=(512, 512, 3))]
+    gt_bboxes = [torch.tensor([[20., 20., 120., 120.], [200., 10., 390., 500.]]),
+                 torch.tensor([[100., 50., 300., 250.]])]
+    gt_labels = [torch.tensor([1, 4]), torch.tensor([3])]
+    outs = head([torch.randn(2, 32, h, w) for h, w in head.featmap_sizes])
+    for assigner_type in ('MaxIoUAssigner', 'GridMaxIoUAssigner'):
+        train_cfg = Dict(assigner=Dict(type=assigner_type, pos_iou_thr=0.5, neg_iou_thr=0.5,
+                                       min_pos_iou=0., ignore_iof_thr=-1,
+                                       gt_max_assign_all=False),
+                         smoothl1_beta=1., allowed_border=-1, pos_weight=-1, neg_pos_ratio=3)
+        generator = pickle.loads(pickle.dumps(head.anchor_target_generator(train_cfg)))
+        targets = [generator(gt, label, img_meta)
+                   for gt, label, img_meta in zip(gt_bboxes, gt_labels, img_metas)]
+        losses = head.loss(*outs, gt_bboxes, gt_labels, img_metas, train_cfg)
+        pre_losses = head.loss(*outs, gt_bboxes, gt_labels, img_metas, train_cfg,
+                               anchor_targets=tuple(zip(*targets)))
+        for name in ('loss_cls', 'loss_reg'):
+            assert all(torch.equal(a, b) for a, b in zip(losses[name], pre_losses[name]))
+
+
+def test_loss_batch():
+    """batch的hard negative mining跟逐张图的loss_single()选出相同的样本:
+    包括没有正样本、负样本不够neg_pos_ratio倍、有weight为0的anchor的图片"""
+    head = M2detHead(input_size=512, planes=16, num_levels=2, num_classes=5)
+    cfg = Dict(neg_pos_ratio=3, smoothl1_beta=1.)
+    g = torch.Generator().manual_seed(0)
+    num_images, num_anchors = 4, 2000
+    all_cls_scores = torch.randn(num_images, num_anchors, 5, generator=g)
+    all_bbox_preds = torch.randn(num_images, num_anchors, 4, generator=g)
+    all_labels = torch.randint(1, 5, (num_images, num_anchors), generator=g)
+    all_labels[torch.rand(num_images, num_anchors, generator=g) < 0.98] = 0
+    all_labels[1] = 0
+    all_labels[2, :1900] = 3
+    all_label_weights = (torch.rand(num_images, num_anchors, generator=g) > 0.05).float()
+    all_bbox_targets = torch.randn(num_images, num_anchors, 4, generator=g)
+    all_bbox_weights = (all_labels > 0).float()[..., None].expand(-1, -1, 4).contiguous()
+    num_total_samples = int((all_labels > 0).sum(1).clamp(min=1).sum())
+    losses = head.loss_batch(all_cls_scores, all_bbox_preds, all_labels, all_label_weights,
+                             all_bbox_targets, all_bbox_weights, num_total_samples, cfg)
+    refs = multi_apply(head.loss_single, all_cls_scores, all_bbox_preds, all_labels,
+                       all_label_weights, all_bbox_targets, all_bbox_weights,
+                       num_total_samples=num_total_samples, cfg=cfg)
+    for loss, ref in zip(losses, refs):
+        for a, b in zip(loss, ref):
+            assert a.shape == b.shape and torch.allclose(a, b, rtol=1e-6, atol=0)
+
+
 if __name__ == '__main__':
+    test_fuse_head_convs()
+    test_input_size()
+    test_batched_get_bboxes()
+    test_get_bboxes_score_thr_first()
+    test_anchor_cache()
+    test_restrict_classes()
+    test_precompute_targets()
+    test_loss_batch()
     
     # 创建MLFPN
     cfg_fpn = dict(backbone_type = 'SSDVGG',
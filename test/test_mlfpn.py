@@ -10,6 +10,74 @@ from model.mlfpn import MLFPN
 import torch
 
 
+def test_shared_leach_runs_once():
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256, 
+                  num_levels=3, leach_mode='shared')
+    mlfpn.init_weights()
+    mlfpn.eval()
+    calls = []
+    mlfpn.leach[0].register_forward_hook(lambda m, i, o: calls.append(1))
+    feats = [torch.randn(1,512,64,64), torch.randn(1,1024,32,32)]
+    with torch.no_grad():
+        sources = mlfpn(feats)
+    assert len(calls) == 1
+    assert [s.shape[1] for s in sources] == [256*3] * 6
+    
+    # per_level模式加载shared模式的checkpoint后输出应一致
+    per_level = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256, 
+                      num_levels=3, leach_mode='per_level')
+    per_level.load_state_dict(mlfpn.state_dict())
+    per_level.eval()
+    assert per_level.leach[0] is not per_level.leach[1]
+    with torch.no_grad():
+        sources_per_level = per_level(feats)
+    for s1, s2 in zip(sources, sources_per_level):
+        assert torch.allclose(s1, s2)
+
+
+def test_active_levels():
+    """只运行前k个tum时，前k个tum的通道跟完整运行一致，缺失通道等价于tum输出为0"""
+    torch.manual_seed(0)
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256, 
+                  num_levels=3)
+    mlfpn.init_weights()
+    mlfpn.Norm.running_mean.uniform_(-0.5, 0.5)
+    mlfpn.Norm.running_var.uniform_(0.5, 2.)
+    mlfpn.Norm.weight.data.uniform_(0.5, 1.5)
+    mlfpn.Norm.bias.data.uniform_(-0.5, 0.5)
+    mlfpn.eval()
+    feats = [torch.randn(1,512,64,64), torch.randn(1,1024,32,32)]
+    with torch.no_grad():
+        sources = mlfpn(feats)
+        sources_k = mlfpn.set_active_levels(2)(feats)
+        norm_zero = mlfpn.Norm(torch.zeros(1, 256*3, 1, 1))
+    c = 256 * 2
+    for s, s_k in zip(sources, sources_k):
+        assert s.shape == s_k.shape
+        assert torch.allclose(s[:, :c], s_k[:, :c], atol=1e-5)
+    for s_k in sources_k[1:]:
+        assert (s_k[:, c:] == 0).all()
+    assert torch.allclose(sources_k[0][:, c:], norm_zero[:, c:].expand_as(
+        sources_k[0][:, c:]), atol=1e-5)
+    
+    # 部署模式下同样成立
+    fused = mlfpn.fuse()
+    with torch.no_grad():
+        fused_k = fused(feats)
+    for s_k, f_k in zip(sources_k, fused_k):
+        assert torch.allclose(s_k, f_k, rtol=1e-4, atol=1e-3)
+    
+    # level dropout训练时缺失tum对应的Norm统计量不更新
+    mlfpn = MLFPN(backbone_type='M2detVGG', input_size=512, planes=256, 
+                  num_levels=3, level_dropout=1.)
+    mlfpn.train()
+    mlfpn.get_active_levels = lambda: 1
+    running_mean = mlfpn.Norm.running_mean.clone()
+    mlfpn(feats)
+    assert torch.equal(mlfpn.Norm.running_mean[256:], running_mean[256:])
+    assert not torch.equal(mlfpn.Norm.running_mean[:256], running_mean[:256])
+
+
 if __name__ == '__main__':
     cfg_fpn = dict(backbone_type = 'SSDVGG',
                    phase = 'train',
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查onnx导出的模型在onnxruntime上跟pytorch输出一致(需要安装onnx/onnxruntime)
+"""
+import os
+import tempfile
+import numpy as np
+import pytest
+import torch
+
+from model.inference_wrapper import M2detFeatureNet
+from test_inference_wrapper import build_small_detector
+
+onnx = pytest.importorskip('onnx')
+ort = pytest.importorskip('onnxruntime')
+
+
+def test_onnx_matches_torch():
+    from model.onnx_runner import export_onnx, OnnxM2detRunner
+    detector = build_small_detector()
+    img = torch.randn(2, 3, 512, 512)
+    with torch.no_grad():
+        cls_scores, bbox_preds = M2detFeatureNet(detector)(img)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'm2det.onnx')
+        export_onnx(detector, path, class_names=['a', 'b', 'c', 'd'])
+        runner = OnnxM2detRunner(path)
+        # 导出时batch=1, 这里用batch=2检查动态batch维度
+        onnx_cls_scores, onnx_bbox_preds = runner.run_network(img)
+    assert runner.class_names[0] == 'a'
+    assert runner.anchors.shape[0] == cls_scores.shape[1]
+    np.testing.assert_allclose(onnx_cls_scores, cls_scores.numpy(), rtol=1e-3, atol=1e-3)
+    np.testing.assert_allclose(onnx_bbox_preds, bbox_preds.numpy(), rtol=1e-3, atol=1e-3)
+
+    img_metas = [dict(img_shape=(512, 512, 3), scale_factor=1.)] * 2
+    results = runner.postprocess(onnx_cls_scores, onnx_bbox_preds, img_metas)
+    torch_results = runner.postprocess(cls_scores.numpy(), bbox_preds.numpy(), img_metas)
+    for (dets, labels), (torch_dets, torch_labels) in zip(results, torch_results):
+        assert torch.equal(labels, torch_labels)
+        assert torch.allclose(dets, torch_dets, rtol=1e-3, atol=1e-2)
+
+
+if __name__ == '__main__':
+    test_onnx_matches_torch()
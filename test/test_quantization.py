@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查int8量化后的模型跟fp32输出接近，且可以导出/加载
+"""
+import os
+import tempfile
+import torch
+import torch.nn.functional as F
+import torch.ao.nn.intrinsic.quantized as nniq
+
+from model.inference_wrapper import M2detFeatureNet, load_torchscript
+from model.quantization import quantize_feature_net, export_quantized
+from test_inference_wrapper import build_small_detector
+
+
+def test_quantize_feature_net():
+    detector = build_small_detector()
+    torch.manual_seed(1)
+    calib_imgs = [torch.randn(1, 3, 512, 512) for _ in range(2)]
+    qnet = quantize_feature_net(detector, calib_imgs)
+    # BasicConv的conv+bn+relu融合成了一个int8 ConvReLU2d
+    assert isinstance(qnet.get_submodule('neck.tums.0.layers.0.conv'), nniq.ConvReLU2d)
+
+    img = torch.randn(1, 3, 512, 512)
+    with torch.no_grad():
+        outs = M2detFeatureNet(detector)(img)
+        qouts = qnet(img)
+    for out, qout in zip(outs, qouts):
+        assert out.shape == qout.shape
+        assert F.cosine_similarity(out.flatten(), qout.flatten(), 0) > 0.98
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'm2det_int8.pt')
+        wrapper = export_quantized(detector, calib_imgs, path)
+        loaded, meta = load_torchscript(path)
+        img_shapes = torch.tensor([[512., 512.]])
+        scale_factors = torch.tensor([[1.]])
+        with torch.no_grad():
+            dets, labels, num_dets = wrapper(img, img_shapes, scale_factors)
+            l_dets, l_labels, l_num_dets = loaded(img, img_shapes, scale_factors)
+    assert meta['quant_backend'] == 'x86'
+    assert torch.equal(labels, l_labels)
+    assert torch.allclose(dets, l_dets)
+
+
+if __name__ == '__main__':
+    test_quantize_feature_net()
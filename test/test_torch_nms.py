@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检查纯tensor实现的torch_nms、网格索引的cpu_grid_nms跟编译的cpu_nms结果完全一致，
+torch_soft_nms跟cpu_soft_nms一致，以及matrix_nms的基本性质
+"""
+import numpy as np
+import pytest
+import torch
+
+from utils.nms.torch_nms import torch_nms, torch_soft_nms, matrix_nms
+from test_bbox_nms import random_dets
+
+
+def clustered_dets(num_bboxes, seed=0):
+    bboxes, scores = random_dets(num_bboxes, num_classes=2, seed=seed)
+    return torch.cat([bboxes, scores[:, 1:]], 1)
+
+
+def test_torch_nms_matches_cpu_nms():
+    cpu_nms = pytest.importorskip('utils.nms.cpu_nms').cpu_nms
+    for num_bboxes in (1, 100, 1000, 3000):
+        dets = clustered_dets(num_bboxes)
+        for iou_thr in (0.3, 0.5, 0.7):
+            keep = cpu_nms(dets.numpy(), iou_thr)
+            _, inds = torch_nms(dets, iou_thr, block_size=256)
+            assert inds.tolist() == list(keep)
+
+
+def test_grid_nms_matches_cpu_nms():
+    cpu_nms = pytest.importorskip('utils.nms.cpu_nms').cpu_nms
+    cpu_grid_nms = pytest.importorskip('utils.nms.cpu_grid_nms').cpu_grid_nms
+    for num_bboxes in (0, 1, 100, 3000):
+        dets = clustered_dets(num_bboxes).numpy()
+        for iou_thr in (0., 0.3, 0.5, 0.7):
+            for cell_size in (0, 5, 1000):
+                assert list(cpu_grid_nms(dets, iou_thr, cell_size)) == list(cpu_nms(dets, iou_thr))
+    # 整数坐标(框的边界正好落在网格边界上)和相同的score
+    dets = clustered_dets(1000, seed=2)
+    dets = torch.cat([dets[:, :4].round(), (dets[:, 4:] * 10).round()], 1).numpy()
+    assert list(cpu_grid_nms(dets, 0.5, 16)) == list(cpu_nms(dets, 0.5))
+
+
+def test_torch_nms():
+    dets = clustered_dets(300, seed=1)
+    _, inds = torch_nms(dets, 0.5)
+    # 逐个框的贪心nms作为参照
+    order = dets[:, 4].argsort(descending=True).tolist()
+    ref = []
+    for i in order:
+        if all(torch_iou(dets[i], dets[j]) < 0.5 for j in ref):
+            ref.append(i)
+    assert inds.tolist() == ref
+    # block大小不影响结果，numpy输入返回numpy
+    assert torch.equal(torch_nms(dets, 0.5, block_size=37)[1], inds)
+    np_dets, np_inds = torch_nms(dets.numpy(), 0.5)
+    assert isinstance(np_inds, np.ndarray) and np_inds.tolist() == ref
+    assert torch_nms(dets[:0], 0.5)[1].numel() == 0
+
+    # groups: 不同group互不抑制，等价于每个group分别nms
+    groups = torch.randint(0, 3, (dets.size(0), ), generator=torch.Generator().manual_seed(0))
+    _, inds = torch_nms(dets, 0.5, groups=groups)
+    ref = torch.cat([torch.nonzero(groups == g)[:, 0][torch_nms(dets[groups == g], 0.5)[1]]
+                     for g in range(3)])
+    assert sorted(inds.tolist()) == sorted(ref.tolist())
+
+
+def test_torch_soft_nms_matches_cpu_soft_nms():
+    cpu_soft_nms = pytest.importorskip('utils.nms.cpu_soft_nms').cpu_soft_nms
+    for num_bboxes in (1, 100, 1000):
+        dets = clustered_dets(num_bboxes)
+        for method, code in (('linear', 1), ('gaussian', 2)):
+            for iou_thr in (0.3, 0.5):
+                ref_dets, ref_inds = cpu_soft_nms(dets.numpy().copy(), iou_thr, method=code,
+                                                  sigma=0.5, min_score=1e-3)
+                new_dets, inds = torch_soft_nms(dets, iou_thr, method=method)
+                assert inds.tolist() == list(ref_inds)
+                assert np.allclose(new_dets.numpy(), ref_dets)
+
+
+def test_torch_soft_nms():
+    dets = torch.tensor([[0., 0., 10., 10., 0.9],
+                         [0., 0., 10., 10., 0.8],
+                         [50., 50., 60., 60., 0.7],
+                         [1., 1., 10., 10., 0.6]])
+    new_dets, inds = torch_soft_nms(dets, 0.3, method='linear')
+    # 完全重合的框score衰减为0被去掉，不重叠的框不变
+    assert inds.tolist() == [0, 2, 3]
+    assert new_dets[:2, 4].tolist() == pytest.approx([0.9, 0.7])
+    assert new_dets[2, 4] == pytest.approx(0.6 * (1 - 100 / 121))
+    new_dets, inds = torch_soft_nms(dets, 0.3, method='gaussian', sigma=0.5)
+    # gaussian不去掉完全重合的框, 衰减后的score决定选取顺序
+    assert inds.tolist() == [0, 2, 3, 1]
+    assert new_dets[2, 4] == pytest.approx(0.6 * np.exp(-(100 / 121) ** 2 / 0.5))
+    assert new_dets[3, 4] < 0.8 * np.exp(-2)
+    with pytest.raises(ValueError):
+        torch_soft_nms(dets, 0.3, method='hard')
+    assert torch_soft_nms(dets[:0], 0.3)[1].numel() == 0
+
+    # groups: 所有group并行处理，结果等价于每个group分别soft nms
+    dets = clustered_dets(500, seed=1)
+    groups = torch.randint(0, 4, (dets.size(0), ), generator=torch.Generator().manual_seed(0))
+    new_dets, inds = torch_soft_nms(dets, 0.3, method='gaussian', groups=groups)
+    for g in range(4):
+        g_inds = torch.nonzero(groups == g)[:, 0]
+        ref_dets, ref_inds = torch_soft_nms(dets[g_inds], 0.3, method='gaussian')
+        mask = groups[inds] == g
+        assert torch.equal(inds[mask], g_inds[ref_inds])
+        assert torch.equal(new_dets[mask], ref_dets)
+    np_dets, np_inds = torch_soft_nms(dets.numpy(), 0.3)
+    assert isinstance(np_inds, np.ndarray) and isinstance(np_dets, np.ndarray)
+
+
+def torch_iou(a, b):
+    w = (min(a[2], b[2]) - max(a[0], b[0]) + 1).clamp(min=0)
+    h = (min(a[3], b[3]) - max(a[1], b[1]) + 1).clamp(min=0)
+    inter = w * h
+    return inter / ((a[2] - a[0] + 1) * (a[3] - a[1] + 1) +
+                    (b[2] - b[0] + 1) * (b[3] - b[1] + 1) - inter)
+
+
+def test_matrix_nms():
+    dets = torch.tensor([[0., 0., 10., 10., 0.9],
+                         [0., 0., 10., 10., 0.8],
+                         [50., 50., 60., 60., 0.7],
+                         [1., 1., 10., 10., 0.6]])
+    new_dets, inds = matrix_nms(dets, kernel='linear', min_score=0.05)
+    # 完全重合的框score衰减为0，不重叠的框不变
+    assert inds.tolist() == [0, 2, 3]
+    assert new_dets[:2, 4].tolist() == pytest.approx([0.9, 0.7])
+    assert new_dets[2, 4] < 0.6
+    # 不同group互不衰减
+    new_dets, inds = matrix_nms(dets, groups=torch.tensor([0, 1, 0, 2]))
+    assert torch.allclose(new_dets[:, 4], dets[inds, 4])
+    # 分块计算不影响结果
+    dets = clustered_dets(1000)
+    assert torch.allclose(matrix_nms(dets)[0], matrix_nms(dets, block_size=100)[0])
+
+
+if __name__ == '__main__':
+    test_torch_nms_matches_cpu_nms()
+    test_grid_nms_matches_cpu_nms()
+    test_torch_nms()
+    test_torch_soft_nms_matches_cpu_soft_nms()
+    test_torch_soft_nms()
+    test_matrix_nms()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+anytime inference评估: 对每个k(只运行前k个tum)统计前向延时，给定checkpoint时同时评估coco mAP
+用法:
+    python tools/benchmark_anytime.py config/cfg_m2det512_vgg16_coco.py
+    python tools/benchmark_anytime.py config/cfg_m2det512_vgg16_coco.py \
+        --checkpoint work_dirs/m2det512/latest.pth --eval --max-imgs 500
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+from functools import partial
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.config import Config  # noqa: E402
+from model.m2det_detector import M2detDetector  # noqa: E402
+
+
+def measure_latency(model, img, repeat=20, warmup=5):
+    """return average latency(ms) of backbone+neck+head forward"""
+    def run():
+        with torch.no_grad():
+            model.bbox_head(model.extract_feat(img))
+        if img.is_cuda:
+            torch.cuda.synchronize()
+    for _ in range(warmup):
+        run()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def evaluate_map(model, cfg, max_imgs=None, out_file='anytime_results.json', imgs_per_gpu=1):
+    """在cfg.data.test上做单gpu测试并返回mAP@IoU=0.5:0.95, 每次前向imgs_per_gpu张图"""
+    from mmcv.parallel import MMDataParallel, collate
+    from dataset.coco_dataset import CocoDataset
+    from dataset.utils import get_dataset
+    from utils.coco_eval import results2json, evaluation
+
+    dataset = get_dataset(cfg.data.test, CocoDataset)
+    if max_imgs is not None:
+        dataset.img_infos = dataset.img_infos[:max_imgs]
+        dataset.img_ids = dataset.img_ids[:max_imgs]
+    data_loader = DataLoader(dataset, batch_size=imgs_per_gpu, shuffle=False,
+                             num_workers=cfg.data.workers_per_gpu,
+                             collate_fn=partial(collate, samples_per_gpu=imgs_per_gpu))
+    parallel_model = MMDataParallel(model, device_ids=[0])
+    results = []
+    for data in data_loader:
+        with torch.no_grad():
+            results.extend(parallel_model(return_loss=False, rescale=True, compact=True, **data))
+    results2json(dataset, results, out_file)
+    coco = dataset.coco
+    if max_imgs is not None:
+        # evaluation()按coco.getImgIds()评估，只保留测试过的图片
+        coco.imgs = {i: coco.imgs[i] for i in dataset.img_ids}
+    stats = evaluation(out_file, coco, eval_types=['bbox'])
+    return stats['bbox'][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark anytime inference')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file')
+    parser.add_argument('--eval', action='store_true', help='evaluate coco mAP for each k')
+    parser.add_argument('--max-imgs', type=int, default=None, help='only evaluate first n imgs')
+    parser.add_argument('--imgs-per-gpu', type=int, default=8, help='batch size for evaluation')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    model = M2detDetector(cfg)
+    if args.checkpoint is not None:
+        from utils.checkpoint import load_checkpoint
+        load_checkpoint(model, args.checkpoint, map_location='cpu')
+    device = 'cpu' if args.cpu or not torch.cuda.is_available() else 'cuda'
+    model = model.to(device).eval()
+    if cfg.get('cudnn_benchmark', False):
+        torch.backends.cudnn.benchmark = True
+
+    img = torch.randn(1, 3, cfg.input_size, cfg.input_size, device=device)
+    rows = []
+    for k in range(1, cfg.model.neck.num_levels + 1):
+        model.set_active_levels(k)
+        latency = measure_latency(model, img, repeat=args.repeat)
+        mAP = None
+        if args.eval:
+            assert args.checkpoint is not None, 'need --checkpoint to evaluate mAP'
+            mAP = evaluate_map(model, cfg, args.max_imgs, imgs_per_gpu=args.imgs_per_gpu)
+        rows.append((k, latency, mAP))
+        print('k={} latency={:.1f}ms mAP={}'.format(
+            k, latency, '-' if mAP is None else '{:.3f}'.format(mAP)))
+    model.set_active_levels(None)
+
+    print('\n{:>4} {:>14} {:>8}'.format('k', 'latency(ms)', 'mAP'))
+    for k, latency, mAP in rows:
+        print('{:>4} {:>14.1f} {:>8}'.format(
+            k, latency, '-' if mAP is None else '{:.3f}'.format(mAP)))
+
+
+if __name__ == '__main__':
+    main()
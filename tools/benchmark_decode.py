@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bbox解码微基准: M2det512的32760个anchor，batch 16，对比delta2bbox和delta2bbox_fast
+(预先计算anchor的cx,cy,w,h，输出写入预先分配的buffer)的耗时，并检查两者结果一致
+用法:
+    python tools/benchmark_decode.py --batch 16
+    python tools/benchmark_decode.py --batch 16 --stds 0.1 0.1 0.2 0.2
+"""
+import argparse
+import os.path as osp
+import sys
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.anchor_generator import m2det_anchor_generators, grid_anchors_flat  # noqa: E402
+from utils.bbox_reg import delta2bbox, delta2bbox_fast, bbox2ctr_wh  # noqa: E402
+from benchmark_nms import timeit  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark bbox decoding')
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--means', type=float, nargs=4, default=[0., 0., 0., 0.])
+    parser.add_argument('--stds', type=float, nargs=4, default=[1., 1., 1., 1.])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    anchors = grid_anchors_flat(
+        m2det_anchor_generators(512, [8, 16, 32, 64, 100, 300],
+                                [0.06, 0.15, 0.33, 0.51, 0.69, 0.87, 1.05], [[2, 3]] * 6),
+        [(64, 64), (32, 32), (16, 16), (8, 8), (4, 4), (2, 2)], [8, 16, 32, 64, 100, 300])
+    deltas = torch.randn(args.batch, anchors.size(0), 4) * 0.5
+    max_shape = (512, 512)
+    print('anchors: {}, batch: {}'.format(anchors.size(0), args.batch))
+
+    def run_delta2bbox():
+        # 原接口只支持(n,4): anchor按batch重复后展开
+        return delta2bbox(anchors.repeat(args.batch, 1), deltas.view(-1, 4), args.means,
+                          args.stds, max_shape).view_as(deltas)
+
+    anchors_cwh = bbox2ctr_wh(anchors)
+    out = torch.empty_like(deltas)
+
+    def run_fast():
+        return delta2bbox_fast(anchors_cwh, deltas, args.means, args.stds, max_shape, out=out)
+
+    same = torch.equal(run_delta2bbox(), run_fast())
+    t_ref = timeit(run_delta2bbox, args.repeat)
+    t_fast = timeit(run_fast, args.repeat)
+    print('delta2bbox: {:.2f}ms, delta2bbox_fast: {:.2f}ms, speedup {:.2f}x, identical: {}'.format(
+        t_ref, t_fast, t_ref / t_fast, same))
+
+
+if __name__ == '__main__':
+    main()
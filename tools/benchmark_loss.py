@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+M2detHead hard negative mining loss微基准: 在M2det512的32760个anchor、81类上，用真实分配得到的target
+(每张图随机若干个gt)，对比逐张图的loss_single(multi_apply)和整个batch一起计算的loss_batch的耗时
+(前向+反向)，并检查两者的loss一致
+用法:
+    python tools/benchmark_loss.py --batch-sizes 2 4 8 16 32
+    python tools/benchmark_loss.py --device cuda --num-gts 50
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+from addict import Dict
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from model.m2det_head import M2detHead  # noqa: E402
+from utils.multi_apply import multi_apply  # noqa: E402
+
+
+def realistic_loss_inputs(head, cfg, num_images, input_size=512, num_gts=20, seed=0,
+                          device='cpu'):
+    """构造loss_single/loss_batch的输入: 随机gt经过anchor分配得到的target和随机的预测
+    Returns:
+        tuple: cls_scores (b, n, 81), bbox_preds (b, n, 4), labels (b, n), label_weights (b, n),
+            bbox_targets (b, n, 4), bbox_weights (b, n, 4), num_total_samples
+    """
+    g = torch.Generator().manual_seed(seed)
+    generator = head.anchor_target_generator(cfg)
+    img_meta = dict(img_shape=(input_size, input_size, 3), pad_shape=(input_size, input_size, 3))
+    targets = []
+    for _ in range(num_images):
+        ctr = torch.rand(num_gts, 2, generator=g) * input_size
+        wh = torch.rand(num_gts, 2, generator=g) * input_size * 0.4 + 16
+        gts = torch.cat([ctr - wh / 2, ctr + wh / 2], 1).clamp(0, input_size - 1)
+        gt_labels = torch.randint(1, head.num_classes, (num_gts, ), generator=g)
+        targets.append(generator(gts, gt_labels, img_meta))
+    labels, label_weights, bbox_targets, bbox_weights = [
+        torch.stack(t).to(device) for t in zip(*targets)]
+    num_anchors = labels.size(1)
+    cls_scores = torch.randn(num_images, num_anchors, head.num_classes, generator=g).to(device)
+    bbox_preds = torch.randn(num_images, num_anchors, 4, generator=g).to(device)
+    num_total_samples = int((labels > 0).sum(1).clamp(min=1).sum())
+    return (cls_scores, bbox_preds, labels, label_weights, bbox_targets, bbox_weights,
+            num_total_samples)
+
+
+def timeit(fn, repeat=10, warmup=2, device='cpu'):
+    for _ in range(warmup):
+        fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark hard negative mining loss')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[2, 4, 8, 16, 32])
+    parser.add_argument('--num-gts', type=int, default=20)
+    parser.add_argument('--input-size', type=int, default=512)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    head = M2detHead(input_size=args.input_size, planes=16, num_levels=2, num_classes=81)
+    cfg = Dict(assigner=dict(type='GridMaxIoUAssigner', pos_iou_thr=0.5, neg_iou_thr=0.5,
+                             min_pos_iou=0., ignore_iof_thr=-1, gt_max_assign_all=False),
+               smoothl1_beta=1., allowed_border=-1, pos_weight=-1, neg_pos_ratio=3)
+
+    print('{:>6} {:>14} {:>12} {:>8} {:>12}'.format(
+        'batch', 'loss_single', 'loss_batch', 'speedup', 'max rel err'))
+    for num_images in args.batch_sizes:
+        inputs = realistic_loss_inputs(head, cfg, num_images, args.input_size, args.num_gts,
+                                       device=args.device)
+        cls_scores, bbox_preds = inputs[:2]
+        cls_scores.requires_grad_(True)
+        bbox_preds.requires_grad_(True)
+
+        def per_image():
+            losses_cls, losses_reg = multi_apply(
+                head.loss_single, *inputs[:6], num_total_samples=inputs[6], cfg=cfg)
+            (sum(losses_cls) + sum(losses_reg).sum()).backward()
+            return losses_cls, losses_reg
+
+        def batched():
+            losses_cls, losses_reg = head.loss_batch(*inputs, cfg=cfg)
+            (sum(losses_cls) + sum(losses_reg).sum()).backward()
+            return losses_cls, losses_reg
+
+        err = 0.
+        for loss, ref in zip(batched(), per_image()):
+            for a, b in zip(loss, ref):
+                err = max(err, float(((a - b).abs() / b.abs().clamp(min=1e-12)).max()))
+        t_loop = timeit(per_image, args.repeat, device=args.device)
+        t_batched = timeit(batched, args.repeat, device=args.device)
+        print('{:>6} {:>12.2f}ms {:>10.2f}ms {:>7.2f}x {:>12.1e}'.format(
+            num_images, t_loop, t_batched, t_loop / t_batched, err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+multiclass_nms微基准: 在M2det512的32760个anchor、81类上构造接近真实分布的score
+(大部分anchor为背景，目标附近的anchor在对应类别上得分较高)，对比逐类别nms和batched nms
+的耗时，并检查两者输出一致；--backends对比单个类别n个框时各nms实现的耗时
+(包括网格索引的grid_nms跟cpu_nms的交叉点)；
+--soft在密集人群(每个目标几百个框)上对比cpu_soft_nms和torch_soft_nms；
+--threads测量多线程nms(nms_cfg.num_threads)在1到N个线程下的耗时
+用法:
+    python tools/benchmark_nms.py --score-thr 0.02 --num-objects 20
+    python tools/benchmark_nms.py --nms-type soft_nms
+    python tools/benchmark_nms.py --backends --sizes 100 1000 5000 20000
+    python tools/benchmark_nms.py --nms-type grid_nms --score-thr 0.01
+    python tools/benchmark_nms.py --soft --sizes 5000 10000
+    python tools/benchmark_nms.py --threads 1 2 4 8 --score-thr 0.01 --num-objects 100
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.anchor_generator import m2det_anchor_generators, grid_anchors_flat  # noqa: E402
+from utils.bbox_reg import delta2bbox  # noqa: E402
+from utils.iou import bbox_overlaps  # noqa: E402
+from utils.bbox_nms import multiclass_nms, multiclass_nms_per_class  # noqa: E402
+from utils.nms import nms_wrapper  # noqa: E402
+from utils.nms.torch_nms import torch_nms, torch_soft_nms, matrix_nms  # noqa: E402
+
+
+def realistic_nms_inputs(num_objects=20, num_classes=81, input_size=512, seed=0):
+    """构造multiclass_nms的输入
+    Returns:
+        bboxes(tensor): (32760, 4) 解码并裁剪后的bbox
+        scores(tensor): (32760, num_classes) softmax score, 第0列为背景
+    """
+    g = torch.Generator().manual_seed(seed)
+    anchors = grid_anchors_flat(
+        m2det_anchor_generators(input_size, [8, 16, 32, 64, 100, 300],
+                                [0.06, 0.15, 0.33, 0.51, 0.69, 0.87, 1.05],
+                                [[2, 3]] * 6),
+        [(64, 64), (32, 32), (16, 16), (8, 8), (4, 4), (2, 2)],
+        [8, 16, 32, 64, 100, 300])
+    num_anchors = anchors.size(0)
+    bboxes = delta2bbox(anchors, torch.randn(num_anchors, 4, generator=g) * 0.1,
+                        max_shape=(input_size, input_size))
+    # 随机目标: 中心和尺寸均匀分布
+    ctr = torch.rand(num_objects, 2, generator=g) * input_size
+    wh = torch.rand(num_objects, 2, generator=g) * input_size * 0.4 + 16
+    gts = torch.cat([ctr - wh / 2, ctr + wh / 2], 1).clamp(0, input_size - 1)
+    gt_labels = torch.randint(1, num_classes, (num_objects, ), generator=g)
+    logits = torch.randn(num_anchors, num_classes, generator=g)
+    logits[:, 0] += 6
+    ious = bbox_overlaps(bboxes, gts)
+    max_ious, argmax = ious.max(1)
+    pos = max_ious > 0.3
+    logits[pos.nonzero()[:, 0], gt_labels[argmax[pos]]] += 10 * max_ious[pos]
+    return bboxes, logits.softmax(-1)
+
+
+def timeit(fn, repeat=10, warmup=2):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def clustered_dets(num_bboxes, input_size=512, seed=0, bboxes_per_object=50):
+    """单个类别的n个框，围绕若干目标分布(互相重叠)，用于对比nms实现: (n,5)"""
+    g = torch.Generator().manual_seed(seed)
+    num_objects = max(num_bboxes // bboxes_per_object, 1)
+    ctr = torch.rand(num_objects, 2, generator=g) * input_size
+    ctr = ctr[torch.randint(0, num_objects, (num_bboxes, ), generator=g)]
+    ctr = ctr + torch.randn(num_bboxes, 2, generator=g) * 8
+    wh = torch.rand(num_bboxes, 2, generator=g) * input_size * 0.2 + 8
+    # score互不相同: 相同score的框在cpu_nms(numpy argsort)和torch_nms(稳定排序)中的顺序不同
+    scores = (torch.randperm(num_bboxes, generator=g).float() + 1) / num_bboxes
+    return torch.cat([ctr - wh / 2, ctr + wh / 2, scores[:, None]], 1)
+
+
+def benchmark_backends(sizes, iou_thr, repeat):
+    print('{:>8} {:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'n', 'cpu_nms', 'grid_nms', 'torch_nms', 'matrix_nms', 'exact'))
+    for n in sizes:
+        dets = clustered_dets(n)
+        _, inds = torch_nms(dets, iou_thr)
+        row = ['-', '-', '{:.2f}ms'.format(timeit(lambda: torch_nms(dets, iou_thr), repeat, 1)),
+               '{:.2f}ms'.format(timeit(lambda: matrix_nms(dets), repeat, 1)), '-']
+        if nms_wrapper.cpu_nms is not None:
+            keep = nms_wrapper.cpu_nms(dets.numpy(), iou_thr)
+            row[0] = '{:.2f}ms'.format(
+                timeit(lambda: nms_wrapper.cpu_nms(dets.numpy(), iou_thr), repeat, 1))
+            exact = inds.tolist() == list(keep)
+            if nms_wrapper.cpu_grid_nms is not None:
+                row[1] = '{:.2f}ms'.format(
+                    timeit(lambda: nms_wrapper.cpu_grid_nms(dets.numpy(), iou_thr), repeat, 1))
+                exact = exact and list(nms_wrapper.cpu_grid_nms(dets.numpy(), iou_thr)) == list(keep)
+            row[4] = str(exact)
+        print('{:>8} {:>10} {:>10} {:>12} {:>12} {:>8}'.format(n, *row))
+
+
+def benchmark_soft_nms(sizes, iou_thr, repeat):
+    """密集人群: 每个目标500个框"""
+    print('{:>8} {:>9} {:>14} {:>16} {:>8}'.format(
+        'n', 'method', 'cpu_soft_nms', 'torch_soft_nms', 'close'))
+    for n in sizes:
+        dets = clustered_dets(n, bboxes_per_object=500)
+        for method, code in (('linear', 1), ('gaussian', 2)):
+            new_dets, inds = torch_soft_nms(dets, iou_thr, method=method)
+            row = ['-', '{:.1f}ms'.format(timeit(
+                lambda: torch_soft_nms(dets, iou_thr, method=method), repeat, 0)), '-']
+            if nms_wrapper.cpu_soft_nms is not None:
+                def cpu_run():
+                    return nms_wrapper.cpu_soft_nms(dets.numpy().copy(), iou_thr, method=code)
+                ref_dets, ref_inds = cpu_run()
+                row[0] = '{:.1f}ms'.format(timeit(cpu_run, repeat, 0))
+                row[2] = str(inds.tolist() == list(ref_inds) and
+                             torch.allclose(new_dets, torch.from_numpy(ref_dets)))
+            print('{:>8} {:>9} {:>14} {:>16} {:>8}'.format(n, method, *row))
+
+
+def benchmark_threads(bboxes, scores, score_thr, iou_thr, threads, repeat):
+    """nms_multi(所有类别的候选框一次传入)在不同线程数下的耗时, 以第一个线程数为基准"""
+    backend = 'cpu_nms_multi' if nms_wrapper.cpu_nms_multi is not None else 'torch_nms thread pool'
+    print('backend: {}'.format(backend))
+    dets_list = [torch.cat([bboxes, scores[:, i:i + 1]], 1)[scores[:, i] > score_thr]
+                 for i in range(1, scores.size(1))]
+    ref_keeps = nms_wrapper.nms_multi(dets_list, iou_thr, num_threads=threads[0])
+    base = None
+    for num_threads in threads:
+        keeps = nms_wrapper.nms_multi(dets_list, iou_thr, num_threads=num_threads)
+        t = timeit(lambda: nms_wrapper.nms_multi(dets_list, iou_thr, num_threads=num_threads),
+                   repeat)
+        base = base or t
+        same = all(torch.equal(k, ref) for k, ref in zip(keeps, ref_keeps))
+        print('threads {:>3}: {:.2f}ms, speedup {:.2f}x, identical: {}'.format(
+            num_threads, t, base / t, same))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark multiclass nms')
+    parser.add_argument('--score-thr', type=float, default=0.02)
+    parser.add_argument('--iou-thr', type=float, default=0.45)
+    parser.add_argument('--nms-type', default='nms', help='nms/grid_nms/soft_nms')
+    parser.add_argument('--max-per-img', type=int, default=200)
+    parser.add_argument('--num-objects', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--backends', action='store_true', help='compare nms backends')
+    parser.add_argument('--soft', action='store_true', help='compare soft nms on dense crowds')
+    parser.add_argument('--threads', type=int, nargs='+', help='nms scaling over thread counts')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+    args = parser.parse_args()
+
+    if args.backends:
+        benchmark_backends(args.sizes, args.iou_thr, args.repeat)
+        return
+    if args.soft:
+        benchmark_soft_nms(args.sizes, args.iou_thr, args.repeat)
+        return
+
+    bboxes, scores = realistic_nms_inputs(args.num_objects)
+    nms_cfg = dict(type=args.nms_type, iou_thr=args.iou_thr)
+    num_candidates = int((scores[:, 1:] > args.score_thr).sum())
+    print('anchors: {}, candidates(score>{}): {}'.format(
+        bboxes.size(0), args.score_thr, num_candidates))
+    if args.threads:
+        benchmark_threads(bboxes, scores, args.score_thr, args.iou_thr, args.threads,
+                          args.repeat)
+        return
+
+    def run(fn):
+        return fn(bboxes, scores, args.score_thr, nms_cfg, args.max_per_img)
+
+    dets, labels = run(multiclass_nms)
+    ref_dets, ref_labels = run(multiclass_nms_per_class)
+    same = torch.equal(labels, ref_labels) and torch.allclose(dets, ref_dets)
+    print('detections: {}, identical to per class nms: {}'.format(dets.size(0), same))
+
+    t_loop = timeit(lambda: run(multiclass_nms_per_class), args.repeat)
+    t_batched = timeit(lambda: run(multiclass_nms), args.repeat)
+    print('per class: {:.2f}ms, batched: {:.2f}ms, speedup {:.2f}x'.format(
+        t_loop, t_batched, t_loop / t_batched))
+
+
+if __name__ == '__main__':
+    main()
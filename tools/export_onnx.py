@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+导出onnx模型(backbone->MLFPN->head conv, batch维度动态)，后处理见model.onnx_runner.OnnxM2detRunner
+用法:
+    python tools/export_onnx.py config/cfg_m2det512_vgg16_coco.py \
+        work_dirs/m2det512/latest.pth work_dirs/m2det512/m2det512.onnx --deploy --verify
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.config import Config  # noqa: E402
+from utils.checkpoint import load_checkpoint  # noqa: E402
+from model.m2det_detector import M2detDetector  # noqa: E402
+from model.inference_wrapper import M2detFeatureNet  # noqa: E402
+from model.onnx_runner import export_onnx, OnnxM2detRunner  # noqa: E402
+from dataset.class_names import get_classes  # noqa: E402
+
+
+def timeit(fn, repeat=10, warmup=2):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def verify(model, onnx_file, batch_size=2, num_threads=None):
+    """对比pytorch和onnxruntime的输出及cpu延时"""
+    feature_net = M2detFeatureNet(model).eval()
+    runner = OnnxM2detRunner(onnx_file, num_threads=num_threads)
+    size = model.cfg.input_size
+    img = torch.randn(batch_size, 3, size, size)
+    with torch.no_grad():
+        cls_scores, bbox_preds = feature_net(img)
+    onnx_cls_scores, onnx_bbox_preds = runner.run_network(img)
+    print('max abs diff: cls {:.2e}, reg {:.2e}'.format(
+        np.abs(onnx_cls_scores - cls_scores.numpy()).max(),
+        np.abs(onnx_bbox_preds - bbox_preds.numpy()).max()))
+
+    def run_torch():
+        with torch.no_grad():
+            feature_net(img)
+    print('batch {}: pytorch {:.1f}ms, onnxruntime {:.1f}ms'.format(
+        batch_size, timeit(run_torch), timeit(lambda: runner.run_network(img))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export m2det to onnx')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument('out', help='output .onnx file')
+    parser.add_argument('--deploy', action='store_true', help='fold bn before export')
+    parser.add_argument('--dataset', default='coco', help='dataset name for class names')
+    parser.add_argument('--opset', type=int, default=11)
+    parser.add_argument('--verify', action='store_true',
+                        help='compare outputs and cpu latency with pytorch')
+    args = parser.parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    model = M2detDetector(cfg)
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model.eval()
+    if args.deploy:
+        model.deploy()
+    export_onnx(model, args.out, class_names=get_classes(args.dataset),
+                opset_version=args.opset)
+    print('onnx model saved to {}'.format(args.out))
+    if args.verify:
+        verify(model, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+导出TorchScript推理模型(backbone->MLFPN->head->decode->nms)，可用于C++(libtorch)部署
+用法:
+    python tools/export_torchscript.py config/cfg_m2det512_vgg16_coco.py \
+        work_dirs/m2det512/latest.pth work_dirs/m2det512/m2det512.pt --deploy
+加载:
+    from model.inference_wrapper import load_torchscript
+    model, meta = load_torchscript('m2det512.pt')
+    dets, labels, num_dets = model(img, img_shapes, scale_factors)
+"""
+import argparse
+import os.path as osp
+import sys
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.config import Config  # noqa: E402
+from utils.checkpoint import load_checkpoint  # noqa: E402
+from model.m2det_detector import M2detDetector  # noqa: E402
+from model.inference_wrapper import export_torchscript  # noqa: E402
+from dataset.class_names import get_classes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export m2det to torchscript')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument('out', help='output .pt file')
+    parser.add_argument('--deploy', action='store_true', help='fold bn before export')
+    parser.add_argument('--dataset', default='coco', help='dataset name for class names')
+    parser.add_argument('--cuda', action='store_true', help='export on gpu')
+    args = parser.parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    model = M2detDetector(cfg)
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    if args.cuda:
+        model = model.cuda()
+    model.eval()
+    if args.deploy:
+        model.deploy()
+    with torch.no_grad():
+        export_torchscript(model, args.out, class_names=get_classes(args.dataset))
+    print('torchscript model saved to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
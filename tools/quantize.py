@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+int8训练后量化: 用test数据集的图片校准，导出TorchScript模型，并报告fp32/int8的cpu延时和mAP
+用法:
+    python tools/quantize.py config/cfg_m2det512_vgg16_coco.py \
+        work_dirs/m2det512/latest.pth work_dirs/m2det512/m2det512_int8.pt \
+        --num-calib 200 --eval --max-imgs 500
+加载:
+    from model.inference_wrapper import load_torchscript
+    model, meta = load_torchscript('m2det512_int8.pt')
+校准图片取自测试集末尾，评估取测试集开头，两者不重叠
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.config import Config  # noqa: E402
+from utils.checkpoint import load_checkpoint  # noqa: E402
+from utils.coco_eval import results2json, evaluation  # noqa: E402
+from utils.detections import Detections  # noqa: E402
+from model.m2det_detector import M2detDetector  # noqa: E402
+from model.inference_wrapper import M2detFeatureNet, build_inference_wrapper  # noqa: E402
+from model.quantization import coco_calib_imgs, export_quantized  # noqa: E402
+from dataset.coco_dataset import CocoDataset  # noqa: E402
+from dataset.utils import get_dataset  # noqa: E402
+
+
+def measure_latency(net, img, repeat=10, warmup=2):
+    with torch.no_grad():
+        for _ in range(warmup):
+            net(img)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            net(img)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def evaluate_wrapper(wrapper, dataset, num_classes, max_imgs, out_file):
+    """用推理模块(eager或TorchScript)在dataset前max_imgs张图上评估mAP@IoU=0.5:0.95"""
+    num_imgs = min(max_imgs, len(dataset))
+    results = []
+    for idx in range(num_imgs):
+        data = dataset[idx]
+        img = data['img'][0][None]
+        img_meta = data['img_meta'][0].data
+        h, w = img_meta['img_shape'][:2]
+        scale_factor = torch.tensor(img_meta['scale_factor'], dtype=torch.float32).view(1, -1)
+        with torch.no_grad():
+            dets, labels, num_dets = wrapper(img, torch.tensor([[float(h), float(w)]]),
+                                             scale_factor)
+        n = int(num_dets[0])
+        results.append(Detections.from_tensors(dets[0, :n], labels[0, :n], num_classes))
+    # len(dataset)跟img_infos一致, results2json按len(dataset)遍历
+    dataset.img_infos = dataset.img_infos[:num_imgs]
+    dataset.img_ids = dataset.img_ids[:num_imgs]
+    results2json(dataset, results, out_file)
+    coco = dataset.coco
+    coco.imgs = {i: coco.imgs[i] for i in dataset.img_ids}
+    return evaluation(out_file, coco, eval_types=['bbox'])['bbox'][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='int8 post training quantization')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument('out', help='output .pt file')
+    parser.add_argument('--num-calib', type=int, default=100, help='calibration imgs')
+    parser.add_argument('--backend', default='x86', help='x86/fbgemm/qnnpack')
+    parser.add_argument('--eval', action='store_true', help='report fp32/int8 mAP')
+    parser.add_argument('--max-imgs', type=int, default=500, help='imgs used for evaluation')
+    args = parser.parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    model = M2detDetector(cfg)
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model.eval()
+    dataset = get_dataset(cfg.data.test, CocoDataset)
+
+    calib_start = max(len(dataset) - args.num_calib, 0)
+    qwrapper = export_quantized(model, coco_calib_imgs(dataset, args.num_calib, calib_start),
+                                args.out, class_names=CocoDataset.CLASSES,
+                                backend=args.backend)
+    print('int8 model saved to {}'.format(args.out))
+
+    img = torch.randn(1, 3, cfg.input_size, cfg.input_size)
+    fp32_latency = measure_latency(M2detFeatureNet(model).eval(), img)
+    int8_latency = measure_latency(qwrapper.feature_net, img)
+    print('cpu latency(batch 1): fp32 {:.1f}ms, int8 {:.1f}ms, speedup {:.2f}x'.format(
+        fp32_latency, int8_latency, fp32_latency / int8_latency))
+
+    if args.eval:
+        num_classes = model.bbox_head.num_classes
+        fp32_map = evaluate_wrapper(build_inference_wrapper(model, script=False),
+                                    get_dataset(cfg.data.test, CocoDataset),
+                                    num_classes, args.max_imgs, 'fp32_results.json')
+        int8_map = evaluate_wrapper(qwrapper, get_dataset(cfg.data.test, CocoDataset),
+                                    num_classes, args.max_imgs, 'int8_results.json')
+        print('mAP: fp32 {:.3f}, int8 {:.3f}, delta {:+.3f}'.format(
+            fp32_map, int8_map, int8_map - fp32_map))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
+from collections import OrderedDict
+
+import numpy as np
 import torch
 
+from .bbox_reg import bbox2ctr_wh
+
 
 class AnchorGenerator(object):
 
@@ -50,7 +55,7 @@ class AnchorGenerator(object):
         else:
             return yy, xx
 
-    def grid_anchors(self, featmap_size, stride=16, device='cuda'):
+    def grid_anchors(self, featmap_size, stride=16, device='cpu'):
         base_anchors = self.base_anchors.to(device)
 
         feat_h, feat_w = featmap_size
@@ -69,7 +74,7 @@ class AnchorGenerator(object):
         # then (0, 1), (0, 2), ...
         return all_anchors
 
-    def valid_flags(self, featmap_size, valid_size, device='cuda'):
+    def valid_flags(self, featmap_size, valid_size, device='cpu'):
         feat_h, feat_w = featmap_size
         valid_h, valid_w = valid_size
         assert valid_h <= feat_h and valid_w <= feat_w
@@ -82,3 +87,120 @@ class AnchorGenerator(object):
         valid = valid[:, None].expand(
             valid.size(0), self.num_base_anchors).contiguous().view(-1)
         return valid
+
+
+def m2det_anchor_generators(input_size, anchor_strides, size_pattern, anchor_ratio_range):
+    """创建m2det每个level的anchor generator(M2detHead和onnx推理共用)
+    Args:
+        input_size(int): img size, 比如512
+        anchor_strides(list): (n_level,) 每个level的cell对应原图尺寸
+        size_pattern(list): (n_level+1,) anchor尺寸跟img的比例, 前n个为min_size比例，后n个为max_size比例
+        anchor_ratio_range(list): (n_level,) 比如[2,3]代表ratio=2,1/2,3,1/3
+    Returns:
+        anchor_generators(list): (n_level,) 每个generator有6个base anchors
+    """
+    min_sizes = [r * input_size for r in size_pattern[:-1]]
+    max_sizes = [r * input_size for r in size_pattern[1:]]
+    anchor_generators = []
+    for k in range(len(anchor_strides)):
+        base_size = min_sizes[k]
+        stride = anchor_strides[k]
+        ctr = ((stride - 1) / 2., (stride - 1) / 2.)
+        scales = [1., np.sqrt(max_sizes[k] / min_sizes[k])]  # 以base_size为第一个anchor，即scale=1
+        ratios = [1.]
+        for r in anchor_ratio_range[k]:
+            ratios += [1 / r, r]
+        # scales (2,) and ratios (5,), if scale_major=False, (1,5)*(2,1)->(2,5)*(2,5)->(2,5)
+        anchor_generator = AnchorGenerator(
+            base_size, scales, ratios, scale_major=False, ctr=ctr)
+        # for m2det, there are 6 anchors for each cells, no matter in any featmap cell
+        # 取前6个anchors(对应scale=1的5种ratios + scale=sqrt(max_size/min_size)的1种ratio)
+        anchor_generator.base_anchors = anchor_generator.base_anchors[:6]
+        anchor_generators.append(anchor_generator)
+    return anchor_generators
+
+
+def grid_anchors_flat(anchor_generators, featmap_sizes, anchor_strides, device='cpu'):
+    """按level -> (h, w) -> base anchor的顺序拼接所有anchors: (num_anchors, 4)"""
+    return torch.cat([
+        anchor_generators[i].grid_anchors(featmap_sizes[i], anchor_strides[i], device=device)
+        for i in range(len(featmap_sizes))], 0)
+
+
+class AnchorCache(object):
+    """多level anchor的缓存，anchor只在featmap_sizes/device/dtype第一次出现时生成:
+    1. get(): 所有level拼接后的anchors, 中心和宽高(cx,cy,w,h), 每个level的anchor数和起始位置
+    2. valid_flags(): 按pad_shape(以及img_shape/allowed_border)计算的有效anchor
+    同一个key返回同一个tensor，batch中所有图片共享，调用方不能原地修改
+    Args:
+        anchor_generators(list): (n_level,) AnchorGenerator
+        anchor_strides(list): (n_level,)
+        max_entries(int): 最多缓存的key数，超过时去掉最久没用的
+    """
+
+    def __init__(self, anchor_generators, anchor_strides, max_entries=32):
+        self.anchor_generators = anchor_generators
+        self.anchor_strides = anchor_strides
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    def _lookup(self, key, build):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = build()
+        self._cache[key] = value
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return value
+
+    def get(self, featmap_sizes, device='cpu', dtype=torch.float32):
+        """
+        Returns:
+            dict: anchors(N,4), anchors_cwh(N,4), num_level_anchors(list), level_offsets(list)
+        """
+        featmap_sizes = tuple(tuple(int(x) for x in size) for size in featmap_sizes)
+        device = torch.device(device)
+
+        def build():
+            anchors = grid_anchors_flat(self.anchor_generators, featmap_sizes,
+                                        self.anchor_strides, device=device).to(dtype)
+            num_level_anchors = [h * w * self.anchor_generators[i].num_base_anchors
+                                 for i, (h, w) in enumerate(featmap_sizes)]
+            return dict(anchors=anchors,
+                        anchors_cwh=bbox2ctr_wh(anchors),
+                        num_level_anchors=num_level_anchors,
+                        level_offsets=np.cumsum([0] + num_level_anchors).tolist())
+        return self._lookup(('anchors', featmap_sizes, device, dtype), build)
+
+    def valid_flags(self, featmap_sizes, pad_shape, img_shape=None, allowed_border=-1,
+                    device='cpu', dtype=torch.float32):
+        """pad_shape之外的cell上的anchor无效; allowed_border >= 0时跟anchor_inside_flags()一样
+        再去掉超出img_shape + allowed_border的anchor
+        Returns:
+            flags(tensor): (N,) bool
+        """
+        featmap_sizes = tuple(tuple(int(x) for x in size) for size in featmap_sizes)
+        pad_hw = tuple(int(x) for x in pad_shape[:2])
+        img_hw = None if img_shape is None or allowed_border < 0 else tuple(
+            int(x) for x in img_shape[:2])
+        device = torch.device(device)
+
+        def build():
+            flags = []
+            for i, (feat_h, feat_w) in enumerate(featmap_sizes):
+                stride = self.anchor_strides[i]
+                valid_h = min(int(np.ceil(pad_hw[0] / stride)), feat_h)
+                valid_w = min(int(np.ceil(pad_hw[1] / stride)), feat_w)
+                flags.append(self.anchor_generators[i].valid_flags(
+                    (feat_h, feat_w), (valid_h, valid_w), device=device).bool())
+            flags = torch.cat(flags)
+            if img_hw is not None:
+                anchors = self.get(featmap_sizes, device, dtype)['anchors']
+                flags &= (anchors[:, 0] >= -allowed_border) & \
+                    (anchors[:, 1] >= -allowed_border) & \
+                    (anchors[:, 2] < img_hw[1] + allowed_border) & \
+                    (anchors[:, 3] < img_hw[0] + allowed_border)
+            return flags
+        return self._lookup(('flags', featmap_sizes, pad_hw, img_hw, allowed_border, device,
+                             dtype), build)
@@ -2,7 +2,8 @@ import torch
 import numpy as np
 
 from .multi_apply import multi_apply
-from .iou import bbox_overlaps
+from .iou import bbox_overlaps, batched_bbox_overlaps
+from .anchor_generator import AnchorCache
 
 class MaxIoUAssigner():
     """Assign a corresponding gt bbox or background to each bbox.
@@ -25,6 +26,8 @@ class MaxIoUAssigner():
         ignore_iof_thr (float): IoF threshold for ignoring bboxes (if
             `gt_bboxes_ignore` is specified). Negative values mean not
             ignoring any bboxes.
+        chunk_size (int): >0时按anchor分块计算iou, 只保留每个anchor/每个gt的max，
+            不生成完整的(k, n) iou, 峰值内存跟gt数量无关. 结果跟一次计算完全一致
     """
 
     def __init__(self,
@@ -32,12 +35,14 @@ class MaxIoUAssigner():
                  neg_iou_thr,
                  min_pos_iou=.0,
                  gt_max_assign_all=True,
-                 ignore_iof_thr=-1):
+                 ignore_iof_thr=-1,
+                 chunk_size=-1):
         self.pos_iou_thr = pos_iou_thr
         self.neg_iou_thr = neg_iou_thr
         self.min_pos_iou = min_pos_iou
         self.gt_max_assign_all = gt_max_assign_all
         self.ignore_iof_thr = ignore_iof_thr
+        self.chunk_size = chunk_size
 
     def assign(self, bboxes, gt_bboxes, gt_bboxes_ignore=None, gt_labels=None):
         """Assign gt to bboxes.
@@ -68,6 +73,16 @@ class MaxIoUAssigner():
         if bboxes.shape[0] == 0 or gt_bboxes.shape[0] == 0:
             raise ValueError('No gt or bboxes')
         bboxes = bboxes[:, :4]
+        if self.chunk_size > 0:
+            assert gt_bboxes_ignore is None or self.ignore_iof_thr <= 0, \
+                'gt_bboxes_ignore is not supported with chunk_size'
+            stats = max_overlaps_chunked(gt_bboxes[None], bboxes, self.chunk_size,
+                                         with_matches=self.gt_max_assign_all)
+            gt_valid = gt_bboxes.new_ones((1, gt_bboxes.size(0)), dtype=torch.bool)
+            result = self.assign_wrt_max_overlaps(
+                *stats, gt_valid, gt_labels[None] if gt_labels is not None else None)
+            return AssignResult(gt_bboxes.size(0), result.gt_inds[0], result.max_overlaps[0],
+                                labels=result.labels[0] if gt_labels is not None else None)
         overlaps = bbox_overlaps(gt_bboxes, bboxes) # (m,n) m is gt row_num, n is anchor row_num
 
         if (self.ignore_iof_thr > 0) and (gt_bboxes_ignore is not None) and (
@@ -144,6 +159,69 @@ class MaxIoUAssigner():
         return AssignResult(
             num_gts, assigned_gt_inds, max_overlaps, labels=assigned_labels)
 
+    def assign_wrt_max_overlaps(self, max_overlaps, argmax_overlaps, gt_max_overlaps,
+                                gt_argmax_overlaps, matches, gt_valid, gt_labels=None):
+        """根据max_overlaps_chunked()的统计量分配(b张图), 跟assign_wrt_overlaps()一致，
+        每个gt的最佳anchor用scatter代替逐个gt的循环
+
+        Args:
+            max_overlaps (Tensor): (b, n); argmax_overlaps (Tensor): (b, n)
+            gt_max_overlaps (Tensor): (b, k); gt_argmax_overlaps (Tensor): (b, k)
+            matches (tuple): iou等于每个gt的max的(img_inds, gt_inds, anchor_inds),
+                gt_max_assign_all=True时需要
+            gt_valid (Tensor): (b, k) bool
+            gt_labels (Tensor, optional): (b, k)
+
+        Returns:
+            :obj:`AssignResult`: num_gts (b,), gt_inds/max_overlaps/labels (b, n)
+        """
+        num_imgs, num_bboxes = max_overlaps.shape
+        num_gts = gt_max_overlaps.size(1)
+
+        # 1. assign -1 by default
+        assigned_gt_inds = max_overlaps.new_full((num_imgs, num_bboxes), -1, dtype=torch.long)
+
+        # 2. assign negative: below
+        if isinstance(self.neg_iou_thr, float):
+            assigned_gt_inds[(max_overlaps >= 0)
+                             & (max_overlaps < self.neg_iou_thr)] = 0
+        elif isinstance(self.neg_iou_thr, tuple):
+            assert len(self.neg_iou_thr) == 2
+            assigned_gt_inds[(max_overlaps >= self.neg_iou_thr[0])
+                             & (max_overlaps < self.neg_iou_thr[1])] = 0
+
+        # 3. assign positive: above positive IoU threshold
+        pos_inds = max_overlaps >= self.pos_iou_thr
+        assigned_gt_inds[pos_inds] = argmax_overlaps[pos_inds] + 1
+
+        # 4. assign fg: for each gt, proposals with highest IoU
+        # 逐gt循环时后面的gt覆盖前面的，所以一个anchor被多个gt选中时取序号最大的gt
+        gt_ok = gt_valid & (gt_max_overlaps >= self.min_pos_iou)
+        best_gt = assigned_gt_inds.new_zeros((num_imgs, num_bboxes))
+        if self.gt_max_assign_all:
+            img_inds, gt_inds, anchor_inds = matches
+            keep = gt_ok[img_inds, gt_inds]
+            best_gt.view(-1).scatter_reduce_(
+                0, img_inds[keep] * num_bboxes + anchor_inds[keep], gt_inds[keep] + 1, 'amax')
+        else:
+            gt_ids = torch.arange(1, num_gts + 1, device=max_overlaps.device).expand(
+                num_imgs, -1)
+            best_gt.scatter_reduce_(
+                1, gt_argmax_overlaps, torch.where(gt_ok, gt_ids, torch.zeros_like(gt_ids)),
+                'amax')
+        assigned_gt_inds = torch.where(best_gt > 0, best_gt, assigned_gt_inds)
+
+        if gt_labels is not None:
+            assigned_labels = torch.where(
+                assigned_gt_inds > 0,
+                gt_labels.gather(1, (assigned_gt_inds - 1).clamp(min=0)),
+                assigned_gt_inds.new_zeros(()))
+        else:
+            assigned_labels = None
+
+        return AssignResult(
+            gt_valid.sum(1), assigned_gt_inds, max_overlaps, labels=assigned_labels)
+
 
 class AssignResult(object):
 
@@ -163,6 +241,246 @@ class AssignResult(object):
             self.labels = torch.cat([gt_labels, self.labels])
 
 
+class BatchedMaxIoUAssigner(MaxIoUAssigner):
+    """一个batch的所有图片一次分配: gt padding到(b, G_max, 4)并给出有效mask，iou一次计算
+    (chunk_size > 0时按anchor分块)，每个gt的最佳anchor用scatter代替逐个gt的循环.
+    每张图的结果跟MaxIoUAssigner一致(ignore_iof_thr不支持)
+    """
+
+    def assign(self, bboxes, gt_bboxes, gt_valid, gt_labels=None, bbox_valid=None):
+        """
+        Args:
+            bboxes (Tensor): 所有图片共享的anchors, shape (n, 4)
+            gt_bboxes (Tensor): shape (b, k, 4), padding的gt由gt_valid标出
+            gt_valid (Tensor): shape (b, k) bool
+            gt_labels (Tensor, optional): shape (b, k)
+            bbox_valid (Tensor, optional): shape (b, n) bool, 无效的anchor不参与分配(-1)
+
+        Returns:
+            :obj:`AssignResult`: num_gts (b,), gt_inds/max_overlaps/labels (b, n)
+        """
+        if bboxes.shape[0] == 0 or not gt_valid.any(1).all():
+            raise ValueError('No gt or bboxes')
+        stats = max_overlaps_chunked(gt_bboxes, bboxes[:, :4], self.chunk_size, gt_valid,
+                                     bbox_valid, with_matches=self.gt_max_assign_all)
+        return self.assign_wrt_max_overlaps(*stats, gt_valid, gt_labels)
+
+
+class GridMaxIoUAssigner(MaxIoUAssigner):
+    """利用anchor的网格结构剪枝的MaxIoUAssigner: anchor在每个level上是规则网格(每个cell有A个形状)，
+    iou >= T(T = min(neg_iou_thr下限, pos_iou_thr))的anchor的形状跟gt相近、中心在gt附近，
+    按level/形状/cell范围直接算出每个gt的候选anchor，只计算这些(gt, anchor)的iou，其余anchor的iou < T.
+    候选中max iou < T的gt改为跟所有anchor计算. 分配结果(gt_inds/labels)跟MaxIoUAssigner完全一致，
+    被剪掉的anchor的max_overlaps为0
+
+    Args:
+        anchor_generators (list): 每个level的AnchorGenerator
+        featmap_sizes (list): 每个level的(h, w)
+        anchor_strides (list): 每个level的stride
+        其余参数同MaxIoUAssigner(ignore_iof_thr不支持)
+    """
+
+    def __init__(self, anchor_generators, featmap_sizes, anchor_strides, **kwargs):
+        kwargs.pop('chunk_size', None)
+        super(GridMaxIoUAssigner, self).__init__(**kwargs)
+        # 每种anchor形状(level, k)一行: x1, y1, x2, y2, stride, feat_w, feat_h, 第(0, 0)个cell的序号, A
+        shapes = []
+        offset = 0
+        for generator, (feat_h, feat_w), stride in zip(anchor_generators, featmap_sizes,
+                                                       anchor_strides):
+            base_anchors = generator.base_anchors.double()
+            num_base = base_anchors.size(0)
+            for k in range(num_base):
+                shapes.append(base_anchors[k].tolist() +
+                              [stride, feat_w, feat_h, offset + k, num_base])
+            offset += int(feat_h) * int(feat_w) * num_base
+        self.anchor_shapes = torch.tensor(shapes, dtype=torch.float64)
+        self.num_anchors = offset
+
+    @property
+    def prune_thr(self):
+        neg_thr = self.neg_iou_thr[0] if isinstance(self.neg_iou_thr, tuple) else self.neg_iou_thr
+        return min(neg_thr, self.pos_iou_thr)
+
+    def candidates(self, gt_bboxes, thr):
+        """每个gt可能跟它iou >= thr的anchor(多取一圈cell，保证不漏)
+        Returns:
+            gt_inds (Tensor), anchor_inds (Tensor): (m,)的(gt, anchor)对
+        """
+        device = gt_bboxes.device
+        shapes = self.anchor_shapes.to(device)
+        bx1, by1, bx2, by2, stride = [shapes[None, :, i] for i in range(5)]
+        feat_w, feat_h, offset, num_base = [shapes[:, i].long() for i in range(5, 9)]
+        gt_bboxes = gt_bboxes.double()
+        gx1, gy1, gx2, gy2 = [gt_bboxes[:, i:i + 1] for i in range(4)]
+        gw, gh = gx2 - gx1 + 1, gy2 - gy1 + 1
+        bw, bh = bx2 - bx1 + 1, by2 - by1 + 1
+        # (num_gts, num_shapes), 留出浮点误差的余量
+        thr = thr * (1 - 1e-3)
+        max_areas = torch.max(gw * gh, bw * bh)
+        # iou <= min(area) / max(area), 形状相差太大的直接去掉
+        ok = torch.min(gw * gh, bw * bh) >= thr * max_areas
+        # 交集的宽至少为thr * max(area) / min(h), 由此得到anchor平移(cell)的范围
+        need_w = thr * max_areas / torch.min(gh, bh)
+        need_h = thr * max_areas / torch.min(gw, bw)
+        x0 = (torch.ceil((gx1 - bx2 - 1 + need_w) / stride).long() - 1).clamp(min=0)
+        x1 = torch.min(torch.floor((gx2 - bx1 + 1 - need_w) / stride).long() + 1, feat_w - 1)
+        y0 = (torch.ceil((gy1 - by2 - 1 + need_h) / stride).long() - 1).clamp(min=0)
+        y1 = torch.min(torch.floor((gy2 - by1 + 1 - need_h) / stride).long() + 1, feat_h - 1)
+        nx = (x1 - x0 + 1).clamp(min=0)
+        ny = (y1 - y0 + 1).clamp(min=0)
+        counts = (nx * ny * ok).view(-1)
+        # 每个(gt, 形状)的矩形cell范围展开成(gt, anchor)对
+        pair_inds = torch.repeat_interleave(torch.arange(counts.numel(), device=device), counts)
+        local = torch.arange(pair_inds.numel(), device=device) - \
+            (torch.cumsum(counts, 0) - counts)[pair_inds]
+        num_shapes = shapes.size(0)
+        gt_inds, shape_inds = pair_inds // num_shapes, pair_inds % num_shapes
+        nx = nx.view(-1)[pair_inds]
+        xs = x0.view(-1)[pair_inds] + local % nx
+        ys = y0.view(-1)[pair_inds] + local // nx
+        anchor_inds = offset[shape_inds] + (ys * feat_w[shape_inds] + xs) * num_base[shape_inds]
+        return gt_inds, anchor_inds
+
+    def assign(self, bboxes, gt_bboxes, gt_bboxes_ignore=None, gt_labels=None, bbox_valid=None):
+        """
+        Args:
+            bboxes (Tensor): 所有level拼接后的anchors(grid_anchors_flat()的顺序), shape (n, 4)
+            gt_bboxes (Tensor): shape (k, 4)
+            gt_labels (Tensor, optional): shape (k, )
+            bbox_valid (Tensor, optional): shape (n, ) bool, 无效的anchor不参与分配(-1)
+
+        Returns:
+            :obj:`AssignResult`: gt_inds/max_overlaps/labels (n, )
+        """
+        assert gt_bboxes_ignore is None or self.ignore_iof_thr <= 0, \
+            'gt_bboxes_ignore is not supported by GridMaxIoUAssigner'
+        if bboxes.shape[0] == 0 or gt_bboxes.shape[0] == 0:
+            raise ValueError('No gt or bboxes')
+        num_gts, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
+        assert num_bboxes == self.num_anchors, 'bboxes should be all grid anchors'
+        bboxes = bboxes[:, :4]
+        if bbox_valid is None:
+            bbox_valid = torch.ones(num_bboxes, dtype=torch.bool, device=bboxes.device)
+        thr = self.prune_thr
+        if thr <= 0:
+            # 没法剪枝
+            overlaps = bbox_overlaps(gt_bboxes, bboxes)
+            overlaps[:, ~bbox_valid] = -1
+            return self.assign_wrt_overlaps(overlaps, gt_labels)
+
+        gt_inds, anchor_inds = self.candidates(gt_bboxes, thr)
+        keep = bbox_valid[anchor_inds]
+        gt_inds, anchor_inds = gt_inds[keep], anchor_inds[keep]
+        ious = bbox_overlaps(gt_bboxes[gt_inds], bboxes[anchor_inds], is_aligned=True) \
+            if gt_inds.numel() > 0 else bboxes.new_zeros(0)
+        gt_max_overlaps = bboxes.new_full((num_gts, ), -1).scatter_reduce(
+            0, gt_inds, ious, 'amax')
+        # 候选中的max < thr的gt(形状特殊的小gt): 真正的max可能不在候选中，跟所有有效anchor计算
+        dense_gts = torch.nonzero(gt_max_overlaps < thr).squeeze(1)
+        if dense_gts.numel() > 0:
+            keep = ~torch.isin(gt_inds, dense_gts)
+            valid_inds = torch.nonzero(bbox_valid).squeeze(1)
+            dense_ious = bbox_overlaps(gt_bboxes[dense_gts], bboxes[valid_inds])
+            gt_inds = torch.cat([gt_inds[keep], dense_gts.repeat_interleave(valid_inds.numel())])
+            anchor_inds = torch.cat([anchor_inds[keep], valid_inds.repeat(dense_gts.numel())])
+            ious = torch.cat([ious[keep], dense_ious.view(-1)])
+            gt_max_overlaps = bboxes.new_full((num_gts, ), -1).scatter_reduce(
+                0, gt_inds, ious, 'amax')
+
+        # 每个anchor的max(没有候选的anchor为0)和argmax(相同iou取序号小的gt，跟dense一致)
+        max_overlaps = bboxes.new_zeros(num_bboxes).scatter_reduce(0, anchor_inds, ious, 'amax')
+        is_max = ious == max_overlaps[anchor_inds]
+        argmax_overlaps = torch.full((num_bboxes, ), num_gts, dtype=torch.long,
+                                     device=bboxes.device).scatter_reduce(
+            0, anchor_inds[is_max], gt_inds[is_max], 'amin')
+        max_overlaps[~bbox_valid] = -1
+        # 每个gt的argmax: 相同iou取序号小的anchor
+        is_gt_max = ious == gt_max_overlaps[gt_inds]
+        gt_argmax_overlaps = torch.full((num_gts, ), num_bboxes, dtype=torch.long,
+                                        device=bboxes.device).scatter_reduce(
+            0, gt_inds[is_gt_max], anchor_inds[is_gt_max], 'amin')
+        matches = (torch.zeros_like(gt_inds[is_gt_max]), gt_inds[is_gt_max],
+                   anchor_inds[is_gt_max])
+        result = self.assign_wrt_max_overlaps(
+            max_overlaps[None], argmax_overlaps.clamp(max=num_gts - 1)[None],
+            gt_max_overlaps[None], gt_argmax_overlaps.clamp(max=num_bboxes - 1)[None], matches,
+            torch.ones((1, num_gts), dtype=torch.bool, device=bboxes.device),
+            gt_labels[None] if gt_labels is not None else None)
+        return AssignResult(num_gts, result.gt_inds[0], result.max_overlaps[0],
+                            labels=result.labels[0] if gt_labels is not None else None)
+
+
+def max_overlaps_chunked(gt_bboxes, bboxes, chunk_size=-1, gt_valid=None, bbox_valid=None,
+                         with_matches=False):
+    """按anchor分块计算iou，只保留分配需要的统计量，不保存完整的(b, k, n) iou.
+    max/argmax的结果跟对完整iou计算一致(argmax取第一个最大值)
+
+    Args:
+        gt_bboxes (Tensor): shape (b, k, 4)
+        bboxes (Tensor): shape (n, 4)
+        chunk_size (int): 每块的anchor数, <=0时一次计算
+        gt_valid (Tensor, optional): (b, k) bool, padding的gt的iou为-1
+        bbox_valid (Tensor, optional): (b, n) bool, 无效的anchor的iou为-1
+        with_matches (bool): 是否返回iou等于每个gt的max的所有anchor
+
+    Returns:
+        tuple: max_overlaps (b, n), argmax_overlaps (b, n), gt_max_overlaps (b, k),
+            gt_argmax_overlaps (b, k), matches (img_inds, gt_inds, anchor_inds)或None
+    """
+    num_imgs, num_gts = gt_bboxes.shape[:2]
+    num_bboxes = bboxes.size(0)
+    if chunk_size <= 0:
+        chunk_size = num_bboxes
+    max_overlaps = gt_bboxes.new_empty((num_imgs, num_bboxes))
+    argmax_overlaps = max_overlaps.new_empty((num_imgs, num_bboxes), dtype=torch.long)
+    gt_max_overlaps = gt_bboxes.new_full((num_imgs, num_gts), -2)
+    gt_argmax_overlaps = gt_max_overlaps.new_zeros((num_imgs, num_gts), dtype=torch.long)
+    matches = None
+    gt_invalid = None if gt_valid is None or gt_valid.all() else ~gt_valid[:, :, None]
+    for start in range(0, num_bboxes, chunk_size):
+        end = min(start + chunk_size, num_bboxes)
+        overlaps = batched_bbox_overlaps(gt_bboxes, bboxes[start:end])  # (b, k, c)
+        if gt_invalid is not None:
+            overlaps.masked_fill_(gt_invalid, -1)
+        if bbox_valid is not None:
+            chunk_valid = bbox_valid[:, start:end]
+            if not chunk_valid.all():
+                overlaps.masked_fill_(~chunk_valid[:, None, :], -1)
+        max_overlaps[:, start:end], argmax_overlaps[:, start:end] = overlaps.max(dim=1)
+        # 前面的块中的最大值优先(跟一次计算的argmax一致)
+        chunk_max, chunk_argmax = overlaps.max(dim=2)
+        better = chunk_max > gt_max_overlaps
+        gt_max_overlaps = torch.where(better, chunk_max, gt_max_overlaps)
+        gt_argmax_overlaps = torch.where(better, chunk_argmax + start, gt_argmax_overlaps)
+        if with_matches:
+            # 只保留可能成为最终max的(img, gt, anchor)，已有的候选中小于当前max的去掉.
+            # iou<=0的不记录(否则还没遇到重叠anchor的gt会保留整块)，最终max为0的gt最后单独处理
+            img_inds, gt_inds, anchor_inds = (
+                (overlaps == gt_max_overlaps[:, :, None]) & (overlaps > 0)).nonzero(as_tuple=True)
+            chunk_matches = (img_inds, gt_inds, anchor_inds + start,
+                             gt_max_overlaps[img_inds, gt_inds])
+            if matches is not None:
+                keep = matches[3] == gt_max_overlaps[matches[0], matches[1]]
+                chunk_matches = tuple(torch.cat([m[keep], c])
+                                      for m, c in zip(matches, chunk_matches))
+            matches = chunk_matches
+    if with_matches:
+        keep = matches[3] == gt_max_overlaps[matches[0], matches[1]]
+        matches = [m[keep] for m in matches[:3]]
+        for img_ind, gt_ind in (gt_max_overlaps == 0).nonzero().tolist():
+            # 跟所有anchor都不重叠的gt(很少见): 所有iou为0的有效anchor都是max
+            zero_mask = bbox_overlaps(gt_bboxes[img_ind, gt_ind:gt_ind + 1], bboxes)[0] == 0
+            if bbox_valid is not None:
+                zero_mask &= bbox_valid[img_ind]
+            anchor_inds = zero_mask.nonzero().squeeze(1)
+            matches[0] = torch.cat([matches[0], torch.full_like(anchor_inds, img_ind)])
+            matches[1] = torch.cat([matches[1], torch.full_like(anchor_inds, gt_ind)])
+            matches[2] = torch.cat([matches[2], anchor_inds])
+        matches = tuple(matches)
+    return max_overlaps, argmax_overlaps, gt_max_overlaps, gt_argmax_overlaps, matches
+
+
 class RandomSampler():
     """随机采样：用在faster rcnn(随机从所有样本中采样指定数量个样本，且保证正样本比例)"""
     def __init__(self,
@@ -370,19 +688,24 @@ def anchor_target(anchor_list,
                   gt_labels_list=None,
                   label_channels=1,
                   sampling=True,
-                  unmap_outputs=True):
+                  unmap_outputs=True,
+                  num_level_anchors=None,
+                  assigner=None):
     """用于从anchor list中指定anchor身份，采样(包括提取pos_inds, neg_inds)，
     并把bbox转换成delta用于回归，以及生成label_weight, bbox_weight为loss计算准备
     Compute regression and classification targets for anchors.
 
     Args:
         anchor_list (list[list]): Multi level anchors of each image.
+            给定num_level_anchors时为每张图所有level拼接后的(N,4) anchors(可以是同一个tensor)
         valid_flag_list (list[list]): Multi level valid flags of each image.
+            给定num_level_anchors时为每张图拼接后的(N,) flags
         gt_bboxes_list (list[Tensor]): Ground truth bboxes of each image.
         img_metas (list[dict]): Meta info of each image.
         target_means (Iterable): Mean value of regression targets.
         target_stds (Iterable): Std value of regression targets.
         cfg (dict): RPN train configs.
+        assigner (GridMaxIoUAssigner, optional): 代替cfg.assigner构造的MaxIoUAssigner(sampling=False时)
 
     Returns:
         tuple
@@ -390,13 +713,14 @@ def anchor_target(anchor_list,
     num_imgs = len(img_metas)
     assert len(anchor_list) == len(valid_flag_list) == num_imgs
 
-    # anchor number of multi levels
-    num_level_anchors = [anchors.size(0) for anchors in anchor_list[0]]
-    # concat all level anchors and flags to a single tensor
-    for i in range(num_imgs):
-        assert len(anchor_list[i]) == len(valid_flag_list[i])
-        anchor_list[i] = torch.cat(anchor_list[i])
-        valid_flag_list[i] = torch.cat(valid_flag_list[i])
+    if num_level_anchors is None:
+        # anchor number of multi levels
+        num_level_anchors = [anchors.size(0) for anchors in anchor_list[0]]
+        # concat all level anchors and flags to a single tensor
+        for i in range(num_imgs):
+            assert len(anchor_list[i]) == len(valid_flag_list[i])
+            anchor_list[i] = torch.cat(anchor_list[i])
+            valid_flag_list[i] = torch.cat(valid_flag_list[i])
 
     # compute targets for each image
     if gt_labels_list is None:
@@ -414,7 +738,8 @@ def anchor_target(anchor_list,
          cfg=cfg,
          label_channels=label_channels,
          sampling=sampling,
-         unmap_outputs=unmap_outputs)
+         unmap_outputs=unmap_outputs,
+         assigner=assigner)
     # no valid anchors
     if any([labels is None for labels in all_labels]):
         return None
@@ -430,6 +755,89 @@ def anchor_target(anchor_list,
             bbox_weights_list, num_total_pos, num_total_neg)
 
 
+def pad_gt_list(gt_bboxes_list, gt_labels_list=None):
+    """每张图的gt padding成一个batch
+    Returns:
+        gt_bboxes (Tensor): (b, G_max, 4)
+        gt_labels (Tensor): (b, G_max), gt_labels_list为None时为None
+        gt_valid (Tensor): (b, G_max) bool
+    """
+    num_imgs = len(gt_bboxes_list)
+    num_gts = [gt.size(0) for gt in gt_bboxes_list]
+    max_num_gts = max(num_gts)
+    gt_bboxes = gt_bboxes_list[0].new_zeros((num_imgs, max_num_gts, 4))
+    gt_labels = None
+    if gt_labels_list is not None:
+        gt_labels = gt_labels_list[0].new_zeros((num_imgs, max_num_gts))
+    gt_valid = torch.arange(max_num_gts, device=gt_bboxes.device)[None, :] < \
+        gt_bboxes.new_tensor(num_gts, dtype=torch.long)[:, None]
+    for i in range(num_imgs):
+        gt_bboxes[i, :num_gts[i]] = gt_bboxes_list[i]
+        if gt_labels is not None:
+            gt_labels[i, :num_gts[i]] = gt_labels_list[i]
+    return gt_bboxes, gt_labels, gt_valid
+
+
+def anchor_target_batched(anchors,
+                          valid_flag_list,
+                          gt_bboxes,
+                          gt_valid,
+                          img_metas,
+                          target_means,
+                          target_stds,
+                          cfg,
+                          gt_labels=None):
+    """anchor_target(sampling=False)的batch版本: 所有图片一次完成BatchedMaxIoUAssigner分配和target计算，
+    没有逐张图和逐gt的循环. 每张图的结果跟anchor_target_single(unmap_outputs=True)一致
+
+    Args:
+        anchors (Tensor): 所有图片共享的所有level拼接后的anchors, shape (n, 4)
+        valid_flag_list (list[Tensor]): 每张图的valid flags (n,)
+        gt_bboxes (Tensor): (b, G_max, 4), 见pad_gt_list()
+        gt_valid (Tensor): (b, G_max) bool
+        img_metas (list[dict]): Meta info of each image.
+        cfg (dict): train cfg
+        gt_labels (Tensor, optional): (b, G_max)
+
+    Returns:
+        tuple: labels (b, n), label_weights (b, n), bbox_targets (b, n, 4),
+            bbox_weights (b, n, 4), num_total_pos, num_total_neg
+    """
+    inside_flags = torch.stack([
+        anchor_inside_flags(anchors, valid_flags, img_meta['img_shape'][:2],
+                            cfg.allowed_border)
+        for valid_flags, img_meta in zip(valid_flag_list, img_metas)])
+    if not inside_flags.any(1).all():
+        return None
+    assign_args = cfg.assigner.copy()
+    assign_args.pop('type')
+    assign_result = BatchedMaxIoUAssigner(**assign_args).assign(
+        anchors, gt_bboxes, gt_valid, gt_labels, inside_flags)
+
+    pos = assign_result.gt_inds > 0
+    neg = assign_result.gt_inds == 0
+    if gt_labels is None:
+        labels = pos.long()
+    else:
+        labels = assign_result.labels
+    label_weights = anchors.new_zeros(pos.shape, dtype=torch.float)
+    label_weights[pos] = 1.0 if cfg.pos_weight <= 0 else cfg.pos_weight
+    label_weights[neg] = 1.0
+
+    bbox_targets = anchors.new_zeros(pos.shape + (4, ))
+    bbox_weights = anchors.new_zeros(pos.shape + (4, ))
+    img_inds, anchor_inds = pos.nonzero(as_tuple=True)
+    if img_inds.numel() > 0:
+        pos_gt_bboxes = gt_bboxes[img_inds, assign_result.gt_inds[img_inds, anchor_inds] - 1]
+        bbox_targets[img_inds, anchor_inds] = bbox2delta(
+            anchors[anchor_inds], pos_gt_bboxes, target_means, target_stds)
+        bbox_weights[img_inds, anchor_inds] = 1.0
+    num_total_pos = int(pos.sum(1).clamp(min=1).sum())
+    num_total_neg = int(neg.sum(1).clamp(min=1).sum())
+    return (labels, label_weights, bbox_targets, bbox_weights, num_total_pos,
+            num_total_neg)
+
+
 def images_to_levels(target, num_level_anchors):
     """Convert targets by image to targets by feature level.
 
@@ -455,7 +863,8 @@ def anchor_target_single(flat_anchors,
                          cfg,
                          label_channels=1,
                          sampling=True,
-                         unmap_outputs=True):
+                         unmap_outputs=True,
+                         assigner=None):
     
     inside_flags = anchor_inside_flags(flat_anchors, valid_flags,
                                        img_meta['img_shape'][:2],
@@ -469,12 +878,20 @@ def anchor_target_single(flat_anchors,
         assign_result, sampling_result = assign_and_sample(
             anchors, gt_bboxes, None, None, cfg)
     else:        # 如果不采样(比如ssd通过后边hard negtive mining解决样本不平衡而不是通过采样)
-#        bbox_assigner = build_assigner(cfg.assigner)
-        assign_args = cfg.assigner.copy()
-        assign_args.pop('type')
-        bbox_assigner = MaxIoUAssigner(**assign_args)
-        assign_result = bbox_assigner.assign(anchors, gt_bboxes, None,
-                                             gt_labels)
+        if isinstance(assigner, GridMaxIoUAssigner):
+            # 网格剪枝需要所有anchor, 结果再取出inside的部分
+            grid_result = assigner.assign(flat_anchors, gt_bboxes, None, gt_labels, inside_flags)
+            assign_result = AssignResult(
+                grid_result.num_gts, grid_result.gt_inds[inside_flags],
+                grid_result.max_overlaps[inside_flags],
+                labels=grid_result.labels[inside_flags] if gt_labels is not None else None)
+        else:
+#            bbox_assigner = build_assigner(cfg.assigner)
+            assign_args = cfg.assigner.copy()
+            assign_args.pop('type')
+            bbox_assigner = MaxIoUAssigner(**assign_args)
+            assign_result = bbox_assigner.assign(anchors, gt_bboxes, None,
+                                                 gt_labels)
         bbox_sampler = PseudoSampler()
         sampling_result = bbox_sampler.sample(assign_result, anchors,
                                               gt_bboxes)
@@ -507,18 +924,70 @@ def anchor_target_single(flat_anchors,
     # map up to original set of anchors
     if unmap_outputs:
         num_total_anchors = flat_anchors.size(0)
-        labels = unmap(labels, num_total_anchors, inside_flags)
-        label_weights = unmap(label_weights, num_total_anchors, inside_flags)
+        # 所有anchor都有效时unmap不改变结果
+        if num_valid_anchors < num_total_anchors:
+            labels = unmap(labels, num_total_anchors, inside_flags)
+            label_weights = unmap(label_weights, num_total_anchors, inside_flags)
+            bbox_targets = unmap(bbox_targets, num_total_anchors, inside_flags)
+            bbox_weights = unmap(bbox_weights, num_total_anchors, inside_flags)
         if label_channels > 1:
             labels, label_weights = expand_binary_labels(
                 labels, label_weights, label_channels)
-        bbox_targets = unmap(bbox_targets, num_total_anchors, inside_flags)
-        bbox_weights = unmap(bbox_weights, num_total_anchors, inside_flags)
 
     return (labels, label_weights, bbox_targets, bbox_weights, pos_inds,
             neg_inds)
 
 
+class AnchorTargetGenerator(object):
+    """在dataset中(DataLoader worker进程里)计算单张图的anchor target, 结果跟head.loss()中
+    anchor_target()的一致. target跟图片一起collate, loss直接使用，分配和target的计算跟模型的前向/反向
+    并行，不再占用训练的时间
+    Args:
+        anchor_generators (list): 每个level的AnchorGenerator
+        featmap_sizes (list): 每个level的(h, w)
+        anchor_strides (list): 每个level的stride
+        target_means (Iterable): Mean value of regression targets.
+        target_stds (Iterable): Std value of regression targets.
+        cfg (dict): train cfg, assigner为GridMaxIoUAssigner时用网格剪枝分配
+    """
+
+    def __init__(self, anchor_generators, featmap_sizes, anchor_strides, target_means,
+                 target_stds, cfg):
+        self.anchor_cache = AnchorCache(anchor_generators, anchor_strides)
+        self.featmap_sizes = [tuple(int(x) for x in s) for s in featmap_sizes]
+        self.target_means = target_means
+        self.target_stds = target_stds
+        self.cfg = cfg
+        self.assigner = None
+        if cfg.assigner.get('type') == 'GridMaxIoUAssigner':
+            assign_args = cfg.assigner.copy()
+            assign_args.pop('type')
+            self.assigner = GridMaxIoUAssigner(anchor_generators, featmap_sizes, anchor_strides,
+                                               **assign_args)
+
+    def __call__(self, gt_bboxes, gt_labels, img_meta):
+        """
+        Args:
+            gt_bboxes (Tensor): (k, 4)
+            gt_labels (Tensor): (k, )
+            img_meta (dict): img_shape, pad_shape
+        Returns:
+            tuple: labels (n, ), label_weights (n, ), bbox_targets (n, 4), bbox_weights (n, 4),
+                没有有效anchor时为None
+        """
+        anchors = self.anchor_cache.get(self.featmap_sizes)['anchors']
+        valid_flags = self.anchor_cache.valid_flags(
+            self.featmap_sizes, img_meta['pad_shape'], img_meta['img_shape'],
+            self.cfg.allowed_border)
+        targets = anchor_target_single(anchors, valid_flags, gt_bboxes.float(), gt_labels,
+                                       img_meta, self.target_means, self.target_stds, self.cfg,
+                                       sampling=False, unmap_outputs=True,
+                                       assigner=self.assigner)
+        if targets[0] is None:
+            return None
+        return targets[:4]
+
+
 def unmap(data, count, inds, fill=0):
     """ Unmap a subset of item (data) back to the original set of items (of
     size count) """
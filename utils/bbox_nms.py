@@ -1,28 +1,133 @@
 import torch
-from nms import nms_wrapper
 import numpy as np
 
+
+def get_nms_op(nms_type):
+    """nms_wrapper依赖编译的nms扩展，用到时再导入"""
+    from .nms import nms_wrapper
+    return getattr(nms_wrapper, nms_type)
+
+
+def batched_nms(bboxes, scores, labels, nms_cfg):
+    """不同类别的bbox加上按类别的偏移(互不重叠)后，一次nms调用完成所有类别的nms.
+    逐个比较的nms代价是O(n^2)，cpu上框的总数超过nms_cfg.split_thr时这一次nms改用网格索引的
+    cpu_grid_nms: 加了偏移的不同类别的框落在不同的网格中，互相不会比较，代价接近O(n log n).
+    没有编译cpu_grid_nms时(nms退回到torch_nms)才按类别排序后对每个类别的连续片段分别nms.
+    type='nms'且nms_cfg.num_threads > 1时，各个类别的nms通过nms_multi在多个线程中并行执行
+    Args:
+        bboxes (Tensor): shape (n, 4)
+        scores (Tensor): shape (n, )
+        labels (Tensor): shape (n, ) 类别序号
+        nms_cfg (dict): dict(type='nms'/'grid_nms'/'soft_nms'/'torch_nms'/'matrix_nms', iou_thr,
+            split_thr(可选), num_threads(可选), ...)
+
+    Returns:
+        tuple: (dets, keep), dets (k, 5)为nms之后的bbox和score(soft_nms时为衰减后的score),
+            keep (k, )为保留的bbox序号
+    """
+    nms_cfg_ = nms_cfg.copy()
+    nms_type = nms_cfg_.pop('type', 'nms')
+    split_thr = nms_cfg_.pop('split_thr', 2000)
+    num_threads = nms_cfg_.pop('num_threads', 1)
+    if nms_type == 'nms' and num_threads > 1:
+        _, order = labels.sort(stable=True)
+        groups = [inds for inds in order.split(torch.bincount(labels).tolist())
+                  if inds.numel() > 0]
+        dets = torch.cat([bboxes, scores[:, None]], dim=1)
+        keeps = get_nms_op('nms_multi')([dets[inds] for inds in groups],
+                                        num_threads=num_threads, **nms_cfg_)
+        keep = torch.cat([inds[cls_keep] for inds, cls_keep in zip(groups, keeps)])
+        return dets[keep], keep
+    nms_op = get_nms_op(nms_type)
+    if nms_type in ('torch_nms', 'soft_nms', 'matrix_nms'):
+        # 纯tensor实现直接按类别分组，不需要坐标偏移
+        dets, keep = nms_op(torch.cat([bboxes, scores[:, None]], dim=1), groups=labels,
+                            **nms_cfg_)
+        return dets, keep
+    if bboxes.shape[0] > split_thr and not bboxes.is_cuda:
+        if get_nms_op('cpu_grid_nms') is None:
+            return _per_class_nms(bboxes, scores, labels, nms_op, nms_cfg_)
+        nms_op = get_nms_op('grid_nms')
+    # 偏移量大于所有bbox的坐标范围，保证不同类别的bbox的iou为0
+    offsets = labels.to(bboxes.dtype) * (bboxes.max() - bboxes.min() + 2)
+    dets, keep = nms_op(
+        torch.cat([bboxes + offsets[:, None], scores[:, None]], dim=1), **nms_cfg_)
+    return torch.cat([bboxes[keep], dets[:, 4:]], dim=1), keep
+
+
+def _per_class_nms(bboxes, scores, labels, nms_op, nms_cfg):
+    """按类别排序后对每个类别的连续片段分别nms，输出同batched_nms()"""
+    _, order = labels.sort(stable=True)
+    dets_list, keep_list = [], []
+    for inds in order.split(torch.bincount(labels).tolist()):
+        if inds.numel() == 0:
+            continue
+        cls_dets, cls_keep = nms_op(
+            torch.cat([bboxes[inds], scores[inds, None]], dim=1), **nms_cfg)
+        dets_list.append(cls_dets)
+        keep_list.append(inds[cls_keep])
+    return torch.cat(dets_list), torch.cat(keep_list)
+
+
 def multiclass_nms(multi_bboxes, multi_scores, score_thr, nms_cfg, max_num=-1):
     """NMS for multi-class bboxes.
+    所有(bbox, class)对一次性按score_thr筛选，通过batched_nms()一次完成所有类别的nms，
+    输出跟逐类别nms(multiclass_nms_per_class)一致
 
     Args:
         multi_bboxes (Tensor): shape (n, #class*4) or (n, 4)
         multi_scores (Tensor): shape (n, #class)
         score_thr (float): bbox threshold, bboxes with scores lower than it
             will not be considered.
-        nms_thr (float): NMS IoU threshold
+        nms_cfg (dict): dict(type='nms'/'grid_nms'/'soft_nms'/'torch_nms'/'matrix_nms', iou_thr,
+            num_threads(可选, >1时多线程nms), ...)
         max_num (int): if there are more than max_num bboxes after NMS,
-            only top max_num will be kept.
+            only top max_num will be kept. -1 means keep all.
 
     Returns:
-        tuple: (bboxes, labels), tensors of shape (k, 5) and (k, 1). Labels
-            are 0-based.
+        tuple: (bboxes, labels), tensors of shape (k, 5) and (k, ). Labels
+            are 0-based. 不超过max_num时按类别排列(同一类别内score降序)，
+            否则按score降序
+    """
+    num_classes = multi_scores.shape[1]
+    scores = multi_scores[:, 1:]
+    valid_mask = scores > score_thr
+    # nonzero按行优先排列，跟scores[valid_mask]的顺序一致
+    anchor_inds, labels = valid_mask.nonzero().unbind(1)
+    if multi_bboxes.shape[1] == 4:
+        bboxes = multi_bboxes[anchor_inds]
+    else:
+        bboxes = multi_bboxes.view(-1, num_classes, 4)[anchor_inds, labels + 1]
+    return candidate_nms(bboxes, scores[valid_mask], labels, nms_cfg, max_num)
+
+
+def candidate_nms(bboxes, scores, labels, nms_cfg, max_num=-1):
+    """对已经按score_thr筛选过的(bbox, class)候选做nms，输出同multiclass_nms()
+    Args:
+        bboxes (Tensor): shape (k, 4)
+        scores (Tensor): shape (k, )
+        labels (Tensor): shape (k, ) 0-based类别
     """
+    if bboxes.shape[0] == 0:
+        return bboxes.new_zeros((0, 5)), bboxes.new_zeros((0, ), dtype=torch.long)
+    dets, keep = batched_nms(bboxes, scores, labels, nms_cfg)
+    labels = labels[keep]
+
+    if 0 < max_num < dets.shape[0]:
+        _, inds = dets[:, -1].topk(max_num)
+    else:
+        # 稳定排序，同一类别内保持nms的输出顺序(score降序)
+        _, inds = labels.sort(stable=True)
+    return dets[inds], labels[inds]
+
+
+def multiclass_nms_per_class(multi_bboxes, multi_scores, score_thr, nms_cfg, max_num=-1):
+    """逐类别做nms的实现(原multiclass_nms)，作为batched版本的参照，参数和输出同multiclass_nms()"""
     num_classes = multi_scores.shape[1]
     bboxes, labels = [], []
     nms_cfg_ = nms_cfg.copy()
     nms_type = nms_cfg_.pop('type', 'nms')
-    nms_op = getattr(nms_wrapper, nms_type)
+    nms_op = get_nms_op(nms_type)
     
     for i in range(1, num_classes):
         cls_inds = multi_scores[:, i] > score_thr
@@ -43,7 +148,7 @@ def multiclass_nms(multi_bboxes, multi_scores, score_thr, nms_cfg, max_num=-1):
     if bboxes:
         bboxes = torch.cat(bboxes)
         labels = torch.cat(labels)
-        if bboxes.shape[0] > max_num:
+        if 0 < max_num < bboxes.shape[0]:
             _, inds = bboxes[:, -1].sort(descending=True)
             inds = inds[:max_num]
             bboxes = bboxes[inds]
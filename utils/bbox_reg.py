@@ -36,33 +36,84 @@ def delta2bbox(rois,
                stds=[1, 1, 1, 1],
                max_shape=None,
                wh_ratio_clip=16 / 1000):
-    means = deltas.new_tensor(means).repeat(1, deltas.size(1) // 4)
-    stds = deltas.new_tensor(stds).repeat(1, deltas.size(1) // 4)
-    denorm_deltas = deltas * stds + means
-    dx = denorm_deltas[:, 0::4]
-    dy = denorm_deltas[:, 1::4]
-    dw = denorm_deltas[:, 2::4]
-    dh = denorm_deltas[:, 3::4]
-    max_ratio = np.abs(np.log(wh_ratio_clip))
-    dw = dw.clamp(min=-max_ratio, max=max_ratio)
-    dh = dh.clamp(min=-max_ratio, max=max_ratio)
-    px = ((rois[:, 0] + rois[:, 2]) * 0.5).unsqueeze(1).expand_as(dx)
-    py = ((rois[:, 1] + rois[:, 3]) * 0.5).unsqueeze(1).expand_as(dy)
-    pw = (rois[:, 2] - rois[:, 0] + 1.0).unsqueeze(1).expand_as(dw)
-    ph = (rois[:, 3] - rois[:, 1] + 1.0).unsqueeze(1).expand_as(dh)
-    gw = pw * dw.exp()
-    gh = ph * dh.exp()
-    gx = torch.addcmul(px, 1, pw, dx)  # gx = px + pw * dx
-    gy = torch.addcmul(py, 1, ph, dy)  # gy = py + ph * dy
-    x1 = gx - gw * 0.5 + 0.5
-    y1 = gy - gh * 0.5 + 0.5
-    x2 = gx + gw * 0.5 - 0.5
-    y2 = gy + gh * 0.5 - 0.5
+    max_ratio = float(np.abs(np.log(wh_ratio_clip)))
+    # (n, 4*k) -> (n, k, 4), 每组4个delta对应同一个roi
+    bboxes = delta2bbox_script(rois[:, None, :], deltas.reshape(deltas.size(0), -1, 4),
+                               deltas.new_tensor(means), deltas.new_tensor(stds), max_ratio)
+    if max_shape is not None:
+        bboxes[..., 0::2].clamp_(min=0, max=max_shape[1] - 1)
+        bboxes[..., 1::2].clamp_(min=0, max=max_shape[0] - 1)
+    return bboxes.view_as(deltas)
+
+
+def bbox2ctr_wh(rois):
+    """anchor预先转换成delta2bbox_fast()用的(cx, cy, w, h), 计算跟delta2bbox()一致
+    Args:
+        rois(tensor): (..., 4) x1,y1,x2,y2
+    Returns:
+        (..., 4) cx,cy,w,h
+    """
+    return torch.cat([(rois[..., :2] + rois[..., 2:]) * 0.5,
+                      rois[..., 2:] - rois[..., :2] + 1.0], dim=-1)
+
+
+def delta2bbox_fast(anchors_cwh,
+                    deltas,
+                    means=[0, 0, 0, 0],
+                    stds=[1, 1, 1, 1],
+                    max_shape=None,
+                    wh_ratio_clip=16 / 1000,
+                    out=None):
+    """同delta2bbox()，结果一致: x,y和w,h成对计算并直接写入out，中间只有两个(..., 2)的临时tensor,
+    means/stds为0/1时跳过反归一化
+    Args:
+        anchors_cwh(tensor): (N, 4) or (B, N, 4) bbox2ctr_wh()的结果
+        deltas(tensor): (N, 4) or (B, N, 4)
+        max_shape(tuple): (h, w, ...) 裁剪到[0, w-1]/[0, h-1]
+        out(tensor): 可选，跟deltas形状相同的输出buffer
+    Returns:
+        bboxes(tensor): 跟deltas形状相同, x1,y1,x2,y2
+    """
+    if out is None:
+        out = torch.empty_like(deltas)
+    if tuple(means) != (0, 0, 0, 0) or tuple(stds) != (1, 1, 1, 1):
+        deltas = deltas * deltas.new_tensor(stds) + deltas.new_tensor(means)
+    max_ratio = float(np.abs(np.log(wh_ratio_clip)))
+    # half_wh = pw * exp(dw) * 0.5, ctr = px + pw * dx
+    half_wh = deltas[..., 2:].clamp(min=-max_ratio, max=max_ratio).exp_()
+    half_wh.mul_(anchors_cwh[..., 2:]).mul_(0.5)
+    ctr = torch.addcmul(anchors_cwh[..., :2], anchors_cwh[..., 2:], deltas[..., :2])
+    torch.sub(ctr, half_wh, out=out[..., :2]).add_(0.5)
+    torch.add(ctr, half_wh, out=out[..., 2:]).sub_(0.5)
     if max_shape is not None:
-        x1 = x1.clamp(min=0, max=max_shape[1] - 1)
-        y1 = y1.clamp(min=0, max=max_shape[0] - 1)
-        x2 = x2.clamp(min=0, max=max_shape[1] - 1)
-        y2 = y2.clamp(min=0, max=max_shape[0] - 1)
-    bboxes = torch.stack([x1, y1, x2, y2], dim=-1).view_as(deltas)
-    return bboxes
+        out[..., 0::2].clamp_(min=0, max=max_shape[1] - 1)
+        out[..., 1::2].clamp_(min=0, max=max_shape[0] - 1)
+    return out
+
 
+def delta2bbox_script(rois, deltas, means, stds, max_ratio: float):
+    """delta2bbox()的解码计算(不裁剪)，可以torch.jit.script，推理模块(inference_wrapper)也用它解码
+    Args:
+        rois(tensor): (..., 4) x1,y1,x2,y2, 可以跟deltas广播
+        deltas(tensor): (..., 4)
+        means(tensor): (4, )
+        stds(tensor): (4, )
+        max_ratio(float): dw/dh裁剪到[-max_ratio, max_ratio]
+    Returns:
+        bboxes(tensor): (..., 4) x1,y1,x2,y2
+    """
+    deltas = deltas * stds + means
+    dx = deltas[..., 0]
+    dy = deltas[..., 1]
+    dw = deltas[..., 2].clamp(min=-max_ratio, max=max_ratio)
+    dh = deltas[..., 3].clamp(min=-max_ratio, max=max_ratio)
+    px = (rois[..., 0] + rois[..., 2]) * 0.5
+    py = (rois[..., 1] + rois[..., 3]) * 0.5
+    pw = rois[..., 2] - rois[..., 0] + 1.0
+    ph = rois[..., 3] - rois[..., 1] + 1.0
+    gw = pw * dw.exp()
+    gh = ph * dh.exp()
+    gx = torch.addcmul(px, pw, dx)  # gx = px + pw * dx
+    gy = torch.addcmul(py, ph, dy)  # gy = py + ph * dy
+    return torch.stack([gx - gw * 0.5 + 0.5, gy - gh * 0.5 + 0.5,
+                        gx + gw * 0.5 - 0.5, gy + gh * 0.5 - 0.5], dim=-1)
@@ -42,6 +42,8 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 from terminaltables import AsciiTable
 
+from utils.detections import Detections
+
 #import _pickle as pickle
 """注意cPickle, Pickle, six.moves的区别：
 1. cPickle是c代码写成，Pickle是python写成，相比之下cPickle更快
@@ -257,6 +259,55 @@ def print_recall_summary(recalls,
     table = AsciiTable(table_data)
     print(table.table)
 
+def xyxy2xywh(bbox):
+    _bbox = bbox.tolist()
+    return [
+        _bbox[0],
+        _bbox[1],
+        _bbox[2] - _bbox[0] + 1,
+        _bbox[3] - _bbox[1] + 1,
+    ]
+
+
+def results2json(dataset, results, out_file):
+    """把detector.simple_test()的输出转换成coco api要求的json格式并保存
+    Args:
+        dataset(obj): CocoDataset, 需要img_ids/cat_ids
+        results(list): (n_img,) with (n_class-1,) with (n,5), 或(n_img,) with Detections
+        out_file(str): .json file
+    """
+    json_results = []
+    for idx in range(len(dataset)):
+        img_id = dataset.img_ids[idx]
+        result = results[idx]
+        if isinstance(result, Detections):
+            json_results.extend(detections2json(result, img_id, dataset.cat_ids))
+            continue
+        for label in range(len(result)):
+            bboxes = result[label]
+            for i in range(bboxes.shape[0]):
+                data = dict()
+                data['image_id'] = img_id
+                data['bbox'] = xyxy2xywh(bboxes[i])
+                data['score'] = float(bboxes[i][4])
+                data['category_id'] = dataset.cat_ids[label]
+                json_results.append(data)
+    with open(out_file, 'w') as f:
+        json.dump(json_results, f)
+
+
+def detections2json(dets, img_id, cat_ids):
+    """一张图的Detections批量转换成coco json格式的dict, 顺序跟按类别list一致(类别内保持原顺序)"""
+    order = np.argsort(dets.labels, kind='stable')
+    boxes = dets.boxes[order].astype(np.float64)
+    boxes[:, 2:] -= boxes[:, :2] - 1
+    cat_ids = np.asarray(cat_ids)[dets.labels[order]].tolist()
+    return [dict(image_id=img_id, bbox=bbox, score=score, category_id=cat_id)
+            for bbox, score, cat_id in zip(boxes.tolist(),
+                                           dets.scores[order].astype(np.float64).tolist(),
+                                           cat_ids)]
+
+
 def evaluation(result_file_path, coco_obj, eval_types = ['bbox']):
     """基于已经生成好的pkl或json模型预测结果文件，进行相关操作:
     Args:
@@ -264,7 +315,7 @@ def evaluation(result_file_path, coco_obj, eval_types = ['bbox']):
         coco_obj(obj): coco object belong to COCO class
         eval_types(list): ['proposal_fast', 'bbox', 'proposal']
     Return:
-        None
+        stats(dict): {res_type: cocoEval.stats} (proposal_fast时为None)
     假定result.pkl已经获得则可按如下进行评估，但实际的test forward()计算过程如下
     在detector的forward_test()函数中, 内部调用simple_test()
         - 从backbone/neck获得x: 从img(1,3,800, 1216)到x[(1,256,200,304),(1,256,100,152),(1,256,50,76),(1,256,25,38),(1,256,13,39)]
@@ -345,6 +396,7 @@ def evaluation(result_file_path, coco_obj, eval_types = ['bbox']):
             img_ids = coco.getImgIds()
             # 定义iou_type: 在coco中iou_type = ['bbox','segm', 'keypoints']三种选择，物体检测需要选bbox
             # 区别eval_types: proposals, bbox
+            stats = {}
             for res_type in eval_types:
                 if res_type == 'proposal':
                     iou_type = 'bbox'
@@ -359,6 +411,8 @@ def evaluation(result_file_path, coco_obj, eval_types = ['bbox']):
                 cocoEval.evaluate()     # 对每一张图片分别评估，耗时较长(1)
                 cocoEval.accumulate()   # 
                 cocoEval.summarize()    # 结果中AP@IoU=0.5:0.95为0.364，跟faster rcnn披露出来的box AP一致
+                stats[res_type] = cocoEval.stats  # stats[0]即mAP@IoU=0.5:0.95
+            return stats
 
 
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+紧凑的检测结果: 一张图的所有检测框存成一个(K,4)的boxes、(K,)的scores和(K,)的labels，
+代替bbox2result输出的按类别的list(80个小array)，评估5000张图时内存和pickle的开销小得多；
+需要旧格式时用to_list()转换(结果缓存)，或直接调用向量化的bbox2result()
+"""
+import numpy as np
+import torch
+
+
+def bbox2result(bboxes, labels, num_classes):
+    """把检测结果转换成按类别的list: 一次稳定排序后按每个类别的个数切分，
+    每个类别内的顺序跟逐类别bboxes[labels == i]一致
+    Args:
+        bboxes(tensor/ndarray): (n,5)
+        labels(tensor/ndarray): (n,) 类别序号, 不包括背景(从0开始)
+        num_classes(int): 类别数, 包括背景
+    Returns:
+        list(ndarray): (num_classes-1,) with (n_i,5) float32
+    """
+    if isinstance(bboxes, torch.Tensor):
+        bboxes = bboxes.detach().cpu().numpy()
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+    labels = np.asarray(labels).reshape(-1)
+    if bboxes.shape[0] == 0:
+        return [np.zeros((0, 5), dtype=np.float32) for _ in range(num_classes - 1)]
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=num_classes - 1)[:num_classes - 1]
+    return np.split(bboxes[order], np.cumsum(counts))[:num_classes - 1]
+
+
+class Detections(object):
+    """一张图的检测结果
+    Args:
+        boxes(ndarray): (K,4) float32, x1,y1,x2,y2
+        scores(ndarray): (K,) float32
+        labels(ndarray): (K,) int64, 类别序号, 不包括背景(从0开始)
+        num_classes(int): 类别数, 包括背景
+    """
+    __slots__ = ('boxes', 'scores', 'labels', 'num_classes', '_list')
+
+    def __init__(self, boxes, scores, labels, num_classes):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        self.num_classes = num_classes
+        self._list = None
+
+    @classmethod
+    def from_tensors(cls, det_bboxes, det_labels, num_classes):
+        """从get_bboxes()的输出构造
+        Args:
+            det_bboxes(tensor): (k,5)
+            det_labels(tensor): (k,)
+        """
+        det_bboxes = det_bboxes.detach().cpu().numpy()
+        return cls(det_bboxes[:, :4], det_bboxes[:, 4], det_labels.detach().cpu().numpy(),
+                   num_classes)
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def __repr__(self):
+        return '{}(num_dets={}, num_classes={})'.format(
+            self.__class__.__name__, len(self), self.num_classes)
+
+    @property
+    def dets(self):
+        """(K,5)的bbox和score"""
+        return np.concatenate([self.boxes, self.scores[:, None]], axis=1)
+
+    def to_list(self):
+        """旧格式: (num_classes-1,) with (n_i,5)，第一次调用时转换"""
+        if self._list is None:
+            self._list = bbox2result(self.dets, self.labels, self.num_classes)
+        return self._list
+
+    def __getstate__(self):
+        # 缓存的旧格式不参与pickle
+        return self.boxes, self.scores, self.labels, self.num_classes
+
+    def __setstate__(self, state):
+        self.boxes, self.scores, self.labels, self.num_classes = state
+        self._list = None
+
+
+def as_result_list(result):
+    """Detections或旧格式的按类别list统一转换成按类别list"""
+    return result.to_list() if isinstance(result, Detections) else result
@@ -62,3 +62,29 @@ def bbox_overlaps(bboxes1, bboxes2, mode='iou', is_aligned=False):
             ious = overlap / (area1[:, None])
 
     return ious
+
+
+def batched_bbox_overlaps(bboxes1, bboxes2):
+    """一个batch的iou一次计算，结果跟bbox_overlaps完全相同(逐元素的计算顺序一致)，
+    x/y分开计算并且原地操作，不产生[b, m, n, 2]的中间结果
+    Args:
+        bboxes1 (Tensor): shape (b, m, 4)
+        bboxes2 (Tensor): shape (n, 4)所有图片共享, 或(b, n, 4)
+    Returns:
+        ious(Tensor): shape (b, m, n)
+    """
+    if bboxes2.dim() == 2:
+        bboxes2 = bboxes2[None]
+    b1 = bboxes1[..., :, None, :]   # (b, m, 1, 4)
+    b2 = bboxes2[..., None, :, :]   # (b or 1, 1, n, 4)
+    w = torch.min(b1[..., 2], b2[..., 2])
+    w.sub_(torch.max(b1[..., 0], b2[..., 0])).add_(1).clamp_(min=0)
+    h = torch.min(b1[..., 3], b2[..., 3])
+    h.sub_(torch.max(b1[..., 1], b2[..., 1])).add_(1).clamp_(min=0)
+    overlap = w.mul_(h)
+    area1 = (bboxes1[..., 2] - bboxes1[..., 0] + 1) * (
+        bboxes1[..., 3] - bboxes1[..., 1] + 1)   # (b, m)
+    area2 = (bboxes2[..., 2] - bboxes2[..., 0] + 1) * (
+        bboxes2[..., 3] - bboxes2[..., 1] + 1)   # (b or 1, n)
+    union = (area1[..., None] + area2[..., None, :]).sub_(overlap)
+    return overlap.div_(union)
@@ -0,0 +1,107 @@
+# --------------------------------------------------------
+# 空间网格索引的cpu nms: 按坐标把框放进均匀网格，保留一个框时只检查跟它在同一网格中的框，
+# 候选框很多(score_thr很低)时比逐个比较的cpu_nms快，结果跟cpu_nms完全一致
+# --------------------------------------------------------
+
+cimport cython
+
+import numpy as np
+cimport numpy as np
+
+cdef inline np.float32_t _max(np.float32_t a, np.float32_t b) nogil:
+    return a if a >= b else b
+
+cdef inline np.float32_t _min(np.float32_t a, np.float32_t b) nogil:
+    return a if a <= b else b
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cpu_grid_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh, double cell_size=0):
+    """
+    Args:
+        dets(ndarray): (n,5) float32
+        thresh(float): iou阈值
+        cell_size(float): 网格大小, <=0时取框的平均边长
+    Returns:
+        list: 保留的框的序号(按score降序), 跟cpu_nms一致
+    """
+    cdef Py_ssize_t n = dets.shape[0]
+    if n == 0:
+        return []
+    # 排序和面积的计算跟cpu_nms一致，相同score的框顺序也一致
+    order = dets[:, 4].argsort()[::-1]
+    if thresh <= 0:
+        # 任意两个框的iou >= 0
+        return [order[0]]
+    sorted_dets = np.ascontiguousarray(dets[order, :4])
+    cdef np.float32_t[:, ::1] boxes = sorted_dets
+    cdef np.float32_t[::1] areas = np.ascontiguousarray(
+        (sorted_dets[:, 2] - sorted_dets[:, 0] + 1) * (sorted_dets[:, 3] - sorted_dets[:, 1] + 1))
+
+    # 框覆盖[x1, x2 + 1)，iou > 0的两个框至少共享一个网格
+    if cell_size <= 0:
+        cell_size = max(float(np.mean(sorted_dets[:, 2:4] - sorted_dets[:, 0:2] + 1)), 1.)
+    lo = sorted_dets[:, :2].min(0)
+    # 网格数不超过4n(比如batched nms中加了类别偏移的框分布很广)
+    extent = (sorted_dets[:, 2:4].max(0) + 1 - lo).astype(np.float64)
+    cell_size = max(cell_size, float(np.sqrt(max(extent[0], 1) * max(extent[1], 1) / (4. * n))))
+    cells_lo = ((sorted_dets[:, :2] - lo) / cell_size).astype(np.int64)
+    cells_hi = np.maximum(((sorted_dets[:, 2:4] + 1 - lo) / cell_size).astype(np.int64),
+                          cells_lo)
+    cdef np.int64_t[:, ::1] c_lo = np.ascontiguousarray(cells_lo)
+    cdef np.int64_t[:, ::1] c_hi = np.ascontiguousarray(cells_hi)
+    cdef Py_ssize_t nx = int(cells_hi[:, 0].max()) + 1
+    cdef Py_ssize_t ny = int(cells_hi[:, 1].max()) + 1
+
+    # CSR格式的网格: 按score顺序放入，每个网格内的序号升序
+    cdef np.int64_t[::1] starts = np.zeros(nx * ny + 1, dtype=np.int64)
+    cdef Py_ssize_t i, j, e, cx, cy, c
+    for i in range(n):
+        for cy in range(c_lo[i, 1], c_hi[i, 1] + 1):
+            for cx in range(c_lo[i, 0], c_hi[i, 0] + 1):
+                starts[cy * nx + cx + 1] += 1
+    for c in range(nx * ny):
+        starts[c + 1] += starts[c]
+    cdef np.int64_t[::1] heads = np.array(starts[:nx * ny], dtype=np.int64)
+    cdef np.int64_t[::1] entries = np.empty(starts[nx * ny], dtype=np.int64)
+    for i in range(n):
+        for cy in range(c_lo[i, 1], c_hi[i, 1] + 1):
+            for cx in range(c_lo[i, 0], c_hi[i, 0] + 1):
+                c = cy * nx + cx
+                entries[heads[c]] = i
+                heads[c] += 1
+    heads[:] = starts[:nx * ny]
+
+    cdef np.uint8_t[::1] suppressed = np.zeros(n, dtype=np.uint8)
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t w, h, inter, ovr
+    keep = []
+    for i in range(n):
+        if suppressed[i] == 1:
+            continue
+        keep.append(order[i])
+        ix1 = boxes[i, 0]
+        iy1 = boxes[i, 1]
+        ix2 = boxes[i, 2]
+        iy2 = boxes[i, 3]
+        iarea = areas[i]
+        for cy in range(c_lo[i, 1], c_hi[i, 1] + 1):
+            for cx in range(c_lo[i, 0], c_hi[i, 0] + 1):
+                c = cy * nx + cx
+                # 排在i之前或已被抑制的框以后都不需要再检查
+                while heads[c] < starts[c + 1] and (
+                        entries[heads[c]] <= i or suppressed[entries[heads[c]]] == 1):
+                    heads[c] += 1
+                for e in range(heads[c], starts[c + 1]):
+                    j = entries[e]
+                    if suppressed[j] == 1:
+                        continue
+                    w = _max(0.0, _min(ix2, boxes[j, 2]) - _max(ix1, boxes[j, 0]) + 1)
+                    h = _max(0.0, _min(iy2, boxes[j, 3]) - _max(iy1, boxes[j, 1]) + 1)
+                    inter = w * h
+                    ovr = inter / (iarea + areas[j] - inter)
+                    if ovr >= thresh:
+                        suppressed[j] = 1
+    return keep
@@ -0,0 +1,82 @@
+# --------------------------------------------------------
+# 多线程的逐类别cpu nms: 所有类别的候选框一次传入，释放GIL后用OpenMP并行处理各个类别，
+# 每个类别的计算跟cpu_nms一致
+# --------------------------------------------------------
+
+cimport cython
+from cython.parallel cimport prange
+
+import numpy as np
+cimport numpy as np
+
+cdef inline np.float32_t _max(np.float32_t a, np.float32_t b) noexcept nogil:
+    return a if a >= b else b
+
+cdef inline np.float32_t _min(np.float32_t a, np.float32_t b) noexcept nogil:
+    return a if a <= b else b
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _nms_segment(np.float32_t[:, ::1] dets, np.float32_t[::1] areas,
+                       np.uint8_t[::1] suppressed, Py_ssize_t start, Py_ssize_t end,
+                       double thresh) noexcept nogil:
+    """dets[start:end]为同一类别的框，已按score降序排列"""
+    cdef Py_ssize_t i, j
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t w, h, inter, ovr
+    for i in range(start, end):
+        if suppressed[i] == 1:
+            continue
+        ix1 = dets[i, 0]
+        iy1 = dets[i, 1]
+        ix2 = dets[i, 2]
+        iy2 = dets[i, 3]
+        iarea = areas[i]
+        for j in range(i + 1, end):
+            if suppressed[j] == 1:
+                continue
+            w = _max(0.0, _min(ix2, dets[j, 2]) - _max(ix1, dets[j, 0]) + 1)
+            h = _max(0.0, _min(iy2, dets[j, 3]) - _max(iy1, dets[j, 1]) + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                suppressed[j] = 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_multi(dets_list, double thresh, int num_threads=1):
+    """
+    Args:
+        dets_list(list[ndarray]): 每个类别的候选框 (n_i,5) float32
+        thresh(float): iou阈值
+        num_threads(int): OpenMP线程数
+    Returns:
+        list[ndarray]: 每个类别保留的框的序号(类别内的序号, 按score降序), int64
+    """
+    cdef Py_ssize_t num_classes = len(dets_list)
+    counts = np.array([d.shape[0] for d in dets_list], dtype=np.int64)
+    cdef np.ndarray[np.int64_t, ndim=1] offsets = np.zeros(num_classes + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if offsets[num_classes] == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in range(num_classes)]
+
+    # 每个类别内部按score降序，拼接成一个连续的数组
+    orders = [d[:, 4].argsort()[::-1] for d in dets_list]
+    dets_arr = np.ascontiguousarray(np.concatenate(
+        [d[o, :5] for d, o in zip(dets_list, orders)]), dtype=np.float32)
+    cdef np.float32_t[:, ::1] dets = dets_arr
+    cdef np.float32_t[::1] areas = np.ascontiguousarray(
+        (dets_arr[:, 2] - dets_arr[:, 0] + 1) * (dets_arr[:, 3] - dets_arr[:, 1] + 1))
+    cdef np.ndarray[np.uint8_t, ndim=1] suppressed_arr = np.zeros(
+        offsets[num_classes], dtype=np.uint8)
+    cdef np.uint8_t[::1] suppressed = suppressed_arr
+    cdef np.int64_t[::1] off = offsets
+
+    cdef Py_ssize_t c
+    for c in prange(num_classes, nogil=True, schedule='dynamic', num_threads=num_threads):
+        _nms_segment(dets, areas, suppressed, off[c], off[c + 1], thresh)
+
+    return [order[suppressed_arr[offsets[i]:offsets[i + 1]] == 0].astype(np.int64)
+            for i, order in enumerate(orders)]
@@ -1,25 +1,53 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
 
-from .gpu_nms import gpu_nms
-from .cpu_nms import cpu_nms
-from .cpu_soft_nms import cpu_soft_nms
+from .torch_nms import torch_nms, torch_soft_nms, matrix_nms  # noqa: F401
+# 编译的扩展不存在时(比如没有cuda或者没有执行make), nms退回到纯tensor实现的torch_nms
+try:
+    from .gpu_nms import gpu_nms
+except ImportError:
+    gpu_nms = None
+try:
+    from .cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
+try:
+    from .cpu_grid_nms import cpu_grid_nms
+except ImportError:
+    cpu_grid_nms = None
+try:
+    from .cpu_nms_multi import cpu_nms_multi
+except ImportError:
+    cpu_nms_multi = None
+try:
+    from .cpu_soft_nms import cpu_soft_nms
+except ImportError:
+    cpu_soft_nms = None
+if cpu_nms is None:
+    logging.getLogger().warning(
+        'compiled nms extensions are not built(run make in utils/nms), '
+        'fall back to torch_nms')
 
 
 def nms(dets, iou_thr, device_id=None):
-    """Dispatch to either CPU or GPU NMS implementations."""
+    """Dispatch to either CPU or GPU NMS implementations.
+    对应的编译扩展不存在时使用torch_nms(结果一致)"""
     if isinstance(dets, torch.Tensor):
         is_tensor = True
         if dets.is_cuda:
             device_id = dets.get_device()
-        dets_np = dets.detach().cpu().numpy()
     elif isinstance(dets, np.ndarray):
         is_tensor = False
-        dets_np = dets
     else:
         raise TypeError(
             'dets must be either a Tensor or numpy array, but got {}'.format(
                 type(dets)))
+    if (gpu_nms if device_id is not None else cpu_nms) is None:
+        return torch_nms(dets, iou_thr)
+    dets_np = dets.detach().cpu().numpy() if is_tensor else dets
 
     if dets_np.shape[0] == 0:
         inds = []
@@ -34,30 +62,62 @@ def nms(dets, iou_thr, device_id=None):
     return dets[inds, :], inds
 
 
-def soft_nms(dets, iou_thr, method='linear', sigma=0.5, min_score=1e-3):
+def grid_nms(dets, iou_thr, cell_size=0):
+    """网格索引的cpu nms，结果跟nms()完全一致，框很多时(大约1000个以上)更快.
+    cpu_grid_nms不存在时使用nms()
+    Args:
+        dets(tensor or ndarray): (n,5)
+        cell_size(float): 网格大小, <=0时取框的平均边长
+    """
+    if cpu_grid_nms is None:
+        return nms(dets, iou_thr)
     if isinstance(dets, torch.Tensor):
-        is_tensor = True
         dets_np = dets.detach().cpu().numpy()
+        inds = cpu_grid_nms(dets_np, iou_thr, cell_size=cell_size)
+        inds = dets.new_tensor(inds, dtype=torch.long)
     elif isinstance(dets, np.ndarray):
-        is_tensor = False
-        dets_np = dets
+        inds = np.array(cpu_grid_nms(dets, iou_thr, cell_size=cell_size), dtype=np.int64)
     else:
         raise TypeError(
             'dets must be either a Tensor or numpy array, but got {}'.format(
                 type(dets)))
+    return dets[inds, :], inds
+
 
-    method_codes = {'linear': 1, 'gaussian': 2}
-    if method not in method_codes:
-        raise ValueError('Invalid method for SoftNMS: {}'.format(method))
-    new_dets, inds = cpu_soft_nms(
-        dets_np,
-        iou_thr,
-        method=method_codes[method],
-        sigma=sigma,
-        min_score=min_score)
+def nms_multi(dets_list, iou_thr, num_threads=1):
+    """多个类别的nms一次完成，各个类别在num_threads个线程中并行处理.
+    使用编译的cpu_nms_multi(OpenMP, 释放GIL)，不存在时用线程池执行torch_nms
+    Args:
+        dets_list(list[tensor or ndarray]): 每个类别的候选框 (n_i,5)
+        num_threads(int): 线程数
+    Returns:
+        list: 每个类别保留的框的序号(类别内的序号, 按score降序)，跟dets同类型
+    """
+    if len(dets_list) == 0:
+        return []
+    is_tensor = isinstance(dets_list[0], torch.Tensor)
+    if cpu_nms_multi is None:
+        with ThreadPoolExecutor(num_threads) as pool:
+            return [inds for _, inds in pool.map(lambda d: torch_nms(d, iou_thr), dets_list)]
 
+    dets_np = [d.detach().cpu().numpy() if is_tensor else d for d in dets_list]
+    keeps = cpu_nms_multi(dets_np, iou_thr, num_threads=num_threads)
     if is_tensor:
-        return dets.new_tensor(new_dets), dets.new_tensor(
-            inds, dtype=torch.long)
-    else:
-        return new_dets.astype(np.float32), inds.astype(np.int64)
+        return [torch.from_numpy(keep).to(d.device) for d, keep in zip(dets_list, keeps)]
+    return keeps
+
+
+def soft_nms(dets, iou_thr, method='linear', sigma=0.5, min_score=1e-3, groups=None):
+    """soft nms, 使用向量化的torch_soft_nms(结果跟cpu_soft_nms一致，在浮点误差范围内)
+    Args:
+        dets(tensor or ndarray): (n,5)
+        groups(tensor): (n,) 可选, 不同group(比如类别)的框互不衰减，所有group并行处理
+    Returns:
+        dets, inds: 跟dets同类型, dets的score为衰减后的score
+    """
+    if not isinstance(dets, (torch.Tensor, np.ndarray)):
+        raise TypeError(
+            'dets must be either a Tensor or numpy array, but got {}'.format(
+                type(dets)))
+    return torch_soft_nms(dets, iou_thr, method=method, sigma=sigma,
+                          min_score=min_score, groups=groups)
@@ -15,8 +15,15 @@ ext_args = dict(
     },
 )
 
+# cpu_nms_multi用OpenMP并行处理各个类别
+omp_args = dict(ext_args, extra_link_args=['-fopenmp'])
+omp_args['extra_compile_args'] = dict(
+    ext_args['extra_compile_args'], cc=ext_args['extra_compile_args']['cc'] + ['-fopenmp'])
+
 extensions = [
     Extension('cpu_nms', ['cpu_nms.pyx'], **ext_args),
+    Extension('cpu_nms_multi', ['cpu_nms_multi.pyx'], **omp_args),
+    Extension('cpu_grid_nms', ['cpu_grid_nms.pyx'], **ext_args),
     Extension('cpu_soft_nms', ['cpu_soft_nms.pyx'], **ext_args),
     Extension('gpu_nms', ['gpu_nms.pyx', 'nms_kernel.cu'], **ext_args),
 ]
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+纯tensor实现的nms，不依赖编译的cpu_nms/gpu_nms扩展，cpu/gpu上都可以运行:
+1. torch_nms: 精确的hard nms，结果跟cpu_nms一致。按score排序后分块计算iou矩阵，
+   每块先用之前所有块保留的框做抑制，块内用上三角iou矩阵迭代到不动点(即贪心nms的结果)
+2. torch_soft_nms: 跟cpu_soft_nms一致的soft nms(linear/gaussian)。每轮对所有group同时选出
+   score最大的框，用向量化的iou衰减同一group中剩余的框，循环次数为最大的group大小
+3. matrix_nms: Matrix NMS(SOLOv2)，用iou矩阵并行地衰减score，没有顺序依赖，
+   是soft nms的近似，结果跟hard nms不同。计算量为O(n^2)，适合gpu或者nms_pre之后框较少的情况
+都支持groups参数: 不同group(类别或图片)之间的框互不抑制，可以一次处理多类别/多张图片
+"""
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def box_iou(bboxes1, bboxes2, areas1: Optional[torch.Tensor] = None,
+            areas2: Optional[torch.Tensor] = None):
+    """跟cpu_nms的计算方式一致(宽高按+1计算)的iou矩阵
+    Args:
+        bboxes1(tensor): (m,4)
+        bboxes2(tensor): (n,4)
+    Returns:
+        ious(tensor): (m,n)
+    """
+    if areas1 is None:
+        areas1 = (bboxes1[:, 2] - bboxes1[:, 0] + 1) * (bboxes1[:, 3] - bboxes1[:, 1] + 1)
+    if areas2 is None:
+        areas2 = (bboxes2[:, 2] - bboxes2[:, 0] + 1) * (bboxes2[:, 3] - bboxes2[:, 1] + 1)
+    xx1 = torch.max(bboxes1[:, None, 0], bboxes2[None, :, 0])
+    yy1 = torch.max(bboxes1[:, None, 1], bboxes2[None, :, 1])
+    xx2 = torch.min(bboxes1[:, None, 2], bboxes2[None, :, 2])
+    yy2 = torch.min(bboxes1[:, None, 3], bboxes2[None, :, 3])
+    inter = (xx2 - xx1 + 1).clamp(min=0) * (yy2 - yy1 + 1).clamp(min=0)
+    return inter / (areas1[:, None] + areas2[None, :] - inter)
+
+
+def _overlap_mask(bboxes1, areas1, groups1: Optional[torch.Tensor], bboxes2, areas2,
+                  groups2: Optional[torch.Tensor], iou_thr: float):
+    """iou >= iou_thr且属于同一group的(m,n) mask.
+    cpu_nms中float32的iou跟double的阈值比较，这里也转成double比较，保证阈值附近结果一致
+    """
+    mask = box_iou(bboxes1, bboxes2, areas1, areas2).double() >= iou_thr
+    if groups1 is not None and groups2 is not None:
+        mask &= groups1[:, None] == groups2[None, :]
+    return mask
+
+
+def _to_tensor(dets):
+    if isinstance(dets, torch.Tensor):
+        return dets.detach(), True
+    if isinstance(dets, np.ndarray):
+        return torch.from_numpy(dets), False
+    raise TypeError(
+        'dets must be either a Tensor or numpy array, but got {}'.format(type(dets)))
+
+
+def _empty(dets, is_tensor):
+    inds = torch.zeros((0, ), dtype=torch.long, device=dets.device)
+    if is_tensor:
+        return dets[inds], inds
+    return dets.numpy()[:0], inds.numpy()
+
+
+def nms_sorted(bboxes, iou_thr: float, groups: Optional[torch.Tensor] = None,
+               block_size: int = 512):
+    """torch_nms()的分块计算，输入已经按score降序排列，可以torch.jit.script(推理模块也用它做nms)
+    Args:
+        bboxes(tensor): (n,4) 按score降序
+        groups(tensor): (n,) 可选, 跟bboxes顺序一致
+    Returns:
+        kept(tensor): (k,) 保留的框在bboxes中的序号(升序)
+    """
+    n = bboxes.size(0)
+    areas = (bboxes[:, 2] - bboxes[:, 0] + 1) * (bboxes[:, 3] - bboxes[:, 1] + 1)
+    kept = torch.zeros((0, ), dtype=torch.long, device=bboxes.device)
+    for start in range(0, n, block_size):
+        blk = torch.arange(start, min(start + block_size, n), device=bboxes.device)
+        blk_groups = groups[blk] if groups is not None else None
+        # 被之前块中保留的框抑制(之前的块已经是最终结果)，分段计算控制内存
+        candidate = torch.ones(blk.numel(), dtype=torch.bool, device=bboxes.device)
+        for kept_chunk in kept.split(block_size * 8):
+            kept_groups = groups[kept_chunk] if groups is not None else None
+            candidate &= ~_overlap_mask(bboxes[kept_chunk], areas[kept_chunk], kept_groups,
+                                        bboxes[blk], areas[blk], blk_groups, iou_thr).any(0)
+        # 块内: keep_j = candidate_j & 不存在i<j且keep_i且iou_ij>=thr.
+        # 从keep=candidate开始迭代, 第t次迭代后前t个框已经正确，不动点唯一即贪心nms的结果
+        suppress = _overlap_mask(bboxes[blk], areas[blk], blk_groups, bboxes[blk], areas[blk],
+                                 blk_groups, iou_thr).triu(1)
+        keep = candidate
+        while True:
+            new_keep = candidate & ~(suppress & keep[:, None]).any(0)
+            if torch.equal(new_keep, keep):
+                break
+            keep = new_keep
+        kept = torch.cat([kept, blk[keep]])
+    return kept
+
+
+def torch_nms(dets, iou_thr, groups=None, block_size=512):
+    """精确的hard nms(同nms_wrapper.nms: iou >= iou_thr的框被抑制)
+    Args:
+        dets(tensor or ndarray): (n,5) [x1,y1,x2,y2,score]
+        iou_thr(float)
+        groups(tensor): (n,) 不同group的框互不抑制(比如类别序号，或者img_id * num_classes + 类别)
+        block_size(int): 每次计算iou的块大小，显存/内存占用为O(n * block_size)
+    Returns:
+        dets(tensor or ndarray): (k,5) 保留的框，按score降序
+        inds(tensor or ndarray): (k,) 保留的框在输入中的序号
+    """
+    dets_t, is_tensor = _to_tensor(dets)
+    n = dets_t.size(0)
+    if n == 0:
+        return _empty(dets_t, is_tensor)
+    _, order = dets_t[:, 4].sort(descending=True, stable=True)
+    if groups is not None:
+        groups = torch.as_tensor(groups, device=dets_t.device)[order]
+    kept = nms_sorted(dets_t[order, :4], iou_thr, groups, block_size)
+    inds = order[kept]
+    if is_tensor:
+        return dets[inds], inds
+    return dets_t[inds].numpy(), inds.numpy()
+
+
+def torch_soft_nms(dets, iou_thr, method='linear', sigma=0.5, min_score=1e-3, groups=None):
+    """soft nms(同cpu_soft_nms): 依次取score最大的框，衰减跟它重叠的框的score，
+    linear时iou > iou_thr的框乘以(1-iou), gaussian时乘以exp(-iou^2/sigma)，
+    衰减后低于min_score的框被去掉
+    Args:
+        dets(tensor or ndarray): (n,5)
+        method(str): 'linear' or 'gaussian'
+        groups(tensor): (n,) 不同group的框互不衰减，所有group并行处理
+    Returns:
+        dets(tensor or ndarray): (k,5) score为衰减后的score, 同一group内按选取的顺序
+        inds(tensor or ndarray): (k,)
+    """
+    if method not in ('linear', 'gaussian'):
+        raise ValueError('Invalid method for SoftNMS: {}'.format(method))
+    dets_t, is_tensor = _to_tensor(dets)
+    n = dets_t.size(0)
+    if n == 0:
+        return _empty(dets_t, is_tensor)
+    device = dets_t.device
+    x1, y1, x2, y2 = dets_t[:, :4].unbind(1)
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    # 剩余的框: (k,6) x1,y1,x2,y2,area,score, 每轮只做一次压缩
+    rest = torch.cat([dets_t[:, :4], areas[:, None], dets_t[:, 4:5]], 1)
+    rest_inds = torch.arange(n, device=device)
+    if groups is None:
+        rest_groups, num_groups = None, 1
+    else:
+        _, rest_groups = torch.unique(torch.as_tensor(groups, device=device),
+                                      return_inverse=True)
+        num_groups = int(rest_groups.max()) + 1
+        partner = rest_inds.new_empty(num_groups)
+
+    picked, picked_scores = [], []
+    while rest_inds.numel() > 0:
+        k = rest_inds.numel()
+        if rest_groups is None:
+            first = rest[:, 5].argmax()[None]
+        else:
+            # 每个group中score最大的框(相同时取第一个)
+            group_max = rest.new_full((num_groups, ), -float('inf')).scatter_reduce(
+                0, rest_groups, rest[:, 5], 'amax')
+            is_max = torch.nonzero(rest[:, 5] == group_max[rest_groups])[:, 0]
+            first = is_max.new_full((num_groups, ), k).scatter_reduce(
+                0, rest_groups[is_max], is_max, 'amin')
+            first = first[first < k]
+        top = rest[first]
+        picked.append(rest_inds[first])
+        picked_scores.append(top[:, 5])
+        if k == first.numel():
+            break
+        if rest_groups is not None:
+            # 每个框跟同一group本轮选出的框计算iou
+            partner[rest_groups[first]] = torch.arange(first.numel(), device=device)
+            top = top[partner[rest_groups]]
+
+        # 计算顺序跟cpu_soft_nms一致
+        iw = torch.min(top[:, 2], rest[:, 2]) - torch.max(top[:, 0], rest[:, 0]) + 1
+        ih = torch.min(top[:, 3], rest[:, 3]) - torch.max(top[:, 1], rest[:, 1]) + 1
+        overlap = (iw > 0) & (ih > 0)
+        inter = iw * ih
+        ov = inter / (top[:, 4] + rest[:, 4] - inter)
+        if method == 'linear':
+            weight = torch.where(ov > iou_thr, 1 - ov, torch.ones_like(ov))
+        else:
+            # cpu_soft_nms中用np.exp在double下计算
+            weight = torch.exp((-(ov * ov) / sigma).double()).float()
+        new_scores = (weight.double() * rest[:, 5].double()).float()
+        rest[:, 5] = torch.where(overlap, new_scores, rest[:, 5])
+        keep = ~(overlap & (new_scores < min_score))
+        keep[first] = False
+        rest, rest_inds = rest[keep], rest_inds[keep]
+        if rest_groups is not None:
+            rest_groups = rest_groups[keep]
+
+    inds = torch.cat(picked)
+    new_dets = torch.cat([dets_t[inds, :4], torch.cat(picked_scores)[:, None]], 1)
+    if is_tensor:
+        return new_dets, inds
+    return new_dets.numpy(), inds.numpy()
+
+
+def matrix_nms(dets, iou_thr=None, kernel='gaussian', sigma=2.0, min_score=1e-3,
+               groups=None, block_size=2048):
+    """Matrix NMS: score衰减为decay_j = min_{i<j} f(iou_ij) / f(max_{k<i} iou_ki)，
+    f为gaussian exp(-sigma*iou^2)或linear 1-iou，所有框并行计算
+    Args:
+        dets(tensor or ndarray): (n,5)
+        iou_thr(float): 为了跟nms的cfg兼容，不使用
+        kernel(str): 'gaussian' or 'linear'
+        min_score(float): 衰减后score低于该值的框被去掉
+        groups(tensor): (n,) 不同group的框互不衰减
+    Returns:
+        dets(tensor or ndarray): (k,5) score为衰减后的score, 按衰减后的score降序
+        inds(tensor or ndarray): (k,)
+    """
+    if kernel not in ('gaussian', 'linear'):
+        raise ValueError('Invalid kernel for MatrixNMS: {}'.format(kernel))
+    dets_t, is_tensor = _to_tensor(dets)
+    n = dets_t.size(0)
+    if n == 0:
+        return _empty(dets_t, is_tensor)
+    _, order = dets_t[:, 4].sort(descending=True, stable=True)
+    bboxes = dets_t[order, :4]
+    areas = (bboxes[:, 2] - bboxes[:, 0] + 1) * (bboxes[:, 3] - bboxes[:, 1] + 1)
+    if groups is not None:
+        groups = torch.as_tensor(groups, device=dets_t.device)[order]
+
+    def upper_ious(cols):
+        """(cols[-1]+1, len(cols))的iou, 只有i<j的框会衰减j, 只计算前cols[-1]+1行，
+        并只保留i<j且同一group的部分"""
+        rows = cols[-1] + 1
+        ious = box_iou(bboxes[:rows], bboxes[cols], areas[:rows], areas[cols])
+        mask = torch.arange(rows, device=dets_t.device)[:, None] < cols[None, :]
+        if groups is not None:
+            mask &= groups[:rows, None] == groups[cols][None, :]
+        return ious * mask
+
+    def f(ious):
+        if kernel == 'gaussian':
+            return torch.exp(-sigma * ious ** 2)
+        return 1 - ious
+
+    # 第一遍: 每个框被更高分的框覆盖的最大iou
+    col_blocks = torch.arange(n, device=dets_t.device).split(block_size)
+    compensate = torch.cat([upper_ious(cols).max(0)[0] for cols in col_blocks])
+    f_compensate = f(compensate).clamp(min=1e-6)
+    # 第二遍: 衰减系数decay_j = min_i f(iou_ij)/f(compensate_i)，i>=j的部分iou为0，
+    # 比值为1/f(compensate_i)>=1，而i=0时为1，所以只需计算i<=cols[-1]的行
+    decay = torch.cat([(f(upper_ious(cols)) / f_compensate[:cols[-1] + 1, None]).min(0)[0]
+                       for cols in col_blocks])
+    scores = dets_t[order, 4] * decay
+    valid = scores >= min_score
+    order, scores = order[valid], scores[valid]
+    scores, resort = scores.sort(descending=True, stable=True)
+    inds = order[resort]
+    new_dets = torch.cat([dets_t[inds, :4], scores[:, None]], 1)
+    if is_tensor:
+        return new_dets, inds
+    return new_dets.numpy(), inds.numpy()